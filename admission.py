@@ -0,0 +1,327 @@
+# Admission control for upstream model calls
+# A global concurrency limit, per-client token buckets and a fair queue that sheds load past the SLO
+
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from resilience import remaining_time
+
+# Who the current request counts against: set by the server from the connection (or a header
+# from a trusted proxy), never from the request body. None for background work (jobs, speculation)
+admission_client: ContextVar[Optional[str]] = ContextVar("admission_client", default=None)
+
+
+@contextmanager
+def client_scope(client: Optional[str]):
+    """Count the calls inside the block against client (e.g. in a streamed response, which outlives the request)."""
+    token = admission_client.set(client)
+    try:
+        yield
+    finally:
+        admission_client.reset(token)
+
+
+class AdmissionRejected(Exception):
+    """
+    A request was not let through to the model.
+
+    reason is "rate_limited" (the client's token bucket is empty) or
+    "overloaded" (the queue wait would exceed the SLO).
+    """
+
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+class _Waiter:
+    __slots__ = ("user", "event", "granted")
+
+    def __init__(self, user: Optional[str]):
+        self.user = user
+        self.event = threading.Event()
+        self.granted = False
+
+    def wake(self):
+        self.event.set()
+
+
+class _AsyncWaiter:
+    """A queued coroutine, woken on its event loop by whichever thread frees a slot."""
+
+    __slots__ = ("user", "loop", "future", "granted")
+
+    def __init__(self, user: Optional[str]):
+        import asyncio
+        self.user = user
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.granted = False
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdmissionController:
+    """
+    Decide which requests may call the model, and when.
+
+    At most max_concurrent calls run at once. When every slot is busy,
+    requests wait in a per-user queue and freed slots go to the users in
+    round-robin order, so a user with many queued requests doesn't delay
+    everyone else's. With user_rate set, each user also has a token bucket
+    refilling at user_rate per second up to user_burst, so one user can't
+    use the whole quota.
+
+    A "user" is whatever the caller passes to admit(); the servers pass
+    admission_client, the client's address, because anything in the
+    request body can be made up. admit(None) is background work that is
+    already bounded by its own worker pool: it queues fairly but has no
+    token bucket.
+
+    A request is shed (AdmissionRejected "overloaded") instead of queued
+    when the queue is full or its expected wait, estimated from the recent
+    call duration, exceeds slo_seconds; a queued request that still hasn't
+    got a slot after slo_seconds (or its request deadline) is shed too.
+    Shedding early keeps the slots busy with requests that can still
+    finish in time, so throughput holds steady under overload.
+
+    Args:
+        max_concurrent: Upstream calls allowed at once
+        user_rate: Requests per second each user may sustain (0, the default, turns the buckets off)
+        user_burst: Requests a user may send at once
+        slo_seconds: Longest a request may wait for a slot
+        max_queue: Most requests waiting at once
+        max_users: Token buckets kept before the least recently used are dropped
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 16,
+        user_rate: float = 0.0,
+        user_burst: int = 5,
+        slo_seconds: float = 10.0,
+        max_queue: int = 256,
+        max_users: int = 10000
+    ):
+        self.max_concurrent = max_concurrent
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.slo_seconds = slo_seconds
+        self.max_queue = max_queue
+        self.max_users = max_users
+        self._lock = threading.Lock()
+        self._active = 0
+        # user -> waiters; the order of the users is the round-robin order
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self._queued = 0
+        # user -> [tokens, last refill]
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+        self._service_time: Optional[float] = None
+        self.admitted = 0
+        self.rate_limited = 0
+        self.shed = 0
+        self.timed_out = 0
+        self.max_queue_wait = 0.0
+
+    @classmethod
+    def from_env(cls) -> "AdmissionController":
+        """Build a controller from the ADMISSION_* environment variables."""
+        return cls(
+            max_concurrent=int(os.getenv("ADMISSION_MAX_CONCURRENT", "16")),
+            user_rate=float(os.getenv("ADMISSION_USER_RATE", "0")),
+            user_burst=int(os.getenv("ADMISSION_USER_BURST", "5")),
+            slo_seconds=float(os.getenv("ADMISSION_SLO", "10")),
+            max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "256"))
+        )
+
+    @contextmanager
+    def admit(self, user: Optional[str]):
+        """
+        Hold an upstream slot for the duration of the block.
+
+        Raises:
+            AdmissionRejected: if the request is rate limited or shed
+        """
+        self._acquire(user)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(time.monotonic() - started)
+
+    @asynccontextmanager
+    async def admit_async(self, user: Optional[str]):
+        """
+        admit() for coroutines, sharing the same slots and queue.
+
+        Waiting for a slot doesn't block the event loop, and a request
+        cancelled while queued (its client went away) leaves the queue.
+
+        Raises:
+            AdmissionRejected: if the request is rate limited or shed
+        """
+        await self._acquire_async(user)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(time.monotonic() - started)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "active": self._active,
+                "max_concurrent": self.max_concurrent,
+                "queued": self._queued,
+                "users_waiting": len(self._queues),
+                "admitted": self.admitted,
+                "rate_limited": self.rate_limited,
+                "shed": self.shed,
+                "timed_out": self.timed_out,
+                "avg_call_ms": round(1000 * self._service_time, 1) if self._service_time is not None else None,
+                "max_queue_wait_ms": round(1000 * self.max_queue_wait, 1)
+            }
+
+    def _acquire(self, user: Optional[str]):
+        budget = self._budget()
+        waiter = self._enqueue(user, budget, _Waiter)
+        if waiter is None:
+            return
+        started = time.monotonic()
+        waiter.event.wait(budget)
+        self._after_wait(waiter, time.monotonic() - started)
+
+    async def _acquire_async(self, user: Optional[str]):
+        import asyncio
+        budget = self._budget()
+        waiter = self._enqueue(user, budget, _AsyncWaiter)
+        if waiter is None:
+            return
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), budget)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._dequeue(waiter)
+                    self._refund_token(user)
+            if granted:
+                # The slot was handed over just as we were cancelled; pass it on
+                self._release(None)
+            raise
+        self._after_wait(waiter, time.monotonic() - started)
+
+    def _budget(self) -> float:
+        budget = self.slo_seconds
+        remaining = remaining_time()
+        if remaining is not None:
+            budget = min(budget, max(remaining, 0.0))
+        return budget
+
+    def _enqueue(self, user: Optional[str], budget: float, waiter_class):
+        # Take a slot right away (returns None) or join the queue (returns the waiter)
+        with self._lock:
+            if not self._take_token(user):
+                self.rate_limited += 1
+                raise AdmissionRejected("rate_limited", "Too many suggestion requests, slow down a little")
+            if self._active < self.max_concurrent and not self._queued:
+                self._active += 1
+                self.admitted += 1
+                return None
+            if self._queued >= self.max_queue or self._expected_wait() > budget:
+                self._refund_token(user)
+                self.shed += 1
+                raise AdmissionRejected("overloaded", "Too many requests right now")
+            waiter = waiter_class(user)
+            self._queues.setdefault(user, deque()).append(waiter)
+            self._queued += 1
+            return waiter
+
+    def _after_wait(self, waiter, waited: float):
+        with self._lock:
+            # A slot may have been handed over right as the wait timed out; take it then
+            if not waiter.granted:
+                self._dequeue(waiter)
+                self._refund_token(waiter.user)
+                self.timed_out += 1
+                self.shed += 1
+                raise AdmissionRejected("overloaded", "Too many requests right now")
+            self.admitted += 1
+            self.max_queue_wait = max(self.max_queue_wait, waited)
+
+    def _dequeue(self, waiter):
+        # Caller must hold the lock
+        queue = self._queues[waiter.user]
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[waiter.user]
+        self._queued -= 1
+
+    def _release(self, service_time: Optional[float]):
+        with self._lock:
+            # Moving average of how long a call holds its slot, for the expected wait
+            if service_time is None:
+                pass
+            elif self._service_time is None:
+                self._service_time = service_time
+            else:
+                self._service_time += 0.1 * (service_time - self._service_time)
+
+            if not self._queues:
+                self._active -= 1
+                return
+            # Hand the slot straight to the next user in turn
+            user, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            if queue:
+                self._queues.move_to_end(user)
+            else:
+                del self._queues[user]
+            self._queued -= 1
+            waiter.granted = True
+            waiter.wake()
+
+    def _expected_wait(self) -> float:
+        # Caller must hold the lock. Requests ahead of us, drained max_concurrent at a time
+        if self._service_time is None:
+            return 0.0
+        return (self._queued + 1) * self._service_time / self.max_concurrent
+
+    def _take_token(self, user: Optional[str]) -> bool:
+        # Caller must hold the lock
+        if self.user_rate <= 0 or user is None:
+            return True
+        now = time.monotonic()
+        bucket = self._buckets.get(user)
+        if bucket is None:
+            bucket = self._buckets[user] = [float(self.user_burst), now]
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user)
+            bucket[0] = min(float(self.user_burst), bucket[0] + (now - bucket[1]) * self.user_rate)
+            bucket[1] = now
+        if bucket[0] < 1.0:
+            return False
+        bucket[0] -= 1.0
+        return True
+
+    def _refund_token(self, user: Optional[str]):
+        # Caller must hold the lock. Shed requests don't count against the user
+        bucket = self._buckets.get(user)
+        if bucket is not None and self.user_rate > 0:
+            bucket[0] = min(float(self.user_burst), bucket[0] + 1.0)
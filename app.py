@@ -3,50 +3,86 @@
 
 import os
 import json
-from typing import List, Dict
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Iterator, Optional, Tuple
 
-from xai_sdk import Client
-from xai_sdk.chat import user, system
 
-# Initialize the client
-client = Client(api_key=os.getenv("XAI_API_KEY"))
+from backends import create_client
+from chat_sessions import ChatSessionManager, make_session_key
+from client_pool import ClientPool
+from model_routing import ModelRouter, HedgePolicy, call_model
+from resilience import CircuitBreaker, CircuitOpenError, RetryPolicy, deadline_scope, is_deadline_error, resilient_call
+from suggestion_options import DEFAULT_COUNT, SuggestionOptions
 
+# Clients are shared by all threads (batch mode runs several requests at once);
+# their connections are opened when the script starts, not on the first request
+client_pool = ClientPool.from_env(create_client)
 
-def generate_reply_suggestions(conversation_history: List[Dict[str, str]]) -> List[str]:
+# Persistent per-conversation chats, so follow-up requests only send new turns.
+# Older turns are folded into a rolling summary once the prompt passes the token budget
+chat_sessions = ChatSessionManager(
+    max_prompt_tokens=int(os.getenv("CONTEXT_MAX_TOKENS", "6000")) or None,
+    recent_turns=int(os.getenv("CONTEXT_RECENT_TURNS", "20"))
+)
+
+# Short, simple threads run on a faster model; slow first tokens can trigger a backup request
+model_router = ModelRouter.from_env(standard_model="grok-4")
+hedge_policy = HedgePolicy.from_env()
+
+# Upstream calls get UPSTREAM_DEADLINE seconds, transient errors are retried within it, and
+# the breaker returns the fallback suggestions right away while the API keeps failing
+UPSTREAM_DEADLINE = float(os.getenv("UPSTREAM_DEADLINE", "60"))
+upstream_breaker = CircuitBreaker.from_env()
+upstream_retry = RetryPolicy.from_env()
+
+# Returned when the model output can't be parsed or the model can't be reached
+FALLBACK_SUGGESTIONS = [
+    "I need to think about this and get back to you.",
+    "Thanks for reaching out. Let me consider this.",
+    "That's interesting. Could you tell me more?"
+]
+
+
+def generate_reply_suggestions(
+    conversation_history: List[Dict[str, str]],
+    conversation_id: str = None,
+    prompt_stats: Dict = None,
+    count: int = DEFAULT_COUNT,
+    tones: List[str] = None
+) -> List[str]:
     """
-    Generate three reply suggestions based on conversation history.
+    Generate reply suggestions based on conversation history.
     
     Args:
         conversation_history: List of messages with 'sender' and 'message' keys
+        conversation_id: Optional id of the conversation, so follow-up calls
+            reuse its chat session and only send the new messages
+        prompt_stats: Optional dict that is filled in with the prompt size
+            and the routing/hedging decision
+        count: Number of suggestions (1 to 5)
+        tones: Optional tones the suggestions may use (see suggestion_options.TONES)
     
     Returns:
-        List of three suggested replies
+        List of `count` suggested replies
     """
-    # Create a new chat instance
-    chat = client.chat.create(model="grok-4")
+    options = SuggestionOptions(count, tones)
     
     # System prompt that instructs Grok to generate structured output
     system_prompt = """You are a helpful AI assistant that analyzes message conversations and suggests appropriate replies.
 
-When given a conversation history, you will provide exactly 3 reply suggestions that:
+When given a conversation history, you will provide exactly as many reply suggestions as the request asks for, that:
 1. Are contextually appropriate and natural
-2. Vary in tone and approach (e.g., friendly, professional, casual)
+2. Vary in tone and approach (e.g., friendly, professional, casual), using only the tones the request allows
 3. Are concise but complete responses
 4. Take into account the entire conversation context
 
-IMPORTANT: You must respond with ONLY a valid JSON object in this exact format:
+IMPORTANT: You must respond with ONLY a valid JSON object in this exact format, with one object in "suggestions" per requested suggestion:
 {
     "suggestions": [
         {
-            "reply": "Your first suggested reply here",
-            "tone": "friendly/professional/casual/etc"
-        },
-        {
-            "reply": "Your second suggested reply here",
-            "tone": "friendly/professional/casual/etc"
-        },
-        {
-            "reply": "Your third suggested reply here",
+            "reply": "Your suggested reply here",
             "tone": "friendly/professional/casual/etc"
         }
     ]
@@ -54,34 +90,56 @@ IMPORTANT: You must respond with ONLY a valid JSON object in this exact format:
 
 Do not include any other text or explanation, just the JSON object."""
     
-    chat.append(system(system_prompt))
-    
-    # Format the conversation history for the AI
-    conversation_text = "Here is the conversation history:\n\n"
-    for msg in conversation_history:
-        conversation_text += f"{msg['sender']}: {msg['message']}\n"
-    
-    conversation_text += "\nPlease provide 3 reply suggestions for the last message."
-    
-    chat.append(user(conversation_text))
-    
-    # Get the response
-    response = chat.sample()
+    # Reuse the conversation's session so only new turns are sent
+    decision = model_router.route(conversation_history)
+    session_key = conversation_id or make_session_key(conversation_history)
+    
+    def make_chat():
+        return chat_sessions.prepare_chat(
+            client,
+            decision.model,
+            session_key,
+            system_prompt,
+            conversation_history,
+            f"Please provide {options.amount()} for the last message.{options.tone_instruction()}"
+        )
+    
+    # make_chat() builds its chats on the leased client
+    with client_pool.lease() as client:
+        chat, prompt_info = make_chat()
+        
+        # Get the response within the deadline, retrying transient errors and racing
+        # a backup call if the first token is late and hedging is on
+        try:
+            with deadline_scope(UPSTREAM_DEADLINE):
+                call, _ = resilient_call(
+                    lambda: call_model(chat, lambda: make_chat()[0], decision.model, hedge_policy),
+                    upstream_breaker,
+                    upstream_retry
+                )
+        except Exception as e:
+            if not (isinstance(e, CircuitOpenError) or is_deadline_error(e)):
+                raise
+            print(f"Model unavailable, using fallback suggestions: {e}")
+            return FALLBACK_SUGGESTIONS[:options.count]
+    response = call.response
+    
+    if prompt_stats is not None:
+        prompt_stats.update(prompt_info)
+        prompt_stats["routing"] = {**decision.to_dict(), **(call.to_dict() if hedge_policy.enabled else {})}
+        if response.usage.prompt_tokens:
+            prompt_stats["prompt_tokens"] = response.usage.prompt_tokens
     
     try:
         # Parse the JSON response
-        result = json.loads(response.content)
+        result = json.loads(call.content)
         suggestions = [item['reply'] for item in result['suggestions']]
         return suggestions
     except (json.JSONDecodeError, KeyError) as e:
         print(f"Error parsing response: {e}")
-        print(f"Raw response: {response.content}")
+        print(f"Raw response: {call.content}")
         # Fallback suggestions if parsing fails
-        return [
-            "I need to think about this and get back to you.",
-            "Thanks for reaching out. Let me consider this.",
-            "That's interesting. Could you tell me more?"
-        ]
+        return FALLBACK_SUGGESTIONS[:options.count]
 
 
 def demo_conversation():
@@ -193,13 +251,194 @@ def interactive_mode():
         print("No conversation entered.")
 
 
+def read_conversations(input_path: str, skip: set, start_line: int) -> Iterator[Tuple[int, Dict]]:
+    """
+    Lazily read conversations from a JSONL file.
+    
+    Each line is either a JSON list of messages or an object with a
+    'conversation' list and an optional 'id'.
+    
+    Args:
+        input_path: Path to the input JSONL file
+        skip: Line numbers that are already done
+        start_line: Every line below this number is already done
+    
+    Yields:
+        (line_number, record) pairs, where record has 'id' and 'conversation',
+        is None for blank lines and is an error result with just 'id' and
+        'error' for lines that aren't a conversation
+    """
+    with open(input_path) as f:
+        for line_number, line in enumerate(f):
+            if line_number < start_line or line_number in skip:
+                continue
+            if not line.strip():
+                yield line_number, None
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield line_number, {"id": line_number, "error": f"Invalid JSON on line {line_number + 1}: {e}"}
+                continue
+            if isinstance(record, list):
+                record = {"conversation": record}
+            if not isinstance(record, dict) or not isinstance(record.get("conversation"), list):
+                record_id = record.get("id", line_number) if isinstance(record, dict) else line_number
+                yield line_number, {"id": record_id, "error": f"Line {line_number + 1} is not a conversation"}
+                continue
+            record.setdefault("id", line_number)
+            yield line_number, record
+
+
+def load_checkpoint(checkpoint_path: str) -> Tuple[int, set, Optional[int]]:
+    """Return (watermark, done line numbers above it, output length in bytes) from a checkpoint file."""
+    if not os.path.exists(checkpoint_path):
+        return 0, set(), None
+    with open(checkpoint_path) as f:
+        checkpoint = json.load(f)
+    return checkpoint["watermark"], set(checkpoint["done"]), checkpoint.get("output_bytes")
+
+
+def save_checkpoint(checkpoint_path: str, watermark: int, done: set, output_bytes: int):
+    """Atomically write the checkpoint so a crash never leaves it half written."""
+    tmp_path = checkpoint_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({"watermark": watermark, "done": sorted(done), "output_bytes": output_bytes}, f)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def _process_record(record: Dict) -> Dict:
+    """Generate suggestions for one batch record, capturing errors in the output."""
+    started = time.time()
+    try:
+        prompt_stats = {}
+        suggestions = generate_reply_suggestions(record["conversation"], record.get("conversation_id"), prompt_stats,
+                                                 record.get("count", DEFAULT_COUNT), record.get("tones"))
+        result = {"id": record["id"], "suggestions": suggestions, "prompt": prompt_stats}
+    except Exception as e:
+        result = {"id": record["id"], "error": str(e)}
+    result["elapsed_ms"] = round(1000 * (time.time() - started), 1)
+    return result
+
+
+# Lines a batch run may finish ahead of its oldest unfinished one, per concurrent request
+BATCH_MAX_AHEAD = int(os.getenv("BATCH_MAX_AHEAD", "16"))
+
+
+def batch_mode(input_path: str, output_path: str, concurrency: int = 8, checkpoint_path: str = None):
+    """
+    Generate suggestions for every conversation in a JSONL file.
+    
+    Conversations are streamed from the input, at most `concurrency` requests
+    are in flight at once, and results are appended to the output JSONL in
+    completion order. Progress is checkpointed after every result along
+    with the output's length: a rerun after a crash cuts off any line
+    written after the last checkpoint (its record runs again) and skips
+    everything before it, so no result is written twice. Memory stays flat:
+    only the in-flight records and the done lines above the checkpoint
+    watermark are held. Once BATCH_MAX_AHEAD × `concurrency` lines are done
+    ahead of the oldest unfinished one, no new record starts until it is
+    done, which also bounds the checkpoint file.
+    
+    Args:
+        input_path: JSONL file of conversations
+        output_path: JSONL file results are appended to
+        concurrency: Maximum number of concurrent model calls
+        checkpoint_path: Checkpoint file, defaults to output_path + ".checkpoint"
+    """
+    checkpoint_path = checkpoint_path or output_path + ".checkpoint"
+    watermark, done, output_bytes = load_checkpoint(checkpoint_path)
+    if watermark or done:
+        print(f"Resuming from line {watermark} ({len(done)} later lines already done)")
+    
+    processed = 0
+    errors = 0
+    started = time.time()
+    records = read_conversations(input_path, set(done), watermark)
+    max_ahead = BATCH_MAX_AHEAD * concurrency
+    
+    with open(output_path, 'a') as output, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if output_bytes is not None and output.tell() > output_bytes:
+            # Written after the last checkpoint, by records that aren't marked done and run again
+            output.truncate(output_bytes)
+            # An append-mode file's position doesn't follow the truncation
+            output.seek(0, os.SEEK_END)
+        save_checkpoint(checkpoint_path, watermark, done, output.tell())
+        pending = {}
+        
+        def mark_done(line_number: int):
+            nonlocal watermark
+            done.add(line_number)
+            # Advance the watermark over the contiguous run of done lines
+            while watermark in done:
+                done.discard(watermark)
+                watermark += 1
+        
+        def finish(line_number: int, result: Dict):
+            nonlocal processed, errors
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+            
+            processed += 1
+            if "error" in result:
+                errors += 1
+            
+            mark_done(line_number)
+            # Right after the line, so a crash leaves at most that one line past the checkpoint
+            save_checkpoint(checkpoint_path, watermark, done, output.tell())
+        
+        def fill():
+            # Keep `concurrency` records in flight, but don't read further ahead while too many
+            # later lines wait on an earlier one. Something always runs, so the watermark moves
+            while len(pending) < concurrency and (not pending or len(done) < max_ahead):
+                line_number, record = next(records, (None, None))
+                if line_number is None:
+                    return
+                if record is None:
+                    mark_done(line_number)
+                elif "conversation" not in record:
+                    # Unreadable line: its error is the result, so a rerun doesn't stop on it again
+                    finish(line_number, record)
+                else:
+                    pending[executor.submit(_process_record, record)] = line_number
+        
+        fill()
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                line_number = pending.pop(future)
+                finish(line_number, future.result())
+            
+            fill()
+    
+    elapsed = time.time() - started
+    rate = processed / elapsed if elapsed else 0.0
+    print(f"Processed {processed} conversations ({errors} errors) in {elapsed:.1f}s, {rate:.1f}/s")
+
+
 if __name__ == "__main__":
-    # Check if API key is set
-    if not os.getenv("XAI_API_KEY"):
+    parser = argparse.ArgumentParser(description="Generate reply suggestions with Grok")
+    subparsers = parser.add_subparsers(dest="command")
+    batch_parser = subparsers.add_parser("batch", help="Generate suggestions for a JSONL file of conversations")
+    batch_parser.add_argument("input", help="Input JSONL, one conversation per line")
+    batch_parser.add_argument("output", help="Output JSONL, results are appended in completion order")
+    batch_parser.add_argument("--concurrency", type=int, default=8, help="Concurrent requests in flight (default: 8)")
+    batch_parser.add_argument("--checkpoint", help="Checkpoint file (default: <output>.checkpoint)")
+    args = parser.parse_args()
+    
+    # Check if API key is set (the local mock backend doesn't need one)
+    if os.getenv("XAI_BACKEND", "xai") == "xai" and not os.getenv("XAI_API_KEY"):
         print("Error: Please set your XAI_API_KEY environment variable")
         print("You can do this by running: export XAI_API_KEY='your-api-key-here'")
         exit(1)
     
+    # Open the connections while the rest of the script starts up
+    client_pool.warm_up(background=True)
+    
+    if args.command == "batch":
+        batch_mode(args.input, args.output, args.concurrency, args.checkpoint)
+        exit(0)
+    
     # Run the demo
     try:
         demo_conversation()
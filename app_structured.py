@@ -1,54 +1,232 @@
 # Enhanced version with Pydantic models for structured outputs
 # pip install xai-sdk pydantic
 
+from __future__ import annotations
+
 import os
 import json
-from typing import List, Dict, Optional, Literal
-from pydantic import BaseModel, Field
+import time
+from functools import lru_cache
+from typing import TYPE_CHECKING, List, Dict, Optional, Tuple
 
-from xai_sdk import Client
-from xai_sdk.chat import user, system
+from backends import create_client
+from chat_sessions import ChatSessionManager, make_session_key
+from client_pool import ClientPool
+from model_routing import ModelRouter, HedgePolicy, call_model
+from resilience import CircuitBreaker, CircuitOpenError, RetryPolicy, deadline_scope, is_deadline_error, resilient_call
+from suggestion_cache import make_cache_key
+from suggestion_history import SuggestionHistory
+from suggestion_options import DEFAULT_COUNT, SuggestionOptions
 
-# Initialize the client
-client = Client(api_key=os.getenv("XAI_API_KEY"))
+if TYPE_CHECKING:
+    from xai_sdk.proto import chat_pb2
+    from structured_models import ReplyResponses
 
+# Clients are shared by all threads (batch mode runs several requests at once);
+# their connections are opened when the script starts, not on the first request
+client_pool = ClientPool.from_env(create_client)
 
-# Define Pydantic models for structured outputs
-class ReplySuggestion(BaseModel):
-    """Model for a single reply suggestion"""
-    reply: str = Field(description="The suggested reply text")
-    tone: Literal["friendly", "professional", "casual", "empathetic", "assertive"] = Field(
-        description="The tone of the reply"
-    )
-    confidence: float = Field(
-        description="Confidence score for this suggestion (0-1)",
-        ge=0.0, 
-        le=1.0
-    )
-    context_notes: Optional[str] = Field(
-        description="Brief notes about why this reply is appropriate",
-        default=None
-    )
+# Persistent per-conversation chats, so follow-up requests only send new turns.
+# Older turns are folded into a rolling summary once the prompt passes the token budget
+chat_sessions = ChatSessionManager(
+    max_prompt_tokens=int(os.getenv("CONTEXT_MAX_TOKENS", "6000")) or None,
+    recent_turns=int(os.getenv("CONTEXT_RECENT_TURNS", "20"))
+)
 
+# Short, simple threads run on a faster model; slow first tokens can trigger a backup request
+model_router = ModelRouter.from_env(standard_model="grok-4")
+hedge_policy = HedgePolicy.from_env()
 
-class ReplyResponses(BaseModel):
-    """Model for the complete response containing multiple suggestions"""
-    suggestions: List[ReplySuggestion] = Field(
-        description="List of reply suggestions",
-        min_items=3,
-        max_items=3
-    )
-    conversation_summary: str = Field(
-        description="Brief summary of the conversation context"
+# Upstream calls get UPSTREAM_DEADLINE seconds, transient errors are retried within it, and
+# the breaker returns the fallback suggestions right away while the API keeps failing
+UPSTREAM_DEADLINE = float(os.getenv("UPSTREAM_DEADLINE", "60"))
+upstream_breaker = CircuitBreaker.from_env()
+upstream_retry = RetryPolicy.from_env()
+
+
+def build_system_prompt(embed_schema: bool) -> str:
+    """
+    Build the system prompt for structured suggestions.
+    
+    With native structured output the schema travels as the request's
+    response format, so it is only embedded in the prompt (compactly) when
+    the model has to be told about it in text.
+    """
+    if embed_schema:
+        from structured_models import ReplyResponses
+        schema_text = f"""Your response must be a valid JSON object that matches this schema:
+{json.dumps(ReplyResponses.model_json_schema(), separators=(",", ":"))}"""
+    else:
+        schema_text = "Your response must be a valid JSON object that matches the response schema."
+    
+    return f"""You are a helpful AI assistant that analyzes message conversations and suggests appropriate replies.
+
+You must analyze the conversation and provide exactly as many reply suggestions with metadata as the request asks for.
+
+{schema_text}
+
+Guidelines for suggestions:
+1. Each suggestion should have a different tone and approach, using only the tones the request allows
+2. Consider the full conversation context
+3. Provide confidence scores based on how well the suggestion fits
+4. Include brief context notes explaining why each suggestion is appropriate
+5. Summarize the conversation and identify the primary intent
+
+IMPORTANT: Respond ONLY with a valid JSON object. No additional text."""
+
+
+# "native" asks the API to constrain output to the ReplyResponses schema,
+# "prompt" only describes the schema in the system prompt
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "native")
+
+
+@lru_cache(maxsize=None)
+def response_format(response_model) -> "chat_pb2.ResponseFormat":
+    """
+    The native response format for a response model, built once per model.
+
+    Passing the pydantic class instead makes xai_sdk render and serialize
+    its JSON schema again on every chat.create.
+    """
+    from xai_sdk.proto import chat_pb2
+    return chat_pb2.ResponseFormat(
+        format_type=chat_pb2.FORMAT_TYPE_JSON_SCHEMA,
+        schema=json.dumps(response_model.model_json_schema())
     )
-    primary_intent: str = Field(
-        description="The primary intent detected in the last message"
+
+
+def response_options(response_model) -> Dict:
+    """Chat options that make the API enforce the response model, when output is native."""
+    return {"response_format": response_format(response_model)} if STRUCTURED_OUTPUT == "native" else {}
+
+
+@lru_cache(maxsize=None)
+def structured_request() -> Tuple[str, Dict]:
+    """
+    The system prompt and the chat options for the default 3 suggestions, built once on first use.
+
+    Not at import, so the command line and code that only imports this
+    module don't pay for loading pydantic and rendering the schema.
+    """
+    from structured_models import reply_responses_model
+    system_prompt = build_system_prompt(embed_schema=STRUCTURED_OUTPUT != "native")
+    return system_prompt, response_options(reply_responses_model())
+
+
+def __getattr__(name: str):
+    # The models and the prebuilt prompt used to be module attributes; keep them importable
+    if name in ("ReplyResponses", "ReplySuggestion"):
+        import structured_models
+        return getattr(structured_models, name)
+    if name == "SYSTEM_PROMPT":
+        return structured_request()[0]
+    if name == "CHAT_OPTIONS":
+        return structured_request()[1]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def fallback_reply_responses(count: int = DEFAULT_COUNT) -> ReplyResponses:
+    """Default suggestions for when the model output is invalid or the model can't be reached."""
+    from structured_models import ReplyResponses, ReplySuggestion
+    return ReplyResponses(
+        suggestions=[
+            ReplySuggestion(
+                reply="I'll need to think about this and get back to you.",
+                tone="professional",
+                confidence=0.7,
+                context_notes="Safe default response"
+            ),
+            ReplySuggestion(
+                reply="Thanks for reaching out. Let me look into this.",
+                tone="friendly",
+                confidence=0.7,
+                context_notes="Polite acknowledgment"
+            ),
+            ReplySuggestion(
+                reply="Could you provide more details about this?",
+                tone="casual",
+                confidence=0.6,
+                context_notes="Information gathering"
+            )
+        ][:count],
+        conversation_summary="Unable to analyze conversation",
+        primary_intent="Unknown"
     )
 
 
+def request_structured(
+    conversation_history: List[Dict[str, str]],
+    instruction: str,
+    response_model,
+    context: Optional[str] = None,
+    conversation_id: Optional[str] = None,
+    prompt_stats: Optional[Dict] = None
+) -> Optional[Tuple[str, str]]:
+    """
+    Send one structured request on the conversation's session.
+    
+    Returns:
+        (raw model output, session key), or None if the model can't be reached
+    """
+    # Context can change between calls, so it goes with the instruction
+    # rather than into the reusable history prefix
+    if context:
+        instruction = f"Additional context: {context}\n\n{instruction}"
+    
+    # Reuse the conversation's session so only new turns are sent
+    decision = model_router.route(conversation_history, context)
+    session_key = conversation_id or make_session_key(conversation_history)
+    system_prompt, _ = structured_request()
+    chat_options = response_options(response_model)
+    
+    def make_chat():
+        return chat_sessions.prepare_chat(
+            client,
+            decision.model,
+            session_key,
+            system_prompt,
+            conversation_history,
+            instruction,
+            history_header="Conversation history:\n\n",
+            **chat_options
+        )
+    
+    # make_chat() builds its chats on the leased client
+    with client_pool.lease() as client:
+        chat, prompt_info = make_chat()
+        
+        # Get the response within the deadline, retrying transient errors and racing
+        # a backup call if the first token is late and hedging is on
+        try:
+            with deadline_scope(UPSTREAM_DEADLINE):
+                call, _ = resilient_call(
+                    lambda: call_model(chat, lambda: make_chat()[0], decision.model, hedge_policy),
+                    upstream_breaker,
+                    upstream_retry
+                )
+        except Exception as e:
+            if not (isinstance(e, CircuitOpenError) or is_deadline_error(e)):
+                raise
+            print(f"Model unavailable: {e}")
+            return None
+    response = call.response
+    
+    if prompt_stats is not None:
+        prompt_stats.update(prompt_info)
+        prompt_stats["routing"] = {**decision.to_dict(), **(call.to_dict() if hedge_policy.enabled else {})}
+        if response.usage.prompt_tokens:
+            prompt_stats["prompt_tokens"] = response.usage.prompt_tokens
+            prompt_stats["completion_tokens"] = response.usage.completion_tokens
+    return call.content, session_key
+
+
 def generate_structured_reply_suggestions(
     conversation_history: List[Dict[str, str]], 
-    context: Optional[str] = None
+    context: Optional[str] = None,
+    conversation_id: Optional[str] = None,
+    prompt_stats: Optional[Dict] = None,
+    count: int = DEFAULT_COUNT,
+    tones: Optional[List[str]] = None
 ) -> ReplyResponses:
     """
     Generate structured reply suggestions with metadata.
@@ -56,83 +234,92 @@ def generate_structured_reply_suggestions(
     Args:
         conversation_history: List of messages with 'sender' and 'message' keys
         context: Optional additional context about the conversation
+        conversation_id: Optional id of the conversation, so follow-up calls
+            reuse its chat session and only send the new messages
+        prompt_stats: Optional dict that is filled in with the prompt size
+            and the routing/hedging decision
+        count: Number of suggestions (1 to 5)
+        tones: Optional tones the suggestions may use (see suggestion_options.TONES)
     
     Returns:
         ReplyResponses object with suggestions and metadata
     """
-    # Create a new chat instance
-    chat = client.chat.create(model="grok-4")
+    from structured_models import reply_responses_model
+    options = SuggestionOptions(count, tones)
+    response_model = reply_responses_model(options.count, options.tones)
+    instruction = f"Generate {options.amount()} with metadata.{options.tone_instruction()}"
     
-    # Create the schema from our Pydantic model
-    schema = ReplyResponses.model_json_schema()
+    sampled = request_structured(conversation_history, instruction, response_model, context, conversation_id, prompt_stats)
+    if sampled is None:
+        return fallback_reply_responses(options.count)
+    content, session_key = sampled
     
-    # System prompt with schema
-    system_prompt = f"""You are a helpful AI assistant that analyzes message conversations and suggests appropriate replies.
-
-You must analyze the conversation and provide exactly 3 reply suggestions with metadata.
-
-Your response must be a valid JSON object that matches this schema:
-{json.dumps(schema, indent=2)}
+    try:
+        # Validate straight from the raw JSON with Pydantic's compiled validator
+        parsed = response_model.model_validate_json(content)
+        # The model's own summary lets the next fold skip a summarization call
+        chat_sessions.record_summary(session_key, parsed.conversation_summary, len(conversation_history))
+        return parsed
+    except (json.JSONDecodeError, ValueError) as e:
+        print(f"Error parsing response: {e}")
+        print(f"Raw response: {content}")
+        
+        # Return default structured response
+        return fallback_reply_responses(options.count)
 
-Guidelines for suggestions:
-1. Each suggestion should have a different tone and approach
-2. Consider the full conversation context
-3. Provide confidence scores based on how well the suggestion fits
-4. Include brief context notes explaining why each suggestion is appropriate
-5. Summarize the conversation and identify the primary intent
 
-IMPORTANT: Respond ONLY with a valid JSON object. No additional text."""
-    
-    chat.append(system(system_prompt))
-    
-    # Format the conversation history
-    conversation_text = "Conversation history:\n\n"
-    for msg in conversation_history:
-        conversation_text += f"{msg['sender']}: {msg['message']}\n"
+def regenerate_structured_suggestion(
+    conversation_history: List[Dict[str, str]],
+    previous: ReplyResponses,
+    index: int,
+    context: Optional[str] = None,
+    conversation_id: Optional[str] = None,
+    prompt_stats: Optional[Dict] = None,
+    tones: Optional[List[str]] = None
+) -> ReplyResponses:
+    """
+    Replace one suggestion of an earlier response with a new one.
     
-    if context:
-        conversation_text += f"\nAdditional context: {context}\n"
+    Only the replacement is generated: the summary, the intent and the other
+    suggestions are taken from `previous` and sent along so the new one is
+    different, which makes this a fraction of the output of a full response.
     
-    conversation_text += "\nGenerate 3 reply suggestions with metadata."
+    Args:
+        conversation_history: The conversation `previous` was generated for
+        previous: Response whose suggestion is replaced
+        index: Position (from 0) of the suggestion to replace
+        tones: Optional tones the replacement may use
     
-    chat.append(user(conversation_text))
+    Returns:
+        `previous` with suggestion `index` replaced, or unchanged if the
+        model can't be reached or its output is invalid
+    """
+    from structured_models import reply_responses_model
+    if not 0 <= index < len(previous.suggestions):
+        raise IndexError(f"No suggestion {index} to regenerate")
+    options = SuggestionOptions(1, tones)
+    response_model = reply_responses_model(1, options.tones, with_analysis=False)
+    current = "\n".join(f"{i + 1}. ({s.tone}) {s.reply}" for i, s in enumerate(previous.suggestions))
+    instruction = f"""Generate 1 reply suggestion with metadata to replace suggestion {index + 1}.{options.tone_instruction()}
+It must be clearly different from all of the current suggestions:
+{current}
+
+The conversation is already summarized ("{previous.conversation_summary}", intent: "{previous.primary_intent}"), so respond with only the "suggestions" list."""
     
-    # Get the response
-    response = chat.sample()
+    sampled = request_structured(conversation_history, instruction, response_model, context, conversation_id, prompt_stats)
+    if sampled is None:
+        return previous
+    content, _ = sampled
     
     try:
-        # Parse and validate with Pydantic
-        result_data = json.loads(response.content)
-        return ReplyResponses(**result_data)
+        replacement = response_model.model_validate_json(content).suggestions[0]
     except (json.JSONDecodeError, ValueError) as e:
         print(f"Error parsing response: {e}")
-        print(f"Raw response: {response.content}")
-        
-        # Return default structured response
-        return ReplyResponses(
-            suggestions=[
-                ReplySuggestion(
-                    reply="I'll need to think about this and get back to you.",
-                    tone="professional",
-                    confidence=0.7,
-                    context_notes="Safe default response"
-                ),
-                ReplySuggestion(
-                    reply="Thanks for reaching out. Let me look into this.",
-                    tone="friendly",
-                    confidence=0.7,
-                    context_notes="Polite acknowledgment"
-                ),
-                ReplySuggestion(
-                    reply="Could you provide more details about this?",
-                    tone="casual",
-                    confidence=0.6,
-                    context_notes="Information gathering"
-                )
-            ],
-            conversation_summary="Unable to analyze conversation",
-            primary_intent="Unknown"
-        )
+        print(f"Raw response: {content}")
+        return previous
+    suggestions = list(previous.suggestions)
+    suggestions[index] = replacement
+    return previous.model_copy(update={"suggestions": suggestions})
 
 
 def display_structured_suggestions(response: ReplyResponses):
@@ -223,20 +410,49 @@ def demo_structured_conversations():
     display_structured_suggestions(response3)
 
 
-def save_suggestions_to_file(response: ReplyResponses, filename: str = "suggestions.json"):
-    """Save the structured suggestions to a JSON file."""
-    with open(filename, 'w') as f:
-        json.dump(response.model_dump(), f, indent=2)
-    print(f"\n💾 Suggestions saved to {filename}")
+def save_suggestions_to_history(
+    conversation_history: List[Dict[str, str]],
+    response: ReplyResponses,
+    conversation_id: Optional[str] = None,
+    prompt_stats: Optional[Dict] = None,
+    latency_ms: Optional[float] = None,
+    directory: Optional[str] = None
+):
+    """Append the structured suggestions to the suggestion history log (read it with suggestion_history.py)."""
+    directory = directory or os.getenv("SUGGESTION_HISTORY_DIR", "suggestion_history")
+    prompt_stats = prompt_stats or {}
+    history = SuggestionHistory(directory)
+    history.record({
+        "source": "app_structured",
+        "conversation_id": conversation_id,
+        "conversation_hash": make_cache_key(conversation_history, "You", "grok-4"),
+        "model": prompt_stats.get("routing", {}).get("model", "grok-4"),
+        "routing": prompt_stats.get("routing"),
+        "turns": len(conversation_history),
+        "success": True,
+        "latency_ms": latency_ms,
+        "prompt_tokens": prompt_stats.get("prompt_tokens"),
+        "completion_tokens": prompt_stats.get("completion_tokens"),
+        "suggestions": [suggestion.model_dump() for suggestion in response.suggestions],
+        "analysis": {
+            "summary": response.conversation_summary,
+            "primary_intent": response.primary_intent
+        }
+    })
+    history.flush()
+    print(f"\n💾 Suggestions appended to {directory}/")
 
 
 if __name__ == "__main__":
-    # Check if API key is set
-    if not os.getenv("XAI_API_KEY"):
+    # Check if API key is set (the local mock backend doesn't need one)
+    if os.getenv("XAI_BACKEND", "xai") == "xai" and not os.getenv("XAI_API_KEY"):
         print("Error: Please set your XAI_API_KEY environment variable")
         print("You can do this by running: export XAI_API_KEY='your-api-key-here'")
         exit(1)
     
+    # Open the connections while the rest of the script starts up
+    client_pool.warm_up(background=True)
+    
     # Run the structured demo
     try:
         demo_structured_conversations()
@@ -251,8 +467,11 @@ if __name__ == "__main__":
             {"sender": "Client", "message": "Great! Are you available tomorrow afternoon or Thursday morning?"}
         ]
         
-        response = generate_structured_reply_suggestions(example_conversation)
-        save_suggestions_to_file(response)
+        prompt_stats = {}
+        started = time.perf_counter()
+        response = generate_structured_reply_suggestions(example_conversation, prompt_stats=prompt_stats)
+        latency_ms = round(1000 * (time.perf_counter() - started), 1)
+        save_suggestions_to_history(example_conversation, response, prompt_stats=prompt_stats, latency_ms=latency_ms)
         
     except Exception as e:
         print(f"An error occurred: {e}") 
\ No newline at end of file
@@ -0,0 +1,491 @@
+# ASGI version of web_app.py: the same routes and JSON, served by any ASGI server
+#   pip install uvicorn
+#   uvicorn asgi_app:app --port 5000
+# Suggestion requests and long-polls are coroutines (async_engine.py), so one process holds thousands
+# of them open at once, and a client that disconnects cancels the work that was being done for it
+
+import os
+import re
+import json
+import time
+import asyncio
+from contextlib import aclosing, suppress
+from functools import lru_cache
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+import async_engine
+from admission import admission_client
+from http_cache import dumps
+from metrics import request_timings, server_timing_header
+from resilience import deadline_scope
+from suggestion_jobs import QueueFull
+from suggestion_options import SuggestionOptions
+from web_app import (DEFAULT_ROOM, EXAMPLES, MAX_ROOM_ID_LENGTH, REQUEST_TIMING_HEADER, SYNC_MAX_WAIT, admission, chat_sessions,
+                     client_address, conversation_store, deadline_seconds, fast_path, lookup_suggestions, metrics_registry,
+                     post_conversation, record_history, remember_suggestions, replay_events, request_seconds, response_cache,
+                     similar_cache, speculative_runs, sse_event, suggestion_cache, suggestion_cache_key, suggestion_jobs,
+                     upstream_breaker, upstream_retry)
+
+cancelled_requests = metrics_registry.counter(
+    "http_requests_cancelled_total", "Requests whose client disconnected before the response was sent, by route", ("route",))
+
+# Requests being handled right now, long-polls and streams included
+in_flight_requests = 0
+
+templates = Environment(
+    loader=FileSystemLoader(os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")),
+    autoescape=select_autoescape()
+)
+
+
+class Request:
+    """What the handlers need from an HTTP request: method, path, query, headers and the whole body."""
+
+    def __init__(self, scope: Dict, body: bytes):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        self.headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope.get("headers", [])}
+        self.client = (scope.get("client") or (None,))[0]
+        self.body = body
+        self.started = time.perf_counter()
+        self.rule: Optional[str] = None
+
+    def arg(self, name: str, type: Callable = str, default=None):
+        """A query parameter converted with type, or default if it is missing or doesn't convert (like Flask's request.args.get)."""
+        values = self.query.get(name)
+        if not values:
+            return default
+        try:
+            return type(values[0])
+        except (TypeError, ValueError):
+            return default
+
+    def header(self, name: str, default: str = "") -> str:
+        return self.headers.get(name.lower(), default)
+
+    def json(self) -> Optional[Dict]:
+        """The body parsed as a JSON object, or None."""
+        try:
+            data = json.loads(self.body) if self.body else None
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+
+
+class Response:
+    """A complete response body."""
+
+    def __init__(self, body: bytes = b"", status: int = 200, headers: Optional[Dict[str, str]] = None,
+                 content_type: str = "application/json"):
+        self.body = body
+        self.status = status
+        self.headers = {"Content-Type": content_type, **(headers or {})}
+
+
+class StreamingResponse:
+    """A response sent piece by piece as the iterator produces it, e.g. Server-Sent Events."""
+
+    def __init__(self, chunks: AsyncIterator[str], status: int = 200, headers: Optional[Dict[str, str]] = None,
+                 content_type: str = "text/event-stream; charset=utf-8"):
+        self.chunks = chunks
+        self.status = status
+        self.headers = {"Content-Type": content_type, **(headers or {})}
+
+
+def json_response(data, status: int = 200) -> Response:
+    return Response(dumps(data), status)
+
+
+def cached_json(request: Request, key, version, build, cache_control: str = "no-cache") -> Response:
+    """web_app.cached_json: the cached body for key at this version, or 304 when the client already has it."""
+    payload = response_cache.payload(key, version, build)
+    status, body, headers = response_cache.render(
+        payload,
+        request.header('If-None-Match'),
+        request.header('Accept-Encoding'),
+        cache_control
+    )
+    return Response(body, status, headers)
+
+
+# rule -> {method: handler}, in the order they were added; "<name>" in a rule matches one path segment
+ROUTES: Dict[str, Dict[str, Callable]] = {}
+_patterns: List[Tuple[re.Pattern, str]] = []
+
+
+def route(rule: str, methods: Tuple[str, ...] = ("GET",)):
+    """Register a handler, `async def handler(request, **path_params) -> Response`."""
+    def register(handler):
+        if rule not in ROUTES:
+            ROUTES[rule] = {}
+            _patterns.append((re.compile("^" + re.sub(r"<(\w+)>", r"(?P<\1>[^/]+)", rule) + "$"), rule))
+        for method in methods:
+            ROUTES[rule][method] = handler
+        return handler
+    return register
+
+
+def resolve(path: str) -> Tuple[Optional[str], Dict[str, str]]:
+    """The rule matching a path and its path parameters, or (None, {})."""
+    for pattern, rule in _patterns:
+        match = pattern.match(path)
+        if match:
+            return rule, match.groupdict()
+    return None, {}
+
+
+@route('/metrics')
+async def metrics(request: Request) -> Response:
+    """Expose counters and latency histograms in the Prometheus text format."""
+    return Response(metrics_registry.render().encode("utf-8"), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@lru_cache(maxsize=None)
+def render_page(is_friend_view: bool) -> bytes:
+    # The page only depends on the view, so it is rendered once
+    return templates.get_template('index.html').render(is_friend_view=is_friend_view).encode("utf-8")
+
+
+@route('/')
+async def index(request: Request) -> Response:
+    """Render the main page for the user."""
+    return Response(render_page(False), content_type='text/html; charset=utf-8')
+
+
+@route('/friend')
+async def friend_view(request: Request) -> Response:
+    """Render the friend's view for demo purposes."""
+    return Response(render_page(True), content_type='text/html; charset=utf-8')
+
+
+def request_deadline(request: Request, data: Dict) -> float:
+    """Time budget of a suggestion request: "deadline_ms" in the body or X-Request-Deadline-Ms, at most SUGGEST_DEADLINE."""
+    return deadline_seconds(data.get('deadline_ms') or request.header('X-Request-Deadline-Ms'))
+
+
+@route('/suggest', methods=('POST',))
+async def suggest(request: Request) -> Response:
+    """
+    API endpoint to get reply suggestions, as web_app's /suggest.
+
+    The model call is awaited, and cancelled if the client disconnects
+    and no identical request is waiting for it.
+    """
+    try:
+        data = request.json() or {}
+        conversation_history = data.get('conversation', [])
+        user_name = data.get('user_name', 'You')
+        conversation_id = data.get('conversation_id')
+        deadline = request_deadline(request, data)
+
+        if not conversation_history:
+            return json_response({
+                "success": False,
+                "error": "No conversation provided"
+            })
+
+        try:
+            options = SuggestionOptions.from_request(data)
+        except ValueError as e:
+            return json_response({
+                "success": False,
+                "error": str(e)
+            }, 400)
+
+        if data.get('regenerate') is not None:
+            index = data['regenerate']
+            if isinstance(index, bool) or not isinstance(index, int):
+                return json_response({
+                    "success": False,
+                    "error": "regenerate must be the index of a suggestion"
+                }, 400)
+            return json_response(await async_engine.regenerate_suggestion(
+                conversation_history, user_name, index, conversation_id, options, deadline))
+
+        # Job mode runs on web_app's worker threads, so its jobs outlive the request
+        if data.get('mode') == 'job':
+            try:
+                job_id = suggestion_jobs.submit(conversation_history, user_name, conversation_id, "job", deadline, options)
+            except QueueFull as e:
+                return json_response({
+                    "success": False,
+                    "error": str(e)
+                }, 503)
+            return json_response({
+                "success": True,
+                "job_id": job_id,
+                "status_url": f"/suggest/jobs/{job_id}"
+            }, 202)
+
+        return json_response(await async_engine.get_suggestions(
+            conversation_history, user_name, conversation_id, deadline=deadline, options=options))
+
+    except Exception as e:
+        return json_response({
+            "success": False,
+            "error": str(e)
+        })
+
+
+@route('/suggest/jobs/<job_id>')
+async def suggest_job(request: Request, job_id: str) -> Response:
+    """Return the status of a queued suggestion job, with its result once done."""
+    job = suggestion_jobs.get(job_id)
+    if job is None:
+        return json_response({
+            "success": False,
+            "error": "Unknown or expired job"
+        }, 404)
+    return json_response(job)
+
+
+@route('/suggest/jobs')
+async def suggest_jobs_stats(request: Request) -> Response:
+    """Return queue depth, worker utilization and average queue/model times."""
+    return json_response(suggestion_jobs.stats())
+
+
+@route('/suggest/stream', methods=('POST',))
+async def suggest_stream(request: Request) -> StreamingResponse:
+    """Streaming variant of /suggest that pushes each suggestion as a Server-Sent Event. Takes the same "count" and "tones"."""
+    data = request.json() or {}
+    conversation_history = data.get('conversation', [])
+    user_name = data.get('user_name', 'You')
+    conversation_id = data.get('conversation_id')
+    deadline = request_deadline(request, data)
+    started = request.started
+    try:
+        options = SuggestionOptions.from_request(data)
+        options_error = None
+    except ValueError as e:
+        options, options_error = None, str(e)
+
+    async def generate():
+        if not conversation_history or options_error:
+            yield sse_event("done", {
+                "success": False,
+                "error": options_error or "No conversation provided"
+            })
+            return
+
+        # Replay cached responses without touching the model
+        cache_key = suggestion_cache_key(conversation_history, user_name, options)
+        cached = lookup_suggestions(cache_key, conversation_history, user_name, options)
+        if cached is not None:
+            for event, payload in replay_events(cached):
+                yield sse_event(event, payload)
+            result = {**cached, "cached": True}
+            record_history("stream", conversation_history, user_name, conversation_id, cache_key, result, started)
+            yield sse_event("done", result)
+            return
+
+        async with aclosing(async_engine.stream_reply_suggestions(conversation_history, user_name, conversation_id, options)) as events:
+            async for event, payload in events:
+                if event == "done":
+                    remember_suggestions(cache_key, conversation_history, user_name, payload, options)
+                    payload = {**payload, "cached": False}
+                    record_history("stream", conversation_history, user_name, conversation_id, cache_key, payload, started)
+                yield sse_event(event, payload)
+
+    async def deadline_generate():
+        with deadline_scope(deadline):
+            async with aclosing(generate()) as events:
+                async for chunk in events:
+                    yield chunk
+
+    return StreamingResponse(deadline_generate(), headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@route('/cache_stats')
+async def cache_stats(request: Request) -> Response:
+    """Return the same counters as web_app's /cache_stats, with the coalescing and client pool of this server."""
+    return json_response({
+        **suggestion_cache.stats(),
+        "coalescing": async_engine.suggestion_flights.stats(),
+        "sessions": chat_sessions.stats(),
+        "speculative": speculative_runs.stats() if speculative_runs is not None else None,
+        "upstream": {**upstream_breaker.stats(), "retries": upstream_retry.retries},
+        "fast_path": fast_path.stats(),
+        "similar": similar_cache.stats() if similar_cache is not None else None,
+        "admission": admission.stats() if admission is not None else None,
+        "client_pool": async_engine.upstream_clients.stats(),
+        "responses": response_cache.stats(),
+        "in_flight_requests": in_flight_requests
+    })
+
+
+@route('/examples')
+async def examples(request: Request) -> Response:
+    """Return example conversations."""
+    return cached_json(request, "examples", 0, lambda: EXAMPLES, cache_control="public, max-age=300")
+
+
+@route('/sync_conversation', methods=('GET', 'POST'))
+async def sync_conversation(request: Request) -> Response:
+    """
+    Sync conversation between user and friend views, as web_app's /sync_conversation.
+
+    A long-poll waits on the event loop, so an idle room costs no thread.
+    """
+    data = (request.json() or {}) if request.method == 'POST' else {}
+    room = str(data.get('room') or request.arg('room') or DEFAULT_ROOM)
+    if len(room) > MAX_ROOM_ID_LENGTH:
+        return json_response({"success": False, "error": "Room id is too long"}, 400)
+
+    if request.method == 'POST':
+        body, status = post_conversation(room, data)
+        return json_response(body, status)
+
+    since = request.arg('since', int)
+    if since is None:
+        return cached_json(request, (room, None), conversation_store.version(room),
+                           lambda: {"room": room, **conversation_store.snapshot(room)})
+
+    wait = min(request.arg('wait', float, 0), SYNC_MAX_WAIT)
+    if wait > 0 and conversation_store.version(room) == since:
+        changes = await conversation_store.wait_for_changes_async(room, since, wait)
+        return cached_json(request, (room, since), changes["version"], lambda: {"room": room, **changes})
+    return cached_json(request, (room, since), conversation_store.version(room),
+                       lambda: {"room": room, **conversation_store.changes_since(room, since)})
+
+
+def collect_async_stats():
+    """Report in-flight requests, coalescing and the async client pool on /metrics."""
+    yield "http_requests_in_flight", "gauge", "Requests being handled, long-polls and streams included", in_flight_requests
+    flights = async_engine.suggestion_flights.stats()
+    yield "suggest_async_coalesced_requests_total", "counter", "Requests that shared an identical in-flight model call", flights["coalesced"]
+    yield "suggest_async_in_flight_calls", "gauge", "Distinct suggestion calls waiting on the model", flights["in_flight"]
+    yield "suggest_async_cancelled_calls_total", "counter", "Model calls cancelled because every client waiting for them disconnected", flights["cancelled"]
+    pool = async_engine.upstream_clients.stats()
+    yield "upstream_async_client_pool_in_use", "gauge", "Calls in flight on the pooled async clients", pool["in_use"]
+    yield "upstream_async_client_connects_total", "counter", "Async upstream clients created, including reconnects", pool["connects"]
+
+
+metrics_registry.add_collector(collect_async_stats)
+
+
+async def handle(request: Request, send):
+    """Run the request's handler and send its response."""
+    global in_flight_requests
+    in_flight_requests += 1
+    admission_client.set(client_address(request.header, request.client))
+    if REQUEST_TIMING_HEADER or request.header('X-Request-Timing') == '1':
+        request_timings.set({})
+    status = 500
+    try:
+        rule, params = resolve(request.path)
+        request.rule = rule or "unmatched"
+        handlers = ROUTES.get(rule, {})
+        if rule is None:
+            response = Response(b"Not Found", 404, content_type="text/plain; charset=utf-8")
+        elif request.method not in handlers:
+            response = Response(b"Method Not Allowed", 405, {"Allow": ", ".join(handlers)}, "text/plain; charset=utf-8")
+        else:
+            try:
+                response = await handlers[request.method](request, **params)
+            except Exception as e:
+                print(f"Error handling {request.method} {request.path}: {e}")
+                response = Response(b"Internal Server Error", 500, content_type="text/plain; charset=utf-8")
+        status = response.status
+
+        if isinstance(response, StreamingResponse):
+            await send({"type": "http.response.start", "status": response.status, "headers": encode_headers(response.headers)})
+            async with aclosing(response.chunks) as chunks:
+                async for chunk in chunks:
+                    await send({"type": "http.response.body", "body": chunk.encode("utf-8"), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        timings = request_timings.get()
+        if timings is not None:
+            response.headers['Server-Timing'] = server_timing_header({**timings, "total": time.perf_counter() - request.started})
+        response.headers['Content-Length'] = str(len(response.body))
+        await send({"type": "http.response.start", "status": response.status, "headers": encode_headers(response.headers)})
+        await send({"type": "http.response.body", "body": response.body})
+    finally:
+        in_flight_requests -= 1
+        request_seconds.observe(time.perf_counter() - request.started, route=request.rule or "unmatched",
+                                method=request.method, status=status)
+
+
+def encode_headers(headers: Dict[str, str]) -> List[Tuple[bytes, bytes]]:
+    return [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()]
+
+
+async def read_body(receive) -> Optional[bytes]:
+    """The whole request body, or None if the client disconnected while sending it."""
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            return b"".join(chunks)
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+_background_tasks = set()
+
+
+async def lifespan(receive, send):
+    """Open the upstream connections at startup (like web_app's warm-up) and close them at shutdown."""
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            if os.getenv("CLIENT_POOL_WARMUP", "1") == "1":
+                task = asyncio.ensure_future(async_engine.upstream_clients.warm_up())
+                _background_tasks.add(task)
+                task.add_done_callback(_background_tasks.discard)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await async_engine.upstream_clients.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope: Dict, receive, send):
+    """
+    The ASGI application.
+
+    The handler runs in its own task next to one watching for the client to
+    disconnect; if the client goes first, the handler is cancelled, which
+    cancels whatever it awaits: a queued admission slot, a model call nobody
+    else is waiting for, a stream or a long-poll.
+    """
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    body = await read_body(receive)
+    if body is None:
+        return
+    request = Request(scope, body)
+    handler = asyncio.ensure_future(handle(request, send))
+    disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({handler, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        # The server is shutting down
+        handler.cancel()
+        raise
+    finally:
+        disconnect.cancel()
+    if handler.done():
+        handler.result()
+        return
+
+    handler.cancel()
+    cancelled_requests.inc(route=request.rule or "unmatched")
+    with suppress(asyncio.CancelledError):
+        await handler
@@ -0,0 +1,269 @@
+# asyncio version of the suggestion pipeline in web_app.py, used by asgi_app.py
+# Caches, chat sessions, prompts, routing, admission control, the circuit breaker, metrics and the
+# history log are web_app's own objects; only what waits (a slot, the model, an identical call in
+# flight) is awaited here, so a request waiting on the model is a suspended task instead of a thread
+
+import asyncio
+import json
+import time
+from contextlib import aclosing, asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import web_app
+from admission import admission_client
+from backends import create_async_client
+from client_pool import AsyncClientPool
+from metrics import record_stage, timed
+from resilience import DeadlineExceeded, deadline_scope, remaining_time, resilient_call_async
+from single_flight import AsyncSingleFlight
+from stream_parser import IncrementalSuggestionParser
+from suggestion_options import SuggestionOptions
+from web_app import (MODEL, SUGGEST_DEADLINE, COALESCE_WAIT_TIMEOUT, build_regenerate_instruction, build_suggestion_prompts,
+                     chat_sessions, check_conversation, count_tokens, degraded_response, fallback_response, finish_suggestions,
+                     local_suggestions, lookup_suggestions, parse_failures, parse_seconds, prompt_build_seconds, record_history,
+                     regeneration_base, regeneration_failed, remember_suggestions, replace_suggestion, route_request,
+                     suggestion_cache_key, suggestion_session_key, upstream_breaker, upstream_retry, upstream_seconds,
+                     upstream_ttft_seconds)
+
+# xai_sdk.aio clients shared by every request. Each one multiplexes any number of concurrent
+# calls over its channel, so a handful serve thousands of requests
+upstream_clients = AsyncClientPool.from_env(create_async_client)
+
+# Identical requests in flight at the same time share one model call, which is cancelled
+# once every request waiting for it has gone away
+suggestion_flights = AsyncSingleFlight()
+
+
+@asynccontextmanager
+async def upstream_slot():
+    """Hold an admission slot for the block, after waiting for it in web_app's fair queue."""
+    if web_app.admission is None:
+        yield
+        return
+    started = time.perf_counter()
+    async with web_app.admission.admit_async(admission_client.get()):
+        record_stage(web_app.admission_wait_seconds, "queue", time.perf_counter() - started)
+        yield
+
+
+async def create_suggestion_chat(conversation_history: List[Dict[str, str]], user_name: str, session_key: str, client,
+                                 model: str = MODEL, options: Optional[SuggestionOptions] = None,
+                                 instruction: Optional[str] = None):
+    """web_app.create_suggestion_chat on an xai_sdk.aio client."""
+    system_prompt, default_instruction = build_suggestion_prompts(conversation_history, user_name, options)
+    instruction = instruction or default_instruction
+    return await chat_sessions.prepare_chat_async(client, model, session_key, system_prompt, conversation_history, instruction)
+
+
+async def sample_suggestions(conversation_history: List[Dict[str, str]], user_name: str, conversation_id: Optional[str],
+                             options: Optional[SuggestionOptions] = None, instruction: Optional[str] = None) -> Tuple[Dict, object, Dict, str, Dict]:
+    """
+    web_app.sample_suggestions, awaiting the model.
+
+    Retries and the circuit breaker work the same way. There is no hedged
+    backup call (HEDGE_*): every attempt is a single call.
+
+    Raises:
+        json.JSONDecodeError: if the output isn't valid JSON (the raw output is in its .doc)
+    """
+    async with upstream_slot(), upstream_clients.lease() as client:
+        with timed(prompt_build_seconds, "prompt"):
+            decision = route_request(conversation_history)
+            session_key = suggestion_session_key(conversation_history, user_name, conversation_id)
+            chat, prompt_info = await create_suggestion_chat(conversation_history, user_name, session_key, client,
+                                                             decision.model, options, instruction)
+        routing = decision.to_dict()
+
+        started = time.perf_counter()
+        response, attempts = await resilient_call_async(chat.sample, upstream_breaker, upstream_retry)
+    if attempts > 1:
+        routing["attempts"] = attempts
+    elapsed = time.perf_counter() - started
+    upstream_ttft_seconds.observe(elapsed)
+    record_stage(upstream_seconds, "upstream", elapsed)
+    count_tokens(response)
+
+    with timed(parse_seconds, "parse"):
+        result = json.loads(response.content)
+    return result, response, prompt_info, session_key, routing
+
+
+async def generate_reply_suggestions(conversation_history: List[Dict[str, str]], user_name: str = "You",
+                                     conversation_id: Optional[str] = None, options: Optional[SuggestionOptions] = None) -> Dict:
+    """web_app.generate_reply_suggestions as a coroutine."""
+    try:
+        error = check_conversation(conversation_history, user_name)
+        if error:
+            return error
+
+        local = local_suggestions(conversation_history, user_name, options)
+        if local is not None:
+            return local
+
+        result, response, prompt_info, session_key, routing = await sample_suggestions(
+            conversation_history, user_name, conversation_id, options)
+        return {
+            **finish_suggestions(result, response, prompt_info, session_key, len(conversation_history)),
+            "routing": routing
+        }
+
+    except json.JSONDecodeError as e:
+        print(f"JSON parsing error: {e}")
+        print(f"Raw response: {e.doc}")
+        parse_failures.inc()
+        return fallback_response()
+    except Exception as e:
+        degraded = degraded_response(e)
+        if degraded is not None:
+            return degraded
+        print(f"Error: {e}")
+        return {
+            "success": False,
+            "error": str(e)
+        }
+
+
+async def regenerate_suggestion(conversation_history: List[Dict[str, str]], user_name: str, index: int,
+                                conversation_id: Optional[str] = None, options: Optional[SuggestionOptions] = None,
+                                deadline: Optional[float] = None) -> Dict:
+    """web_app.regenerate_suggestion as a coroutine."""
+    with deadline_scope(deadline or SUGGEST_DEADLINE):
+        started = time.perf_counter()
+        cache_key = suggestion_cache_key(conversation_history, user_name, options)
+        cached = regeneration_base(cache_key, conversation_history, user_name, options)
+        if cached is None:
+            return await _get_suggestions(conversation_history, user_name, conversation_id, "regenerate", options)
+        data = cached["data"]
+        if not 0 <= index < len(data.get("suggestions", [])):
+            return {
+                "success": False,
+                "error": f"There is no suggestion {index} to regenerate"
+            }
+
+        try:
+            instruction = build_regenerate_instruction(conversation_history, user_name, data, index, options)
+            result, response, prompt_info, _, routing = await sample_suggestions(
+                conversation_history, user_name, conversation_id, options, instruction)
+            result = replace_suggestion(cache_key, cached, index, result, response, prompt_info, routing)
+        except Exception as e:
+            return regeneration_failed(cached, index, e)
+        record_history("regenerate", conversation_history, user_name, conversation_id, cache_key, result, started)
+        return result
+
+
+async def stream_reply_suggestions(conversation_history: List[Dict[str, str]], user_name: str = "You",
+                                   conversation_id: Optional[str] = None,
+                                   options: Optional[SuggestionOptions] = None) -> AsyncIterator[Tuple[str, Dict]]:
+    """
+    web_app.stream_reply_suggestions as an async generator.
+
+    Closing it early (the client went away) cancels the upstream stream.
+    """
+    error = check_conversation(conversation_history, user_name)
+    if error:
+        yield "done", error
+        return
+
+    local = local_suggestions(conversation_history, user_name, options)
+    if local is not None:
+        for suggestion in local["data"]["suggestions"]:
+            yield "suggestion", suggestion
+        yield "analysis", local["data"]["conversation_analysis"]
+        yield "done", local
+        return
+
+    content = ""
+    try:
+        parser = IncrementalSuggestionParser()
+        response = None
+        async with upstream_slot(), upstream_clients.lease() as client:
+            with timed(prompt_build_seconds, "prompt"):
+                decision = route_request(conversation_history)
+                session_key = suggestion_session_key(conversation_history, user_name, conversation_id)
+                chat, prompt_info = await create_suggestion_chat(conversation_history, user_name, session_key, client,
+                                                                 decision.model, options)
+
+            started = time.perf_counter()
+            # Tokens already reached the client, so a stream isn't retried; it still goes through the breaker
+            probe = upstream_breaker.before_call()
+            try:
+                async with aclosing(chat.stream()) as stream:
+                    async for response, chunk in stream:
+                        if parser.text == "" and chunk.content:
+                            upstream_ttft_seconds.observe(time.perf_counter() - started)
+                        for key, obj in parser.feed(chunk.content):
+                            yield ("suggestion" if key == "suggestions" else "analysis"), obj
+            except (asyncio.CancelledError, GeneratorExit):
+                upstream_breaker.cancel_call(probe)
+                raise
+            except Exception as e:
+                upstream_breaker.after_call(probe, e)
+                raise
+            upstream_breaker.after_call(probe)
+        record_stage(upstream_seconds, "upstream", time.perf_counter() - started)
+        count_tokens(response)
+
+        content = parser.text
+        with timed(parse_seconds, "parse"):
+            result = json.loads(content)
+        yield "done", {
+            **finish_suggestions(result, response, prompt_info, session_key, len(conversation_history)),
+            "routing": decision.to_dict()
+        }
+
+    except json.JSONDecodeError as e:
+        print(f"JSON parsing error: {e}")
+        print(f"Raw response: {content}")
+        parse_failures.inc()
+        yield "done", fallback_response()
+    except Exception as e:
+        degraded = degraded_response(e)
+        if degraded is not None:
+            yield "done", degraded
+            return
+        print(f"Error: {e}")
+        yield "done", {
+            "success": False,
+            "error": str(e)
+        }
+
+
+async def get_suggestions(conversation_history: List[Dict[str, str]], user_name: str = "You",
+                          conversation_id: Optional[str] = None, source: str = "suggest",
+                          deadline: Optional[float] = None, options: Optional[SuggestionOptions] = None) -> Dict:
+    """
+    web_app.get_suggestions as a coroutine.
+
+    Cancelling it (the client went away) leaves a shared model call running
+    for the identical requests still waiting on it, and cancels it otherwise.
+    """
+    with deadline_scope(deadline or SUGGEST_DEADLINE):
+        return await _get_suggestions(conversation_history, user_name, conversation_id, source, options)
+
+
+async def _get_suggestions(conversation_history: List[Dict[str, str]], user_name: str,
+                           conversation_id: Optional[str], source: str, options: Optional[SuggestionOptions] = None) -> Dict:
+    started = time.perf_counter()
+    cache_key = suggestion_cache_key(conversation_history, user_name, options)
+    if web_app.speculative_runs is not None:
+        web_app.speculative_runs.mark_used(cache_key)
+    cached = lookup_suggestions(cache_key, conversation_history, user_name, options)
+    if cached is not None:
+        result = {**cached, "cached": True}
+        record_history(source, conversation_history, user_name, conversation_id, cache_key, result, started)
+        return result
+
+    async def generate():
+        result = await generate_reply_suggestions(conversation_history, user_name, conversation_id, options)
+        remember_suggestions(cache_key, conversation_history, user_name, result, options)
+        return result
+
+    try:
+        wait_timeout = min(COALESCE_WAIT_TIMEOUT, max(remaining_time(), 0.0))
+        result, coalesced = await suggestion_flights.do(cache_key, generate, wait_timeout=wait_timeout)
+    except TimeoutError as e:
+        # Waited on an identical call until our own deadline ran out
+        result, coalesced = degraded_response(DeadlineExceeded(str(e))), True
+    result = {**result, "cached": False, "coalesced": coalesced}
+    record_history(source, conversation_history, user_name, conversation_id, cache_key, result, started)
+    return result
@@ -0,0 +1,134 @@
+# Pluggable model backends
+# XAI_BACKEND=xai (default) talks to the real API, XAI_BACKEND=mock runs a local stand-in (mock_backend.py)
+# Both are imported on first use, so importing this module stays cheap
+
+import os
+from functools import lru_cache
+
+from resilience import remaining_time
+
+
+def create_client():
+    """
+    Create the chat client selected by XAI_BACKEND.
+
+    Returns:
+        An xai_sdk Client, or a MockClient configured from the MOCK_* env vars
+    """
+    backend = os.getenv("XAI_BACKEND", "xai")
+    if backend == "mock":
+        from mock_backend import MockClient
+        return MockClient.from_env()
+    if backend != "xai":
+        raise ValueError(f"Unknown XAI_BACKEND '{backend}', expected 'xai' or 'mock'")
+
+    return _deadline_client_class()(api_key=os.getenv("XAI_API_KEY"))
+
+
+def create_async_client():
+    """
+    Create the asyncio chat client selected by XAI_BACKEND, for asgi_app.py.
+
+    Must be called on the event loop the client will be used from.
+
+    Returns:
+        An xai_sdk.aio Client, or a MockAsyncClient configured from the MOCK_* env vars
+    """
+    backend = os.getenv("XAI_BACKEND", "xai")
+    if backend == "mock":
+        from mock_backend import MockAsyncClient
+        return MockAsyncClient.from_env()
+    if backend != "xai":
+        raise ValueError(f"Unknown XAI_BACKEND '{backend}', expected 'xai' or 'mock'")
+
+    return _deadline_async_client_class()(api_key=os.getenv("XAI_API_KEY"))
+
+
+def _with_deadline(client_call_details):
+    # Lower the call's timeout to the time left until the request deadline
+    remaining = remaining_time()
+    if remaining is None:
+        return client_call_details
+    timeout = max(remaining, 0.001)
+    if client_call_details.timeout is not None:
+        timeout = min(timeout, client_call_details.timeout)
+    return client_call_details._replace(timeout=timeout)
+
+
+@lru_cache(maxsize=None)
+def _deadline_client_class():
+    """
+    xai_sdk.Client whose calls also stop at the current request deadline.
+
+    The SDK only has a per-client timeout, applied by an interceptor on
+    its channel. This subclass builds the same channel with one more
+    interceptor after that one, which lowers each call's timeout to the
+    time left until resilience.request_deadline.
+    """
+    import grpc
+    from xai_sdk import Client
+    from xai_sdk.client import create_channel_credentials
+    from xai_sdk.interceptors import AuthInterceptor, TimeoutInterceptor
+
+    class DeadlineInterceptor(grpc.UnaryUnaryClientInterceptor, grpc.UnaryStreamClientInterceptor):
+        def _intercept_call(self, continuation, client_call_details, request):
+            return continuation(_with_deadline(client_call_details), request)
+
+        def intercept_unary_unary(self, continuation, client_call_details, request):
+            return self._intercept_call(continuation, client_call_details, request)
+
+        def intercept_unary_stream(self, continuation, client_call_details, request):
+            return self._intercept_call(continuation, client_call_details, request)
+
+    class DeadlineClient(Client):
+        def _make_grpc_channel(self, api_key, api_host, metadata, channel_options, timeout, use_insecure_channel):
+            # Same as the SDK's, plus the deadline interceptor closest to the wire
+            interceptors = [TimeoutInterceptor(timeout), DeadlineInterceptor()]
+            if use_insecure_channel:
+                channel = grpc.insecure_channel(api_host, options=channel_options)
+                return grpc.intercept_channel(channel, AuthInterceptor(api_key, metadata), *interceptors)
+            credentials = create_channel_credentials(api_key, api_host, metadata)
+            channel = grpc.secure_channel(api_host, credentials, options=channel_options)
+            return grpc.intercept_channel(channel, *interceptors)
+
+    return DeadlineClient
+
+
+@lru_cache(maxsize=None)
+def _deadline_async_client_class():
+    """
+    xai_sdk.aio.Client whose calls also stop at the current request deadline.
+
+    Same as _deadline_client_class, with grpc.aio interceptors. The deadline
+    is read from the context of the task making the call.
+    """
+    import grpc
+    from xai_sdk.aio.client import Client
+    from xai_sdk.client import create_channel_credentials
+    from xai_sdk.interceptors import (UnaryStreamAuthAioInterceptor, UnaryStreamTimeoutAioInterceptor,
+                                      UnaryUnaryAuthAioInterceptor, UnaryUnaryTimeoutAioInterceptor)
+
+    class UnaryUnaryDeadlineInterceptor(grpc.aio.UnaryUnaryClientInterceptor):
+        async def intercept_unary_unary(self, continuation, client_call_details, request):
+            return await continuation(_with_deadline(client_call_details), request)
+
+    class UnaryStreamDeadlineInterceptor(grpc.aio.UnaryStreamClientInterceptor):
+        async def intercept_unary_stream(self, continuation, client_call_details, request):
+            return await continuation(_with_deadline(client_call_details), request)
+
+    class DeadlineAsyncClient(Client):
+        def _make_grpc_channel(self, api_key, api_host, metadata, channel_options, timeout, use_insecure_channel):
+            # Same as the SDK's, plus the deadline interceptors after its timeout ones
+            interceptors = [
+                UnaryUnaryTimeoutAioInterceptor(timeout),
+                UnaryStreamTimeoutAioInterceptor(timeout),
+                UnaryUnaryDeadlineInterceptor(),
+                UnaryStreamDeadlineInterceptor()
+            ]
+            if use_insecure_channel:
+                interceptors += [UnaryUnaryAuthAioInterceptor(api_key, metadata), UnaryStreamAuthAioInterceptor(api_key, metadata)]
+                return grpc.aio.insecure_channel(api_host, options=channel_options, interceptors=interceptors)
+            credentials = create_channel_credentials(api_key, api_host, metadata)
+            return grpc.aio.secure_channel(api_host, credentials, options=channel_options, interceptors=interceptors)
+
+    return DeadlineAsyncClient
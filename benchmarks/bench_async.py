@@ -0,0 +1,226 @@
+# In-flight capacity of asgi_app.py: N concurrent /suggest requests waiting on a slow mock model,
+# with the memory each one holds, and what happens to them when their clients disconnect
+# python benchmarks/bench_async.py --requests 100,1000,5000 --latency-ms 3000 --compare-threads --output async_results.jsonl
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import threading
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def rss_bytes() -> int:
+    """Resident memory of this process."""
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def request_body(i: int, run: str) -> bytes:
+    # Every request is a different conversation, so none is answered from the cache or coalesced
+    return json.dumps({
+        "conversation": [
+            {"sender": "You", "message": "Are we still on for the project review?"},
+            {"sender": "Sam", "message": f"Yes, but can we move it to {i % 12 + 1}pm? ({run} #{i})"}
+        ],
+        "user_name": "You",
+        "deadline_ms": 600000
+    }).encode("utf-8")
+
+
+class Client:
+    """One HTTP request driven straight through the ASGI interface, with no sockets in between."""
+
+    def __init__(self, method: str, path: str, body: bytes = b""):
+        self.scope = {
+            "type": "http", "method": method, "path": path, "query_string": b"",
+            "headers": [(b"content-type", b"application/json")]
+        }
+        self.body = body
+        self.sent_body = False
+        self.disconnected = asyncio.Event()
+        self.status: Optional[int] = None
+        self.chunks: List[bytes] = []
+
+    async def receive(self) -> Dict:
+        if not self.sent_body:
+            self.sent_body = True
+            return {"type": "http.request", "body": self.body, "more_body": False}
+        await self.disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(self, message: Dict):
+        if message["type"] == "http.response.start":
+            self.status = message["status"]
+        elif message["type"] == "http.response.body":
+            self.chunks.append(message.get("body", b""))
+
+    def json(self) -> Dict:
+        return json.loads(b"".join(self.chunks))
+
+
+async def wait_until(condition, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+async def bench_async(asgi_app, n: int, latency: float, run: str) -> Dict:
+    """N concurrent distinct /suggest requests; memory is measured once all of them wait on the model."""
+    baseline = rss_bytes()
+    clients = [Client("POST", "/suggest", request_body(i, run)) for i in range(n)]
+    started = time.perf_counter()
+    tasks = [asyncio.ensure_future(asgi_app.app(c.scope, c.receive, c.send)) for c in clients]
+    flights = asgi_app.async_engine.suggestion_flights
+    all_waiting = await wait_until(lambda: flights.in_flight() >= n, timeout=max(latency, 1.0))
+    peak = rss_bytes()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    ok = sum(1 for c in clients if c.status == 200 and c.json().get("success"))
+    return {
+        "mode": "asyncio",
+        "requests": n,
+        "all_in_flight": all_waiting,
+        "succeeded": ok,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(n / elapsed, 1),
+        "rss_mb": round(peak / 2**20, 1),
+        "kb_per_request": round((peak - baseline) / n / 1024, 1)
+    }
+
+
+async def bench_cancel(asgi_app, n: int, latency: float, run: str) -> Dict:
+    """N requests whose clients all disconnect halfway through the model call."""
+    flights = asgi_app.async_engine.suggestion_flights
+    cancelled_before = flights.stats()["cancelled"]
+    clients = [Client("POST", "/suggest", request_body(i, run)) for i in range(n)]
+    tasks = [asyncio.ensure_future(asgi_app.app(c.scope, c.receive, c.send)) for c in clients]
+    await wait_until(lambda: flights.in_flight() >= n, timeout=max(latency, 1.0))
+    await asyncio.sleep(latency / 2)
+
+    started = time.perf_counter()
+    for c in clients:
+        c.disconnected.set()
+    await asyncio.gather(*tasks)
+    drained = await wait_until(lambda: flights.in_flight() == 0, timeout=latency)
+    return {
+        "mode": "disconnect",
+        "requests": n,
+        "responses_sent": sum(1 for c in clients if c.status is not None),
+        "model_calls_cancelled": flights.stats()["cancelled"] - cancelled_before,
+        "drained": drained,
+        "ms_to_drain": round(1000 * (time.perf_counter() - started), 1)
+    }
+
+
+def bench_threads(web_app, n: int, latency: float, run: str) -> Dict:
+    """The same load on web_app.py with one thread per request, as the Flask server runs it."""
+    baseline = rss_bytes()
+    results = []
+    ready = threading.Barrier(n + 1)
+
+    def worker(i):
+        client = web_app.app.test_client()
+        ready.wait()
+        response = client.post("/suggest", data=request_body(i, run), content_type="application/json")
+        results.append(response.status_code == 200 and response.get_json().get("success"))
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(n)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    ready.wait()
+    time.sleep(min(latency / 2, 1.0))
+    peak = rss_bytes()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    return {
+        "mode": "threads",
+        "requests": n,
+        "succeeded": sum(1 for ok in results if ok),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(n / elapsed, 1),
+        "rss_mb": round(peak / 2**20, 1),
+        "kb_per_request": round((peak - baseline) / n / 1024, 1)
+    }
+
+
+def print_result(result: Dict):
+    if result["mode"] == "disconnect":
+        print(f"{'disconnect':>10} {result['requests']:>6}  responses sent {result['responses_sent']}, "
+              f"model calls cancelled {result['model_calls_cancelled']}, drained in {result['ms_to_drain']}ms")
+        return
+    print(f"{result['mode']:>10} {result['requests']:>6}  ok {result['succeeded']:>6}  {result['seconds']:>7.2f}s  "
+          f"{result['requests_per_second']:>8.1f} req/s  rss {result['rss_mb']:>7.1f}MB  {result['kb_per_request']:>7.1f}KB/request")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent in-flight suggestion requests on the ASGI app")
+    parser.add_argument("--requests", default="100,1000,5000", help="Comma-separated numbers of concurrent requests")
+    parser.add_argument("--latency-ms", type=float, default=3000.0, help="Mock model latency; long enough for every request to be in flight at once")
+    parser.add_argument("--cancel", type=int, default=1000, help="Requests for the disconnect check (0 to skip)")
+    parser.add_argument("--compare-threads", action="store_true", help="Also run web_app.py with a thread per request (up to --max-threads)")
+    parser.add_argument("--max-threads", type=int, default=1000)
+    parser.add_argument("--output", help="Append the results as JSON lines to this file")
+    args = parser.parse_args()
+
+    # Every request reaches the model: no admission queue, no near-duplicate answers, no history log
+    os.environ.update({
+        "XAI_BACKEND": "mock",
+        "MOCK_LATENCY_MS": str(args.latency_ms),
+        "MOCK_LATENCY_JITTER_MS": "0",
+        "MOCK_LATENCY_DISTRIBUTION": "fixed",
+        "ADMISSION_CONTROL": "0",
+        "SIMILAR_CACHE": "0",
+        "SUGGESTION_HISTORY_DIR": "",
+        "CLIENT_POOL_WARMUP": "0"
+    })
+    import asgi_app
+    import web_app
+
+    latency = args.latency_ms / 1000
+    counts = [int(n) for n in args.requests.split(",") if n.strip()]
+    results = []
+    loop = asyncio.new_event_loop()
+    try:
+        # The first request pays for the lazy imports and the client connections
+        loop.run_until_complete(bench_async(asgi_app, 1, latency, "warm-up"))
+        for i, n in enumerate(counts):
+            results.append(loop.run_until_complete(bench_async(asgi_app, n, latency, f"async-{i}")))
+            print_result(results[-1])
+        if args.cancel:
+            results.append(loop.run_until_complete(bench_cancel(asgi_app, args.cancel, latency, "cancel")))
+            print_result(results[-1])
+    finally:
+        loop.close()
+
+    if args.compare_threads:
+        bench_threads(web_app, 1, latency, "threads-warm-up")
+        for i, n in enumerate(counts):
+            if n > args.max_threads:
+                print(f"{'threads':>10} {n:>6}  skipped (over --max-threads)")
+                continue
+            results.append(bench_threads(web_app, n, latency, f"threads-{i}"))
+            print_result(results[-1])
+
+    if args.output:
+        with open(args.output, "a") as f:
+            for result in results:
+                f.write(json.dumps({"latency_ms": args.latency_ms, **result}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,530 @@
+# Load test: N simulated user/friend pairs against a real web_app.py server backed by the mock model
+# python benchmarks/bench_load.py --pairs 1,5,10,25,50 --duration 20 --servers dev,gunicorn,uvicorn --output load_results.jsonl
+
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.client
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ("hey thanks sure meeting tomorrow project status deadline weekend coffee update dinner "
+         "movie trip plan budget review slides office train late early call later idea").split()
+
+
+def percentiles(samples: List[float]) -> Dict:
+    """Summarize a list of durations (seconds) as milliseconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(p):
+        return round(1000 * ordered[min(len(ordered) - 1, int(p * len(ordered)))], 1)
+
+    return {
+        "count": len(ordered),
+        "mean": round(1000 * sum(ordered) / len(ordered), 1),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(1000 * ordered[-1], 1)
+    }
+
+
+class Recorder:
+    """Latencies and errors per route, shared by every simulated client of one step."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples: Dict[str, List[float]] = {}
+        self._errors: Dict[str, int] = {}
+
+    def record(self, route: str, seconds: float, ok: bool):
+        with self._lock:
+            self._samples.setdefault(route, []).append(seconds)
+            self._errors[route] = self._errors.get(route, 0) + (not ok)
+
+    def summary(self, elapsed: float) -> Dict:
+        with self._lock:
+            routes = {}
+            for route, samples in sorted(self._samples.items()):
+                errors = self._errors[route]
+                routes[route] = {
+                    **percentiles(samples),
+                    "throughput": round(len(samples) / elapsed, 2),
+                    "errors": errors,
+                    "error_rate": round(errors / len(samples), 4)
+                }
+            requests = sum(len(samples) for samples in self._samples.values())
+            return {
+                "requests": requests,
+                "throughput": round(requests / elapsed, 1),
+                "errors": sum(self._errors.values()),
+                "routes": routes
+            }
+
+
+class HttpClient:
+    """One keep-alive connection for one simulated browser tab, reopened when the server closes it."""
+
+    def __init__(self, port: int, recorder: Recorder, timeout: float):
+        self.port = port
+        self.recorder = recorder
+        self.timeout = timeout
+        self._conn: Optional[http.client.HTTPConnection] = None
+
+    def request(self, route: str, method: str, path: str, body: Optional[Dict] = None,
+                headers: Optional[Dict[str, str]] = None,
+                check: Callable[[int, bytes], bool] = lambda status, data: status < 400,
+                record: bool = True) -> Tuple[int, bytes, Dict[str, str]]:
+        """Send one request and record its latency under route; returns (status, body, headers), status 0 on failure."""
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        request_headers = {"Accept-Encoding": "gzip"}
+        if data is not None:
+            request_headers["Content-Type"] = "application/json"
+        request_headers.update(headers or {})
+
+        started = time.perf_counter()
+        try:
+            if self._conn is None:
+                self._conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=self.timeout)
+            self._conn.request(method, path, body=data, headers=request_headers)
+            response = self._conn.getresponse()
+            payload = response.read()
+            response_headers = {k.lower(): v for k, v in response.getheaders()}
+            if response.will_close:
+                self.close()
+            if response_headers.get("content-encoding") == "gzip":
+                payload = gzip.decompress(payload)
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.close()
+            status, payload, response_headers = 0, b"", {}
+        if record:
+            self.recorder.record(route, time.perf_counter() - started, status != 0 and check(status, payload))
+        return status, payload, response_headers
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def json_success(status: int, data: bytes) -> bool:
+    try:
+        return status == 200 and json.loads(data).get("success", False)
+    except ValueError:
+        return False
+
+
+def stream_success(status: int, data: bytes) -> bool:
+    # The last event of /suggest/stream is "done" with the same document /suggest returns
+    if status != 200:
+        return False
+    text = data.decode("utf-8", "replace")
+    marker = text.rfind("event: done\ndata: ")
+    if marker < 0:
+        return False
+    try:
+        return json.loads(text[marker + len("event: done\ndata: "):].split("\n", 1)[0]).get("success", False)
+    except ValueError:
+        return False
+
+
+class Pair:
+    """
+    One user and one friend in their own room, doing what templates/index.html does.
+
+    Both views watch the room (long-polling /sync_conversation, or polling
+    it every poll_interval with If-None-Match), the friend posts a message,
+    the user asks for suggestions and posts one of them back, with think
+    time in between.
+    """
+
+    def __init__(self, index: int, room: str, port: int, recorder: Recorder, args):
+        self.index = index
+        self.room = room
+        self.port = port
+        self.recorder = recorder
+        self.args = args
+        self.user = f"user{index}"
+        self.friend = f"friend{index}"
+        self.random = random.Random(f"{room}")
+        self.conversation: List[Dict[str, str]] = []
+        self.threads: List[threading.Thread] = []
+
+    def start(self, stop: threading.Event):
+        for target in (self._watch, self._watch, self._talk):
+            thread = threading.Thread(target=target, args=(stop,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def wake(self):
+        """Post a last message so the long-polls in flight return right away."""
+        client = HttpClient(self.port, self.recorder, timeout=10)
+        client.request("", "POST", "/sync_conversation", {"room": self.room, "append": [{"sender": self.friend, "message": "bye"}]},
+                       record=False)
+        client.close()
+
+    def _message(self) -> str:
+        words = " ".join(self.random.choice(WORDS) for _ in range(self.random.randint(5, 20)))
+        return words.capitalize() + self.random.choice(("?", ".", "!"))
+
+    def _think(self, stop: threading.Event):
+        stop.wait(self.random.uniform(0.5, 1.5) * self.args.think_ms / 1000)
+
+    def _watch(self, stop: threading.Event):
+        client = HttpClient(self.port, self.recorder, timeout=self.args.poll_wait + 30)
+        version, etag = 0, None
+        while not stop.is_set():
+            if self.args.sync == "longpoll":
+                query = urlencode({"room": self.room, "since": version, "wait": self.args.poll_wait})
+                status, body, _ = client.request("GET /sync_conversation (long-poll)", "GET", f"/sync_conversation?{query}")
+                if status == 200:
+                    version = json.loads(body)["version"]
+                elif not stop.wait(1.0):
+                    continue
+            else:
+                # The older 2-second polling of the whole conversation, revalidated with the ETag
+                status, _, headers = client.request(
+                    "GET /sync_conversation (poll)", "GET", f"/sync_conversation?{urlencode({'room': self.room})}",
+                    headers={"If-None-Match": etag} if etag else None,
+                    check=lambda status, data: status in (200, 304))
+                etag = headers.get("etag", etag)
+                stop.wait(self.args.poll_interval)
+        client.close()
+
+    def _talk(self, stop: threading.Event):
+        client = HttpClient(self.port, self.recorder, timeout=60)
+        # Start at different times, like real users
+        stop.wait(self.random.uniform(0, self.args.think_ms / 1000))
+        while not stop.is_set():
+            message = {"sender": self.friend, "message": self._message()}
+            client.request("POST /sync_conversation", "POST", "/sync_conversation", {"room": self.room, "append": [message]},
+                           check=json_success)
+            self.conversation.append(message)
+            self._think(stop)
+            if stop.is_set():
+                break
+
+            body = {"conversation": self.conversation[-self.args.max_turns:], "user_name": self.user, "conversation_id": self.room}
+            if self.args.suggest == "stream":
+                status, data, _ = client.request("POST /suggest/stream", "POST", "/suggest/stream", body, check=stream_success)
+                reply = None
+            else:
+                status, data, _ = client.request("POST /suggest", "POST", "/suggest", body, check=json_success)
+                reply = None
+                if status == 200:
+                    suggestions = (json.loads(data).get("data") or {}).get("suggestions") or []
+                    reply = suggestions[0]["reply"] if suggestions else None
+            self._think(stop)
+            if stop.is_set():
+                break
+
+            message = {"sender": self.user, "message": reply or self._message()}
+            client.request("POST /sync_conversation", "POST", "/sync_conversation", {"room": self.room, "append": [message]},
+                           check=json_success)
+            self.conversation.append(message)
+            self._think(stop)
+        client.close()
+
+
+class ResourceSampler:
+    """CPU and resident memory of a process and its children (e.g. gunicorn workers), read from /proc."""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.available = os.path.exists(f"/proc/{pid}/stat")
+        self._ticks = os.sysconf("SC_CLK_TCK") if self.available else 100
+        self._stop = threading.Event()
+        self._rss: List[float] = []
+        self._processes = 0
+        self._thread: Optional[threading.Thread] = None
+        self._started = 0.0
+        self._cpu_start = 0.0
+
+    def start(self):
+        if not self.available:
+            return
+        self._started = time.perf_counter()
+        self._cpu_start = self._sample()[0]
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Dict:
+        if not self.available:
+            return {"cpu_percent": None, "rss_mb_peak": None, "rss_mb_end": None, "processes": None}
+        self._stop.set()
+        self._thread.join()
+        cpu, rss, processes = self._sample()
+        elapsed = time.perf_counter() - self._started
+        peak = max(self._rss + [rss])
+        return {
+            # 100% is one core fully busy
+            "cpu_percent": round(100 * (cpu - self._cpu_start) / elapsed, 1),
+            "rss_mb_peak": round(peak, 1),
+            "rss_mb_end": round(rss, 1),
+            "processes": processes
+        }
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._rss.append(self._sample()[1])
+
+    def _tree(self) -> List[int]:
+        children: Dict[int, List[int]] = {}
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+        tree, pending = [], [self.pid]
+        while pending:
+            pid = pending.pop()
+            tree.append(pid)
+            pending.extend(children.get(pid, []))
+        return tree
+
+    def _sample(self) -> Tuple[float, float, int]:
+        # CPU seconds (exited children included through cutime/cstime) and RSS in MB
+        cpu, rss, processes = 0.0, 0.0, 0
+        for pid in self._tree():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                with open(f"/proc/{pid}/status") as f:
+                    vm_rss = next((line for line in f if line.startswith("VmRSS:")), "VmRSS: 0 kB")
+            except OSError:
+                continue
+            cpu += sum(int(fields[i]) for i in (11, 12, 13, 14)) / self._ticks
+            rss += int(vm_rss.split()[1]) / 1024
+            processes += 1
+        return cpu, rss, processes
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_command(name: str, port: int, args, workdir: str) -> Optional[Tuple[List[str], Dict[str, str]]]:
+    """Command line and extra environment of a server configuration, or None if it isn't installed."""
+    if name == "dev":
+        # What `python web_app.py` runs (debug mode, a thread per request), without the reloader process
+        code = f"import web_app; web_app.app.run(host='127.0.0.1', port={port}, debug=True, use_reloader=False, threaded=True)"
+        return [sys.executable, "-c", code], {}
+    if name == "gunicorn":
+        if shutil.which("gunicorn") is None:
+            return None
+        # Threaded workers for the long-polls; rooms go through SQLite so every worker sees them
+        return (
+            ["gunicorn", "-w", str(args.workers), "-k", "gthread", "--threads", str(args.threads),
+             "-b", f"127.0.0.1:{port}", "--timeout", "120", "web_app:app"],
+            {"CONVERSATION_STORE": "sqlite", "CONVERSATION_DB": os.path.join(workdir, "conversations.db")}
+        )
+    if name == "uvicorn":
+        if shutil.which("uvicorn") is None:
+            return None
+        # asgi_app.py: one process, every request a coroutine
+        return ["uvicorn", "asgi_app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"], {}
+    raise ValueError(f"Unknown server '{name}', expected 'dev', 'gunicorn' or 'uvicorn'")
+
+
+class ServerProcess:
+    """A web_app server in its own process group, stopped with everything it started."""
+
+    def __init__(self, name: str, argv: List[str], env: Dict[str, str], port: int):
+        self.name = name
+        self.argv = argv
+        self.env = env
+        self.port = port
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self, timeout: float = 30.0):
+        self.process = subprocess.Popen(self.argv, cwd=ROOT, env=self.env, stdout=subprocess.DEVNULL,
+                                        stderr=subprocess.DEVNULL, start_new_session=True)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.name} server exited with status {self.process.returncode}")
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=1)
+                conn.request("GET", "/examples")
+                ready = conn.getresponse().status == 200
+                conn.close()
+                if ready:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        raise RuntimeError(f"{self.name} server didn't come up within {timeout}s")
+
+    def stop(self):
+        if self.process is None or self.process.poll() is not None:
+            return
+        os.killpg(self.process.pid, signal.SIGTERM)
+        try:
+            self.process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+
+
+def run_step(server: ServerProcess, pairs: int, run_id: str, args) -> Dict:
+    """Run `pairs` pairs against the server for args.duration seconds."""
+    recorder = Recorder()
+    stop = threading.Event()
+    group = [Pair(i, f"load-{run_id}-{pairs}-{i}", server.port, recorder, args) for i in range(pairs)]
+    sampler = ResourceSampler(server.process.pid)
+
+    sampler.start()
+    started = time.perf_counter()
+    for pair in group:
+        pair.start(stop)
+    time.sleep(args.duration)
+    stop.set()
+    elapsed = time.perf_counter() - started
+    resources = sampler.stop()
+    summary = recorder.summary(elapsed)
+
+    for pair in group:
+        pair.wake()
+    for pair in group:
+        for thread in pair.threads:
+            thread.join(timeout=5)
+    return {"server": server.name, "pairs": pairs, "elapsed_s": round(elapsed, 2), **summary, "resources": resources}
+
+
+def saturation(steps: List[Dict], slo_ms: float, suggest_route: str) -> Optional[Dict]:
+    """
+    First step past the saturation point: suggestion p95 over the SLO, more than 1% errors,
+    or throughput growing by less than a tenth of the added load.
+    """
+    for previous, step in zip(steps, steps[1:]):
+        suggest = step["routes"].get(suggest_route, {})
+        load_growth = step["pairs"] / previous["pairs"] - 1
+        throughput_growth = step["throughput"] / previous["throughput"] - 1 if previous["throughput"] else 0.0
+        reason = None
+        if suggest.get("p95", 0) > slo_ms:
+            reason = f"{suggest_route} p95 {suggest['p95']}ms over the {slo_ms:.0f}ms SLO"
+        elif step["requests"] and step["errors"] / step["requests"] > 0.01:
+            reason = f"{100 * step['errors'] / step['requests']:.1f}% errors"
+        elif throughput_growth < 0.1 * load_growth:
+            reason = f"throughput +{100 * throughput_growth:.0f}% for +{100 * load_growth:.0f}% pairs"
+        if reason:
+            return {"last_good_pairs": previous["pairs"], "pairs": step["pairs"], "reason": reason}
+    return None
+
+
+def print_step(step: Dict):
+    res = step["resources"]
+    cpu = f"{res['cpu_percent']}%" if res["cpu_percent"] is not None else "n/a"
+    rss = f"{res['rss_mb_peak']}MB" if res["rss_mb_peak"] is not None else "n/a"
+    print(f"\n[{step['server']}] {step['pairs']} pairs: {step['throughput']} req/s, {step['errors']} errors, "
+          f"server CPU {cpu}, peak RSS {rss}")
+    print(f"  {'route':<40}{'count':>7}{'req/s':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'err%':>7}   (ms)")
+    for route, stats in step["routes"].items():
+        print(f"  {route:<40}{stats['count']:>7}{stats['throughput']:>8}{stats['p50']:>9}{stats['p95']:>9}"
+              f"{stats['p99']:>9}{100 * stats['error_rate']:>7.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find how many user/friend pairs a web_app.py server can take")
+    parser.add_argument("--pairs", default="1,5,10,25,50", help="Comma-separated pair counts, run in order (default: 1,5,10,25,50)")
+    parser.add_argument("--duration", type=float, default=20, help="Seconds per step (default: 20)")
+    parser.add_argument("--servers", default="dev,gunicorn", help="Server configurations: dev, gunicorn, uvicorn (default: dev and gunicorn, if installed)")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn worker processes (default: 4)")
+    parser.add_argument("--threads", type=int, default=32, help="Threads per gunicorn worker (default: 32)")
+    parser.add_argument("--latency-ms", type=float, default=800, help="Mock model latency (default: 800)")
+    parser.add_argument("--jitter-ms", type=float, default=200, help="Mock model latency spread (default: 200)")
+    parser.add_argument("--think-ms", type=float, default=1000, help="Mean pause between a pair's actions (default: 1000)")
+    parser.add_argument("--suggest", choices=("stream", "json"), default="stream", help="POST /suggest/stream like the page, or POST /suggest")
+    parser.add_argument("--sync", choices=("longpoll", "poll"), default="longpoll", help="Long-poll like the page, or poll every --poll-interval")
+    parser.add_argument("--poll-wait", type=float, default=25, help="Long-poll wait in seconds (default: 25, as the page)")
+    parser.add_argument("--poll-interval", type=float, default=2, help="Seconds between polls with --sync poll (default: 2)")
+    parser.add_argument("--max-turns", type=int, default=20, help="Most messages sent with a suggestion request (default: 20)")
+    parser.add_argument("--slo-ms", type=float, default=3000, help="Suggestion p95 that counts as saturated (default: 3000)")
+    parser.add_argument("--output", help="Append the results as one JSON line to this file")
+    args = parser.parse_args()
+
+    pair_counts = [int(n) for n in args.pairs.split(",") if n.strip()]
+    suggest_route = "POST /suggest/stream" if args.suggest == "stream" else "POST /suggest"
+    run_id = str(int(time.time()))
+    workdir = tempfile.mkdtemp(prefix="bench_load_")
+    env = dict(
+        os.environ,
+        PYTHONPATH=ROOT,
+        XAI_BACKEND="mock",
+        MOCK_LATENCY_MS=str(args.latency_ms),
+        MOCK_LATENCY_JITTER_MS=str(args.jitter_ms),
+        SUGGESTION_HISTORY_DIR=""
+    )
+
+    results = {}
+    try:
+        for name in [s.strip() for s in args.servers.split(",") if s.strip()]:
+            port = free_port()
+            command = server_command(name, port, args, workdir)
+            if command is None:
+                print(f"\n[{name}] not installed, skipped (pip install {name})")
+                continue
+            argv, extra_env = command
+            server = ServerProcess(name, argv, {**env, **extra_env}, port)
+            server.start()
+            steps = []
+            try:
+                for pairs in pair_counts:
+                    step = run_step(server, pairs, run_id, args)
+                    print_step(step)
+                    steps.append(step)
+            finally:
+                server.stop()
+            saturated = saturation(steps, args.slo_ms, suggest_route)
+            results[name] = {"steps": steps, "saturation": saturated}
+            if saturated:
+                print(f"\n[{name}] saturates between {saturated['last_good_pairs']} and {saturated['pairs']} pairs: {saturated['reason']}")
+            else:
+                print(f"\n[{name}] no saturation up to {pair_counts[-1]} pairs")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if len(results) > 1:
+        print(f"\n{'pairs':>6}" + "".join(f"{name + ' req/s':>18}{name + ' p95':>16}" for name in results))
+        for i, pairs in enumerate(pair_counts):
+            row = f"{pairs:>6}"
+            for result in results.values():
+                step = result["steps"][i]
+                row += f"{step['throughput']:>18}{step['routes'].get(suggest_route, {}).get('p95', '-'):>16}"
+            print(row)
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps({
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "config": vars(args),
+                "results": results
+            }) + "\n")
+        print(f"\nResults appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
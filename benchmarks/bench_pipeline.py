@@ -0,0 +1,223 @@
+# Micro-benchmarks for the suggestion pipeline, run against the local mock backend
+# python benchmarks/bench_pipeline.py --iterations 500 --concurrency 16 --duration 20
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from typing import List, Dict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentiles(samples: List[float]) -> Dict:
+    """Summarize a list of durations (seconds) as milliseconds."""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(p):
+        return round(1000 * ordered[min(len(ordered) - 1, int(p * len(ordered)))], 3)
+
+    return {
+        "count": len(ordered),
+        "mean": round(1000 * sum(ordered) / len(ordered), 3),
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": round(1000 * ordered[-1], 3)
+    }
+
+
+def make_conversation(turns: int, seed: int) -> List[Dict[str, str]]:
+    """Build a synthetic conversation ending with a message from the other party."""
+    rng = random.Random(seed)
+    words = "hey thanks sure order meeting tomorrow project status deadline weekend coffee refund update".split()
+    conversation = []
+    for i in range(turns):
+        sender = "Friend" if (turns - i) % 2 == 1 else "You"
+        message = " ".join(rng.choice(words) for _ in range(rng.randint(4, 30)))
+        conversation.append({"sender": sender, "message": f"{message} #{seed}"})
+    return conversation
+
+
+def bench_stages(iterations: int, min_turns: int, max_turns: int) -> Dict:
+    """Time every stage of one suggestion request separately."""
+    import web_app
+    from app_structured import ReplyResponses
+
+    stages = {name: [] for name in ("prompt_build", "model_call", "json_loads", "validate", "serialize", "total")}
+    failures = 0
+
+    for i in range(iterations):
+        conversation = make_conversation(random.randint(min_turns, max_turns), seed=i)
+        start = time.perf_counter()
+
+        session_key = web_app.suggestion_session_key(conversation, "You", f"bench-{i}")
+        # The chat is bound to a pooled client, which stays leased for the call
+        with web_app.client_pool.lease() as client:
+            chat, prompt_info = web_app.create_suggestion_chat(conversation, "You", session_key, client)
+            built = time.perf_counter()
+
+            try:
+                response = chat.sample()
+            except Exception:
+                failures += 1
+                continue
+            sampled = time.perf_counter()
+
+        try:
+            data = json.loads(response.content)
+        except json.JSONDecodeError:
+            failures += 1
+            continue
+        parsed = time.perf_counter()
+
+        try:
+            ReplyResponses(**data)
+        except ValueError:
+            failures += 1
+        validated = time.perf_counter()
+
+        with web_app.app.app_context():
+            web_app.jsonify({"success": True, "data": data, "prompt": prompt_info}).get_data()
+        serialized = time.perf_counter()
+
+        stages["prompt_build"].append(built - start)
+        stages["model_call"].append(sampled - built)
+        stages["json_loads"].append(parsed - sampled)
+        stages["validate"].append(validated - parsed)
+        stages["serialize"].append(serialized - validated)
+        stages["total"].append(serialized - start)
+
+    return {"stages": {name: percentiles(samples) for name, samples in stages.items()}, "failures": failures}
+
+
+def bench_end_to_end(concurrency: int, duration: float, window: float, min_turns: int, max_turns: int) -> Dict:
+    """Drive POST /suggest from several threads and report throughput and latency per time window."""
+    import web_app
+
+    client = web_app.app.test_client()
+    started = time.perf_counter()
+    deadline = started + duration
+    results = []  # (finished_at, latency, ok)
+    lock = threading.Lock()
+    counter = iter(range(10 ** 9))
+
+    def worker():
+        while time.perf_counter() < deadline:
+            with lock:
+                n = next(counter)
+            # Unique conversations so the response cache doesn't hide the model call
+            conversation = make_conversation(random.randint(min_turns, max_turns), seed=10 ** 6 + n)
+            t0 = time.perf_counter()
+            response = client.post('/suggest', json={"conversation": conversation, "user_name": "You"})
+            t1 = time.perf_counter()
+            ok = response.status_code == 200 and response.json.get("success", False)
+            with lock:
+                results.append((t1 - started, t1 - t0, ok))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    windows = []
+    for w in range(int(elapsed // window) + 1):
+        in_window = [r for r in results if w * window <= r[0] < (w + 1) * window]
+        if not in_window:
+            continue
+        latency = percentiles([r[1] for r in in_window])
+        windows.append({
+            "t": round(w * window, 1),
+            "throughput": round(len(in_window) / window, 1),
+            "p50": latency["p50"],
+            "p99": latency["p99"],
+            "errors": sum(1 for r in in_window if not r[2])
+        })
+
+    return {
+        "concurrency": concurrency,
+        "elapsed_s": round(elapsed, 2),
+        "requests": len(results),
+        "throughput": round(len(results) / elapsed, 1) if elapsed else 0.0,
+        "errors": sum(1 for r in results if not r[2]),
+        "latency": percentiles([r[1] for r in results]),
+        "windows": windows
+    }
+
+
+def print_stages(result: Dict):
+    print(f"\n{'stage':<14}{'count':>8}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}   (ms)")
+    for name, stats in result["stages"].items():
+        if not stats["count"]:
+            continue
+        print(f"{name:<14}{stats['count']:>8}{stats['mean']:>10}{stats['p50']:>10}{stats['p90']:>10}{stats['p99']:>10}{stats['max']:>10}")
+    print(f"failures: {result['failures']}")
+
+
+def print_end_to_end(result: Dict):
+    latency = result["latency"]
+    print(f"\nPOST /suggest x{result['concurrency']}: {result['requests']} requests in {result['elapsed_s']}s, "
+          f"{result['throughput']} req/s, {result['errors']} errors")
+    print(f"latency ms: p50 {latency.get('p50')}  p90 {latency.get('p90')}  p99 {latency.get('p99')}  max {latency.get('max')}")
+    print(f"\n{'t (s)':>8}{'req/s':>10}{'p50':>10}{'p99':>10}{'errors':>8}")
+    for w in result["windows"]:
+        print(f"{w['t']:>8}{w['throughput']:>10}{w['p50']:>10}{w['p99']:>10}{w['errors']:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the suggestion pipeline against the mock backend")
+    parser.add_argument("--iterations", type=int, default=300, help="Requests for the per-stage benchmark")
+    parser.add_argument("--concurrency", type=int, default=8, help="Threads for the end-to-end benchmark (0 to skip)")
+    parser.add_argument("--duration", type=float, default=10.0, help="Seconds to run the end-to-end benchmark")
+    parser.add_argument("--window", type=float, default=1.0, help="Seconds per time window in the report")
+    parser.add_argument("--min-turns", type=int, default=3)
+    parser.add_argument("--max-turns", type=int, default=40)
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Mock mean model latency")
+    parser.add_argument("--jitter-ms", type=float, default=20.0, help="Mock latency spread")
+    parser.add_argument("--distribution", default="lognormal", choices=["fixed", "uniform", "normal", "lognormal"])
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of mock calls that fail")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="Fraction of mock calls returning bad JSON")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Append the results as one JSON line to this file")
+    args = parser.parse_args()
+
+    # The mock backend is configured through the environment before the app is imported
+    os.environ.update({
+        "XAI_BACKEND": "mock",
+        "MOCK_LATENCY_MS": str(args.latency_ms),
+        "MOCK_LATENCY_JITTER_MS": str(args.jitter_ms),
+        "MOCK_LATENCY_DISTRIBUTION": args.distribution,
+        "MOCK_ERROR_RATE": str(args.error_rate),
+        "MOCK_MALFORMED_RATE": str(args.malformed_rate),
+        "MOCK_SEED": str(args.seed)
+    })
+    random.seed(args.seed)
+
+    stages = bench_stages(args.iterations, args.min_turns, args.max_turns)
+    print_stages(stages)
+
+    end_to_end = None
+    if args.concurrency > 0:
+        end_to_end = bench_end_to_end(args.concurrency, args.duration, args.window, args.min_turns, args.max_turns)
+        print_end_to_end(end_to_end)
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps({
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "config": vars(args),
+                "stages": stages,
+                "end_to_end": end_to_end
+            }) + "\n")
+        print(f"\nResults appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
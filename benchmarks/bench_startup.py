@@ -0,0 +1,102 @@
+# Startup cost of the command-line scripts: import time and time to first output
+# python benchmarks/bench_startup.py --runs 20 --output startup_results.jsonl
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from typing import List, Dict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that are expensive to import and should only load when a suggestion is generated
+HEAVY_MODULES = ["grpc", "xai_sdk", "pydantic"]
+
+# (name, argv, extra environment); each is timed from process start to its first line of output
+# (or to exit if it prints nothing)
+SCENARIOS = [
+    ("python (baseline)", ["-c", "pass"], {}),
+    ("import app", ["-c", "import app"], {}),
+    ("import app_structured", ["-c", "import app_structured"], {}),
+    ("app.py --help", ["app.py", "--help"], {}),
+    ("app.py, missing XAI_API_KEY", ["app.py"], {"XAI_BACKEND": "xai", "XAI_API_KEY": ""}),
+    ("app.py demo, first output", ["app.py"], {"XAI_BACKEND": "mock"}),
+    ("app_structured.py demo, first output", ["app_structured.py"], {"XAI_BACKEND": "mock"}),
+]
+
+
+def percentiles(samples: List[float]) -> Dict:
+    """Summarize a list of durations (seconds) as milliseconds."""
+    ordered = sorted(samples)
+
+    def pick(p):
+        return round(1000 * ordered[min(len(ordered) - 1, int(p * len(ordered)))], 1)
+
+    return {
+        "count": len(ordered),
+        "mean": round(1000 * sum(ordered) / len(ordered), 1),
+        "p50": pick(0.50),
+        "p90": pick(0.90),
+        "min": round(1000 * ordered[0], 1)
+    }
+
+
+def time_to_first_output(argv: List[str], env: Dict[str, str]) -> float:
+    """Seconds from spawning the interpreter to its first line on stdout."""
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, *argv], cwd=ROOT, env=env, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    proc.stdout.readline()
+    elapsed = time.perf_counter() - started
+    proc.kill()
+    proc.wait()
+    return elapsed
+
+
+def loaded_heavy_modules(module: str, env: Dict[str, str]) -> List[str]:
+    """Which of HEAVY_MODULES importing the module pulls in."""
+    code = f"import sys, json, {module}; print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return json.loads(out.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup cost of app.py and app_structured.py")
+    parser.add_argument("--runs", type=int, default=10, help="Runs per scenario")
+    parser.add_argument("--output", help="Append the results as one JSON line to this file")
+    args = parser.parse_args()
+
+    # Demos run against an instant mock, so the first output is all startup; nothing is written to disk
+    base_env = dict(os.environ, PYTHONPATH=ROOT, MOCK_LATENCY_MS="0", MOCK_LATENCY_JITTER_MS="0",
+                    SUGGESTION_HISTORY_DIR=os.devnull, CLIENT_POOL_SIZE="1")
+
+    results = {}
+    for name, argv, extra in SCENARIOS:
+        env = dict(base_env, **extra)
+        time_to_first_output(argv, env)  # warm the OS file cache and __pycache__
+        samples = [time_to_first_output(argv, env) for _ in range(args.runs)]
+        results[name] = percentiles(samples)
+        stats = results[name]
+        print(f"{name:<40}p50 {stats['p50']:7.1f}ms  p90 {stats['p90']:7.1f}ms  min {stats['min']:7.1f}ms")
+
+    heavy = {module: loaded_heavy_modules(module, base_env) for module in ("app", "app_structured")}
+    print()
+    for module, loaded in heavy.items():
+        print(f"import {module} loads: {', '.join(loaded) or 'none of ' + ', '.join(HEAVY_MODULES)}")
+
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps({
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "config": vars(args),
+                "python": sys.version.split()[0],
+                "startup": results,
+                "heavy_imports": heavy
+            }) + "\n")
+        print(f"\nResults appended to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
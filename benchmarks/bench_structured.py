@@ -0,0 +1,111 @@
+# Before/after timings for the structured-output hot path in app_structured.py
+# python benchmarks/bench_structured.py --iterations 5000
+
+import os
+import sys
+import json
+import time
+import argparse
+from typing import List, Callable
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("XAI_BACKEND", "mock")
+
+from xai_sdk import Client
+from mock_backend import MockClient
+from app_structured import ReplyResponses, SYSTEM_PROMPT, build_system_prompt, response_options
+from structured_models import reply_responses_model
+
+
+def legacy_system_prompt() -> str:
+    """What every call used to do: regenerate the schema and pretty-print it into the prompt."""
+    schema = ReplyResponses.model_json_schema()
+    return f"""You are a helpful AI assistant that analyzes message conversations and suggests appropriate replies.
+
+You must analyze the conversation and provide exactly 3 reply suggestions with metadata.
+
+Your response must be a valid JSON object that matches this schema:
+{json.dumps(schema, indent=2)}
+
+Guidelines for suggestions:
+1. Each suggestion should have a different tone and approach
+2. Consider the full conversation context
+3. Provide confidence scores based on how well the suggestion fits
+4. Include brief context notes explaining why each suggestion is appropriate
+5. Summarize the conversation and identify the primary intent
+
+IMPORTANT: Respond ONLY with a valid JSON object. No additional text."""
+
+
+def legacy_parse(content: str) -> ReplyResponses:
+    result_data = json.loads(content)
+    return ReplyResponses(**result_data)
+
+
+def compiled_parse(content: str) -> ReplyResponses:
+    return ReplyResponses.model_validate_json(content)
+
+
+def time_calls(fn: Callable, inputs: List, iterations: int) -> List[float]:
+    samples = []
+    for i in range(iterations):
+        value = inputs[i % len(inputs)]
+        start = time.perf_counter()
+        fn(value)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def summarize(samples: List[float]) -> str:
+    ordered = sorted(samples)
+    mean = sum(ordered) / len(ordered)
+    p50 = ordered[len(ordered) // 2]
+    p99 = ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))]
+    return f"mean {1e6 * mean:8.1f}us  p50 {1e6 * p50:8.1f}us  p99 {1e6 * p99:8.1f}us"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the old and new structured-output hot path")
+    parser.add_argument("--iterations", type=int, default=5000)
+    args = parser.parse_args()
+
+    # Realistic model outputs from the mock backend, without its latency
+    mock = MockClient(latency_ms=0, latency_jitter_ms=0, distribution="fixed", seed=1)
+    contents = []
+    for i in range(50):
+        chat = mock.chat.create(model="mock", messages=[
+            SYSTEM_PROMPT, f"Conversation history:\n\nFriend{i}: hello\n", "Generate 3 reply suggestions with metadata."
+        ])
+        contents.append(chat.sample().content)
+
+    # A real xai_sdk client: creating a chat builds the request locally, nothing is sent
+    client = Client(api_key="benchmark")
+    response_model = reply_responses_model()
+
+    def legacy_create(_):
+        # The pydantic class as response format: xai_sdk renders and serializes its schema per chat
+        client.chat.create(model="grok-4", messages=[], response_format=response_model)
+
+    def compiled_create(_):
+        client.chat.create(model="grok-4", messages=[], **response_options(response_model))
+
+    rows = [
+        ("system prompt (before: schema + indent=2 per call)", time_calls(lambda _: legacy_system_prompt(), [None], args.iterations)),
+        ("system prompt (after: compiled once, lookup)", time_calls(lambda _: SYSTEM_PROMPT, [None], args.iterations)),
+        ("chat.create (before: pydantic response_format)", time_calls(legacy_create, [None], args.iterations)),
+        ("chat.create (after: prebuilt ResponseFormat)", time_calls(compiled_create, [None], args.iterations)),
+        ("parse (before: json.loads + ReplyResponses(**d))", time_calls(legacy_parse, contents, args.iterations)),
+        ("parse (after: model_validate_json)", time_calls(compiled_parse, contents, args.iterations)),
+    ]
+
+    print(f"{args.iterations} iterations\n")
+    for name, samples in rows:
+        print(f"{name:<52}{summarize(samples)}")
+
+    print(f"\nprompt size: before {len(legacy_system_prompt())} chars, "
+          f"after {len(SYSTEM_PROMPT)} chars (native schema), "
+          f"{len(build_system_prompt(embed_schema=True))} chars (compact schema in prompt)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,440 @@
+# Persistent chat sessions keyed by conversation id
+# Keeps the prompt prefix byte-stable and only appends the new turns
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, List, Dict, Optional, Tuple, Callable
+
+
+def system(content: str):
+    """xai_sdk system message. The SDK takes over half a second to import, so it is loaded on first use."""
+    from xai_sdk.chat import system as make_system
+    return make_system(content)
+
+
+def user(content: str):
+    """xai_sdk user message, imported on first use like system()."""
+    from xai_sdk.chat import user as make_user
+    return make_user(content)
+
+
+SUMMARY_PROMPT = """You maintain a running summary of a message conversation.
+
+You will get the current summary (possibly empty) and the messages that came after it.
+Return an updated summary that covers both. Keep who said what, names, dates, numbers,
+commitments and open questions. Stay under 200 words.
+
+Respond with ONLY the updated summary text."""
+
+
+def make_session_key(conversation_history: List[Dict[str, str]], *parts: str) -> str:
+    """
+    Derive a conversation id when the caller doesn't have one.
+
+    A thread only ever grows at the end, so its first message plus the
+    extra parts (e.g. the user name) identifies it across requests.
+    """
+    first = conversation_history[0] if conversation_history else {}
+    payload = json.dumps([list(parts), first.get('sender'), first.get('message')], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+def format_turns(turns: List[Tuple[str, str]]) -> str:
+    """Render (sender, message) pairs one per line."""
+    return "".join(f"{sender}: {message}\n" for sender, message in turns)
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate (roughly 4 characters per token)."""
+    return len(text) // 4 + 1 if text else 0
+
+
+def summarize_turns(client, model: str, previous_summary: str, turns: List[Tuple[str, str]]) -> str:
+    """
+    Fold new turns into an existing summary with one model call.
+
+    Only the turns that aren't covered yet are sent, so the cost of keeping
+    the summary current doesn't grow with the length of the thread.
+    """
+    chat = client.chat.create(
+        model=model,
+        messages=[
+            system(SUMMARY_PROMPT),
+            user(f"Current summary:\n{previous_summary or '(none)'}\n\nNew messages:\n{format_turns(turns)}")
+        ]
+    )
+    return chat.sample().content.strip()
+
+
+async def summarize_turns_async(client, model: str, previous_summary: str, turns: List[Tuple[str, str]]) -> str:
+    """summarize_turns with an xai_sdk.aio client."""
+    chat = client.chat.create(
+        model=model,
+        messages=[
+            system(SUMMARY_PROMPT),
+            user(f"Current summary:\n{previous_summary or '(none)'}\n\nNew messages:\n{format_turns(turns)}")
+        ]
+    )
+    return (await chat.sample()).content.strip()
+
+
+class _PendingFold:
+    """A fold waiting on the summarizer: the turns to summarize and the session state it was started from."""
+
+    __slots__ = ("fold_to", "summary_turns", "previous_summary", "new_turns")
+
+    def __init__(self, fold_to: int, summary_turns: int, previous_summary: str, new_turns: List[Tuple[str, str]]):
+        self.fold_to = fold_to
+        self.summary_turns = summary_turns
+        self.previous_summary = previous_summary
+        self.new_turns = new_turns
+
+
+class ChatSession:
+    """The stable message prefix sent for one conversation."""
+
+    def __init__(self, system_prompt: str):
+        self.system_prompt = system_prompt
+        self.messages = [system(system_prompt)]
+        self.turns: List[Tuple[str, str]] = []
+        self.prefix_chars = len(system_prompt)
+        # Rolling summary of turns[:summary_turns]; the rest is sent verbatim
+        self.summary = ""
+        self.summary_turns = 0
+        # Latest summary the model produced itself, and how many turns it covers
+        self.seed_summary = ""
+        self.seed_turns = 0
+        # A request is waiting on the summarizer for this session
+        self.folding = False
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+
+class ChatSessionManager:
+    """
+    Reuse the prompt prefix of a conversation across suggestion requests.
+
+    Each session holds the system prompt followed by one user message per
+    batch of turns it has seen. When a request comes in for the same
+    conversation, only the turns after the ones already in the session are
+    appended as a new message, so everything before them is byte-identical
+    to the previous request and upstream prompt caching can hit. The
+    per-request instruction is added after the prefix and never stored.
+    Sessions idle for longer than idle_ttl are evicted, as are the least
+    recently used ones beyond max_sessions.
+
+    With a max_prompt_tokens budget, once the prompt would exceed it every
+    turn but the last recent_turns is folded into a rolling summary. The
+    summary is updated incrementally: either the model already summarized
+    the conversation in its last answer (see record_summary), or only the
+    newly folded turns are sent to the summarizer. Folding rebuilds the
+    prefix, so it only happens once at least fold_batch turns can be folded
+    at a time.
+    """
+
+    def __init__(
+        self,
+        idle_ttl: float = 900.0,
+        max_sessions: int = 1000,
+        max_prompt_tokens: Optional[int] = None,
+        recent_turns: int = 20,
+        fold_batch: int = 10,
+        summarizer: Callable[..., str] = summarize_turns,
+        summary_model: Optional[str] = None,
+        async_summarizer: Callable[..., Awaitable[str]] = summarize_turns_async
+    ):
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.max_prompt_tokens = max_prompt_tokens
+        self.recent_turns = recent_turns
+        self.fold_batch = fold_batch
+        self.summarizer = summarizer
+        self.async_summarizer = async_summarizer
+        self.summary_model = summary_model
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.rebuilt = 0
+        self.evicted = 0
+        self.turns_reused = 0
+        self.turns_appended = 0
+        self.folds = 0
+        self.seeded_folds = 0
+        self.summary_failures = 0
+        self.unshared = 0
+
+    def prepare_chat(
+        self,
+        client,
+        model: str,
+        session_key: str,
+        system_prompt: str,
+        conversation_history: List[Dict[str, str]],
+        instruction: str,
+        history_header: str = "Here is the conversation history:\n\n",
+        **chat_options
+    ) -> Tuple[object, Dict]:
+        """
+        Build a chat for the current request on top of the session prefix.
+
+        Args:
+            client: xAI client used to create the chat
+            model: Model name
+            session_key: Conversation id the session is stored under
+            system_prompt: System prompt, must be stable for the conversation
+            conversation_history: Full list of messages with 'sender' and 'message' keys
+            instruction: Per-request instruction appended after the history
+            history_header: Text put in front of the first batch of turns
+            **chat_options: Extra arguments for client.chat.create, e.g. response_format
+
+        Returns:
+            (chat, prompt_info) where chat is ready for sample() or stream()
+            and prompt_info describes what is being sent
+
+        The prompt only ever holds this request's turns. If a concurrent
+        request for the same conversation already added later (or
+        different) turns to the session, this one gets a prompt of its own
+        instead of the shared prefix. When older turns have to be
+        summarized first, the summary call runs without holding the
+        session lock.
+        """
+        turns = [(msg['sender'], msg['message']) for msg in conversation_history]
+        session = self._get_session(session_key, system_prompt, turns)
+
+        with session.lock:
+            shared, pending = self._add_request(session, turns, instruction, history_header)
+
+        # The summary is a model call of its own; other requests for the conversation don't wait for it
+        if pending is not None:
+            summary = None
+            try:
+                summary = self.summarizer(client, self.summary_model or model, pending.previous_summary, pending.new_turns)
+            except Exception as e:
+                self._summary_failed(e)
+            finally:
+                with session.lock:
+                    self._finish_fold(session, pending, summary, history_header)
+
+        with session.lock:
+            messages, prompt_info = self._prompt(session, turns, shared, instruction, history_header)
+
+        chat = client.chat.create(
+            model=model,
+            conversation_id=session_key,
+            messages=messages + [user(instruction)],
+            **chat_options
+        )
+        return chat, prompt_info
+
+    async def prepare_chat_async(
+        self,
+        client,
+        model: str,
+        session_key: str,
+        system_prompt: str,
+        conversation_history: List[Dict[str, str]],
+        instruction: str,
+        history_header: str = "Here is the conversation history:\n\n",
+        **chat_options
+    ) -> Tuple[object, Dict]:
+        """
+        prepare_chat for an xai_sdk.aio client, awaiting the summary call.
+        """
+        turns = [(msg['sender'], msg['message']) for msg in conversation_history]
+        session = self._get_session(session_key, system_prompt, turns)
+
+        with session.lock:
+            shared, pending = self._add_request(session, turns, instruction, history_header)
+
+        if pending is not None:
+            summary = None
+            try:
+                summary = await self.async_summarizer(client, self.summary_model or model, pending.previous_summary,
+                                                      pending.new_turns)
+            except Exception as e:
+                self._summary_failed(e)
+            finally:
+                # Also when cancelled, so that a later request can fold instead
+                with session.lock:
+                    self._finish_fold(session, pending, summary, history_header)
+
+        with session.lock:
+            messages, prompt_info = self._prompt(session, turns, shared, instruction, history_header)
+
+        chat = client.chat.create(
+            model=model,
+            conversation_id=session_key,
+            messages=messages + [user(instruction)],
+            **chat_options
+        )
+        return chat, prompt_info
+
+    def record_summary(self, session_key: str, summary: str, turns_covered: int):
+        """
+        Remember a summary the model returned for the first turns_covered turns.
+
+        The next fold can use it instead of asking for a new one.
+        """
+        with self._lock:
+            session = self._sessions.get(session_key)
+        if session is None or not summary:
+            return
+        with session.lock:
+            if turns_covered <= len(session.turns) and turns_covered >= session.seed_turns:
+                session.seed_summary = summary
+                session.seed_turns = turns_covered
+
+    def drop(self, session_key: str):
+        """Forget a session, e.g. when its conversation is cleared."""
+        with self._lock:
+            self._sessions.pop(session_key, None)
+
+    def stats(self) -> Dict:
+        """Return session counts, how many turns were reused vs appended and how often history was folded."""
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "created": self.created,
+                "rebuilt": self.rebuilt,
+                "evicted": self.evicted,
+                "turns_reused": self.turns_reused,
+                "turns_appended": self.turns_appended,
+                "folds": self.folds,
+                "seeded_folds": self.seeded_folds,
+                "summary_failures": self.summary_failures,
+                "unshared": self.unshared
+            }
+
+    def _get_session(self, session_key: str, system_prompt: str, turns: List[Tuple[str, str]]) -> ChatSession:
+        with self._lock:
+            self._evict_idle()
+            session = self._sessions.get(session_key)
+
+            if session is None:
+                session = ChatSession(system_prompt)
+                self._sessions[session_key] = session
+                self.created += 1
+            elif session.system_prompt != system_prompt or turns[:len(session.turns)] != session.turns:
+                # History was edited or the prompt changed, the prefix is no good
+                session = ChatSession(system_prompt)
+                self._sessions[session_key] = session
+                self.rebuilt += 1
+
+            session.last_used = time.monotonic()
+            self._sessions.move_to_end(session_key)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+            return session
+
+    def _over_budget(self, session: ChatSession, instruction: str) -> bool:
+        if not self.max_prompt_tokens:
+            return False
+        verbatim = len(session.turns) - session.summary_turns
+        estimated = (session.prefix_chars + len(instruction)) // 4
+        return estimated > self.max_prompt_tokens and verbatim >= self.recent_turns + self.fold_batch
+
+    def _add_request(self, session: ChatSession, turns: List[Tuple[str, str]], instruction: str,
+                     history_header: str) -> Tuple[bool, Optional["_PendingFold"]]:
+        # Caller must hold session.lock. Returns whether the request shares the session prefix,
+        # and the fold it has to ask the summarizer for, if any
+        if turns[:len(session.turns)] != session.turns:
+            # Another request got here first with later or different turns; the session keeps them
+            with self._lock:
+                self.unshared += 1
+            return False, None
+        self._add_turns(session, turns, history_header)
+        if session.folding or not self._over_budget(session, instruction):
+            return True, None
+
+        fold_to = len(session.turns) - self.recent_turns
+        if session.seed_turns >= fold_to and session.seed_summary:
+            # The model already summarized at least this much in its last answer
+            self._apply_fold(session, fold_to, session.seed_summary, True, history_header)
+            return True, None
+        session.folding = True
+        return True, _PendingFold(fold_to, session.summary_turns, session.summary,
+                                  session.turns[session.summary_turns:fold_to])
+
+    def _finish_fold(self, session: ChatSession, pending: "_PendingFold", summary: Optional[str], history_header: str):
+        # Caller must hold session.lock. summary is None when the summarizer failed
+        session.folding = False
+        if summary is not None and session.summary_turns == pending.summary_turns:
+            self._apply_fold(session, pending.fold_to, summary, False, history_header)
+
+    def _add_turns(self, session: ChatSession, turns: List[Tuple[str, str]], history_header: str):
+        # Caller must hold session.lock
+        new_turns = turns[len(session.turns):]
+        if new_turns:
+            header = history_header if len(session.messages) == 1 else ""
+            block = header + format_turns(new_turns)
+            session.messages.append(user(block))
+            session.prefix_chars += len(block)
+            session.turns.extend(new_turns)
+
+        with self._lock:
+            self.turns_reused += len(turns) - len(new_turns)
+            self.turns_appended += len(new_turns)
+
+    def _prompt(self, session: ChatSession, turns: List[Tuple[str, str]], shared: bool, instruction: str,
+                history_header: str) -> Tuple[List, Dict]:
+        # Caller must hold session.lock
+        if shared and len(session.turns) == len(turns):
+            messages = list(session.messages)
+            prefix_chars = session.prefix_chars
+            summary, summary_turns = session.summary, session.summary_turns
+        else:
+            # The session moved past this request's turns (or never had them): send exactly these
+            # turns, behind the session's summary if it still covers a prefix of them
+            summary, summary_turns = session.summary, session.summary_turns
+            if not summary or summary_turns > len(turns) or turns[:summary_turns] != session.turns[:summary_turns]:
+                summary, summary_turns = "", 0
+            recent_block = history_header + format_turns(turns[summary_turns:])
+            messages = [system(session.system_prompt)]
+            prefix_chars = len(session.system_prompt) + len(recent_block)
+            if summary:
+                summary_block = f"Summary of the earlier conversation:\n{summary}\n"
+                messages.append(user(summary_block))
+                prefix_chars += len(summary_block)
+            messages.append(user(recent_block))
+
+        prompt_info = {
+            "estimated_tokens": estimate_tokens(instruction) + prefix_chars // 4 + 1,
+            "verbatim_turns": len(turns) - summary_turns,
+            "summarized_turns": summary_turns,
+            "summary_tokens": estimate_tokens(summary),
+            "budget_tokens": self.max_prompt_tokens
+        }
+        return messages, prompt_info
+
+    def _apply_fold(self, session: ChatSession, fold_to: int, summary: str, seeded: bool, history_header: str):
+        # Caller must hold session.lock
+        summary_block = f"Summary of the earlier conversation:\n{summary}\n"
+        recent_block = history_header + format_turns(session.turns[fold_to:])
+        session.summary = summary
+        session.summary_turns = fold_to
+        session.messages = [system(session.system_prompt), user(summary_block), user(recent_block)]
+        session.prefix_chars = len(session.system_prompt) + len(summary_block) + len(recent_block)
+
+        with self._lock:
+            self.folds += 1
+            if seeded:
+                self.seeded_folds += 1
+
+    def _summary_failed(self, error: Exception):
+        print(f"Error summarizing conversation: {error}")
+        with self._lock:
+            self.summary_failures += 1
+
+    def _evict_idle(self):
+        # Caller must hold the lock; sessions are kept in last-used order
+        cutoff = time.monotonic() - self.idle_ttl
+        while self._sessions:
+            key, session = next(iter(self._sessions.items()))
+            if session.last_used > cutoff:
+                break
+            del self._sessions[key]
+            self.evicted += 1
@@ -0,0 +1,311 @@
+# Pool of upstream clients shared by all request threads
+# Connections are opened up front, spread across requests and checked again after sitting idle
+
+import os
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Dict, List, Optional
+
+from resilience import rpc_status
+
+
+class _Slot:
+    def __init__(self, index: int):
+        self.index = index
+        self.client = None
+        self.in_use = 0
+        self.last_used = 0.0
+        self.suspect = False
+        self.lock = threading.Lock()
+
+
+def _channel_of(client):
+    # The xai_sdk client keeps its API channel here; the mock backend has none
+    return getattr(client, "_api_channel", None)
+
+
+class ClientPool:
+    """
+    A fixed set of clients, each with its own gRPC channel, shared by every thread.
+
+    gRPC channels are thread-safe and multiplex concurrent calls, so a lease
+    doesn't take a client away from other threads: lease() hands out the
+    client with the fewest calls in flight. Spreading calls over several
+    channels keeps one HTTP/2 connection from becoming the bottleneck, and
+    every connection is reused for the life of the process.
+
+    warm_up() creates the clients and opens their connections (TCP + TLS)
+    ahead of the first request. A client that sat idle for longer than
+    idle_check, or whose last call failed with UNAVAILABLE, is checked
+    before its next use and replaced if its connection is gone.
+
+    Args:
+        factory: Creates one client (backends.create_client)
+        size: Number of clients
+        idle_check: Idle seconds after which a connection is checked before use
+        health_timeout: How long a connection check may take
+    """
+
+    def __init__(self, factory: Callable[[], object], size: int = 4, idle_check: float = 60.0, health_timeout: float = 2.0):
+        self.factory = factory
+        self.size = max(1, size)
+        self.idle_check = idle_check
+        self.health_timeout = health_timeout
+        self._slots: List[_Slot] = [_Slot(i) for i in range(self.size)]
+        self._lock = threading.Lock()
+        self._next = 0
+        self._created = time.monotonic()
+        self._busy_seconds = 0.0
+        self.leases = 0
+        self.max_in_use = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.health_checks = 0
+        self.health_failures = 0
+        self.warmup_seconds: Optional[float] = None
+
+    @classmethod
+    def from_env(cls, factory: Callable[[], object]) -> "ClientPool":
+        """Build a pool from the CLIENT_POOL_* environment variables."""
+        return cls(
+            factory,
+            size=int(os.getenv("CLIENT_POOL_SIZE", "4")),
+            idle_check=float(os.getenv("CLIENT_POOL_IDLE_CHECK", "60"))
+        )
+
+    def warm_up(self, background: bool = False):
+        """Create every client and open its connection, in parallel."""
+        def run():
+            started = time.perf_counter()
+            threads = [threading.Thread(target=self._warm_slot, args=(slot,), daemon=True) for slot in self._slots]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.warmup_seconds = time.perf_counter() - started
+
+        if background:
+            threading.Thread(target=run, name="client-pool-warmup", daemon=True).start()
+        else:
+            run()
+
+    @contextmanager
+    def lease(self):
+        """Use the least busy client for the duration of the block."""
+        with self._lock:
+            # Least calls in flight; ties go round-robin so idle clients stay warm
+            slot = min(self._slots, key=lambda s: (s.in_use, (s.index - self._next) % self.size))
+            self._next = (slot.index + 1) % self.size
+            slot.in_use += 1
+            self.leases += 1
+            self.max_in_use = max(self.max_in_use, sum(s.in_use for s in self._slots))
+        started = time.monotonic()
+        try:
+            client = self._ready_client(slot, started)
+            yield client
+        except Exception as e:
+            if rpc_status(e) == "UNAVAILABLE":
+                slot.suspect = True
+            raise
+        finally:
+            now = time.monotonic()
+            with self._lock:
+                slot.in_use -= 1
+                slot.last_used = now
+                self._busy_seconds += now - started
+
+    def stats(self) -> Dict:
+        with self._lock:
+            in_use = sum(slot.in_use for slot in self._slots)
+            elapsed = max(time.monotonic() - self._created, 1e-9)
+            return {
+                "size": self.size,
+                "in_use": in_use,
+                "max_in_use": self.max_in_use,
+                "leases": self.leases,
+                "utilization": round(self._busy_seconds / (elapsed * self.size), 4),
+                "connects": self.connects,
+                "reconnects": self.reconnects,
+                "health_checks": self.health_checks,
+                "health_failures": self.health_failures,
+                "warmup_ms": round(1000 * self.warmup_seconds, 1) if self.warmup_seconds is not None else None
+            }
+
+    def _warm_slot(self, slot: _Slot):
+        try:
+            self._ready_client(slot, time.monotonic(), force_check=True)
+        except Exception as e:
+            print(f"Client pool warm-up failed: {e}")
+
+    def _ready_client(self, slot: _Slot, now: float, force_check: bool = False):
+        with slot.lock:
+            if slot.client is None:
+                slot.client = self.factory()
+                slot.last_used = now
+                self.connects += 1
+                if force_check:
+                    # Opens the connection now instead of on the first call
+                    self._healthy(slot.client)
+            elif (force_check or slot.suspect or self._idle(slot, now)) and not self._healthy(slot.client):
+                # The connection was dropped (idle timeout, server restart); start over on a new one
+                old, slot.client = slot.client, self.factory()
+                self.connects += 1
+                self.reconnects += 1
+                if slot.in_use <= 1 and hasattr(old, "close"):
+                    old.close()
+            slot.suspect = False
+            return slot.client
+
+    def _idle(self, slot: _Slot, now: float) -> bool:
+        # No other call on it, and none for a while: the server or a proxy may have closed the connection
+        return slot.in_use <= 1 and now - slot.last_used > self.idle_check
+
+    def _healthy(self, client) -> bool:
+        channel = _channel_of(client)
+        if channel is None:
+            return True
+        import grpc  # already loaded by the client that owns the channel
+        self.health_checks += 1
+        try:
+            # Connects if needed; ready means the TCP and TLS handshakes are done
+            grpc.channel_ready_future(channel).result(timeout=self.health_timeout)
+            return True
+        except grpc.FutureTimeoutError:
+            self.health_failures += 1
+            return False
+
+
+class AsyncClientPool:
+    """
+    ClientPool for xai_sdk.aio clients, used from one event loop.
+
+    Picks clients the same way (fewest calls in flight, ties round-robin)
+    and checks idle or failing connections the same way, awaiting the
+    check instead of blocking a thread. A grpc.aio channel belongs to the
+    loop it was created on, so clients are created on first use or by
+    warm_up() running on that loop.
+
+    Args:
+        factory: Creates one client (backends.create_async_client)
+        size: Number of clients
+        idle_check: Idle seconds after which a connection is checked before use
+        health_timeout: How long a connection check may take
+    """
+
+    def __init__(self, factory: Callable[[], object], size: int = 4, idle_check: float = 60.0, health_timeout: float = 2.0):
+        self.factory = factory
+        self.size = max(1, size)
+        self.idle_check = idle_check
+        self.health_timeout = health_timeout
+        self._slots: List[_Slot] = [_Slot(i) for i in range(self.size)]
+        self._next = 0
+        self._created = time.monotonic()
+        self._busy_seconds = 0.0
+        self.leases = 0
+        self.max_in_use = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.health_checks = 0
+        self.health_failures = 0
+        self.warmup_seconds: Optional[float] = None
+
+    @classmethod
+    def from_env(cls, factory: Callable[[], object]) -> "AsyncClientPool":
+        """Build a pool from the same CLIENT_POOL_* environment variables as ClientPool."""
+        return cls(
+            factory,
+            size=int(os.getenv("CLIENT_POOL_SIZE", "4")),
+            idle_check=float(os.getenv("CLIENT_POOL_IDLE_CHECK", "60"))
+        )
+
+    async def warm_up(self):
+        """Create every client and open its connection, concurrently."""
+        import asyncio
+        started = time.perf_counter()
+        results = await asyncio.gather(
+            *(self._ready_client(slot, time.monotonic(), force_check=True) for slot in self._slots),
+            return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Client pool warm-up failed: {result}")
+        self.warmup_seconds = time.perf_counter() - started
+
+    @asynccontextmanager
+    async def lease(self):
+        """Use the least busy client for the duration of the block."""
+        slot = min(self._slots, key=lambda s: (s.in_use, (s.index - self._next) % self.size))
+        self._next = (slot.index + 1) % self.size
+        slot.in_use += 1
+        self.leases += 1
+        self.max_in_use = max(self.max_in_use, sum(s.in_use for s in self._slots))
+        started = time.monotonic()
+        try:
+            client = await self._ready_client(slot, started)
+            yield client
+        except Exception as e:
+            if rpc_status(e) == "UNAVAILABLE":
+                slot.suspect = True
+            raise
+        finally:
+            now = time.monotonic()
+            slot.in_use -= 1
+            slot.last_used = now
+            self._busy_seconds += now - started
+
+    async def close(self):
+        """Close every client, e.g. when the server shuts down."""
+        for slot in self._slots:
+            client, slot.client = slot.client, None
+            if client is not None and hasattr(client, "close"):
+                await client.close()
+
+    def stats(self) -> Dict:
+        in_use = sum(slot.in_use for slot in self._slots)
+        elapsed = max(time.monotonic() - self._created, 1e-9)
+        return {
+            "size": self.size,
+            "in_use": in_use,
+            "max_in_use": self.max_in_use,
+            "leases": self.leases,
+            "utilization": round(self._busy_seconds / (elapsed * self.size), 4),
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "health_checks": self.health_checks,
+            "health_failures": self.health_failures,
+            "warmup_ms": round(1000 * self.warmup_seconds, 1) if self.warmup_seconds is not None else None
+        }
+
+    async def _ready_client(self, slot: _Slot, now: float, force_check: bool = False):
+        if slot.client is None:
+            slot.client = self.factory()
+            slot.last_used = now
+            self.connects += 1
+            if force_check:
+                await self._healthy(slot.client)
+        elif force_check or slot.suspect or (slot.in_use <= 1 and now - slot.last_used > self.idle_check):
+            client = slot.client
+            slot.suspect = False
+            # Another coroutine may have replaced the client while this one was being checked
+            if not await self._healthy(client) and slot.client is client:
+                slot.client = self.factory()
+                self.connects += 1
+                self.reconnects += 1
+                if slot.in_use <= 1 and hasattr(client, "close"):
+                    await client.close()
+        slot.suspect = False
+        return slot.client
+
+    async def _healthy(self, client) -> bool:
+        channel = _channel_of(client)
+        if channel is None:
+            return True
+        import asyncio
+        self.health_checks += 1
+        try:
+            # Connects if needed; ready means the TCP and TLS handshakes are done
+            await asyncio.wait_for(channel.channel_ready(), self.health_timeout)
+            return True
+        except asyncio.TimeoutError:
+            self.health_failures += 1
+            return False
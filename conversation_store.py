@@ -0,0 +1,314 @@
+# Pluggable storage for the shared conversations, one per room
+# CONVERSATION_STORE=memory (default) keeps them in this process, CONVERSATION_STORE=sqlite shares them between worker processes
+
+import os
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Iterator, List, Dict
+
+from conversation_sync import AsyncWaiters, SharedConversation, check_messages
+from single_flight import AsyncSingleFlight
+
+
+def create_conversation_store():
+    """
+    Create the conversation store selected by CONVERSATION_STORE.
+
+    Returns:
+        A MemoryConversationStore, or a SQLiteConversationStore on CONVERSATION_DB
+    """
+    backend = os.getenv("CONVERSATION_STORE", "memory")
+    if backend == "memory":
+        return MemoryConversationStore()
+    if backend != "sqlite":
+        raise ValueError(f"Unknown CONVERSATION_STORE '{backend}', expected 'memory' or 'sqlite'")
+    return SQLiteConversationStore(
+        os.getenv("CONVERSATION_DB", "conversations.db"),
+        poll_interval=float(os.getenv("CONVERSATION_POLL_INTERVAL", "0.1"))
+    )
+
+
+class ConversationStore(ABC):
+    """
+    Versioned conversations keyed by room id.
+
+    Same contract as SharedConversation, with the room as first argument.
+    Rooms that were never written to are empty at version 0. append and
+    replace raise ValueError, and store nothing, unless the messages are a
+    list of {"sender": str, "message": str} objects.
+    """
+
+    @abstractmethod
+    def version(self, room: str) -> int:
+        """Return the current version, without reading the messages."""
+
+    @abstractmethod
+    def snapshot(self, room: str) -> Dict:
+        """Return the full conversation with its version."""
+
+    @abstractmethod
+    def append(self, room: str, messages: List[Dict[str, str]]) -> int:
+        """Atomically append messages. Returns the new version."""
+
+    @abstractmethod
+    def replace(self, room: str, messages: List[Dict[str, str]]) -> int:
+        """Store a full conversation, appending only the new tail when possible. Returns the new version."""
+
+    @abstractmethod
+    def changes_since(self, room: str, since: int) -> Dict:
+        """Return what a client holding version `since` is missing."""
+
+    @abstractmethod
+    def wait_for_changes(self, room: str, since: int, timeout: float) -> Dict:
+        """Block until the version moves past `since` or the timeout expires."""
+
+    @abstractmethod
+    async def wait_for_changes_async(self, room: str, since: int, timeout: float) -> Dict:
+        """wait_for_changes for coroutines, without blocking the event loop."""
+
+
+def _checked(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    error = check_messages(messages)
+    if error:
+        raise ValueError(error)
+    return messages
+
+
+# Answers reads of rooms that don't exist; never written to
+_EMPTY_ROOM = SharedConversation()
+
+
+class MemoryConversationStore(ConversationStore):
+    """
+    Rooms held in this process. Only correct with a single worker process.
+
+    A room is created by its first write, or by a client waiting on it, and
+    only kept once it has been written to: reading a room id nobody ever
+    wrote to doesn't cost any memory.
+    """
+
+    def __init__(self):
+        self._rooms: Dict[str, SharedConversation] = {}
+        # Writers and waiters currently using each room, which keep an unwritten room around
+        self._users: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _room(self, room: str) -> SharedConversation:
+        with self._lock:
+            return self._rooms.get(room, _EMPTY_ROOM)
+
+    @contextmanager
+    def _using(self, room: str) -> Iterator[SharedConversation]:
+        with self._lock:
+            conversation = self._rooms.get(room)
+            if conversation is None:
+                conversation = self._rooms[room] = SharedConversation()
+            self._users[room] = self._users.get(room, 0) + 1
+        try:
+            yield conversation
+        finally:
+            with self._lock:
+                self._users[room] -= 1
+                if not self._users[room]:
+                    del self._users[room]
+                    if not conversation.version:
+                        del self._rooms[room]
+
+    def version(self, room: str) -> int:
+        return self._room(room).version
+
+    def snapshot(self, room: str) -> Dict:
+        return self._room(room).snapshot()
+
+    def append(self, room: str, messages: List[Dict[str, str]]) -> int:
+        messages = _checked(messages)
+        with self._using(room) as conversation:
+            return conversation.append(messages)
+
+    def replace(self, room: str, messages: List[Dict[str, str]]) -> int:
+        messages = _checked(messages)
+        with self._using(room) as conversation:
+            return conversation.replace(messages)
+
+    def changes_since(self, room: str, since: int) -> Dict:
+        return self._room(room).changes_since(since)
+
+    def wait_for_changes(self, room: str, since: int, timeout: float) -> Dict:
+        with self._using(room) as conversation:
+            return conversation.wait_for_changes(since, timeout)
+
+    async def wait_for_changes_async(self, room: str, since: int, timeout: float) -> Dict:
+        with self._using(room) as conversation:
+            return await conversation.wait_for_changes_async(since, timeout)
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    Rooms in a local SQLite database in WAL mode, shared by every process using the same file.
+
+    Writes run in BEGIN IMMEDIATE transactions, so concurrent appends from
+    different workers are serialized and never lose messages. Each message
+    row remembers the version it was added in, like SharedConversation does
+    in memory. Waiting clients are woken right away by writes from their own
+    process and notice writes from other processes within poll_interval.
+    Coroutines waiting on the same room share one version query at a time,
+    run in a worker thread so the event loop never waits on the database.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 0.1):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._changed = threading.Condition()
+        self._async_waiters = AsyncWaiters()
+        self._version_polls = AsyncSingleFlight()
+        with self._transaction() as db:
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS rooms (
+                    room TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL,
+                    reset_version INTEGER NOT NULL
+                )""")
+            db.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    room TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    version INTEGER NOT NULL,
+                    body TEXT NOT NULL,
+                    PRIMARY KEY (room, position)
+                )""")
+
+    def _connection(self) -> sqlite3.Connection:
+        # One connection per thread; sqlite3 connections must not be shared across threads
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _transaction(self, write: bool = True):
+        return _Transaction(self._connection(), "BEGIN IMMEDIATE" if write else "BEGIN")
+
+    @staticmethod
+    def _versions(db: sqlite3.Connection, room: str):
+        row = db.execute("SELECT version, reset_version FROM rooms WHERE room = ?", (room,)).fetchone()
+        return row if row is not None else (0, 0)
+
+    @staticmethod
+    def _messages(db: sqlite3.Connection, room: str, start: int = 0) -> List[Dict[str, str]]:
+        rows = db.execute(
+            "SELECT body FROM messages WHERE room = ? AND position >= ? ORDER BY position", (room, start))
+        return [json.loads(body) for (body,) in rows]
+
+    @staticmethod
+    def _insert(db: sqlite3.Connection, room: str, start: int, version: int, messages: List[Dict[str, str]]):
+        db.executemany(
+            "INSERT INTO messages (room, position, version, body) VALUES (?, ?, ?, ?)",
+            [(room, start + i, version, json.dumps(message)) for i, message in enumerate(messages)])
+
+    @staticmethod
+    def _set_versions(db: sqlite3.Connection, room: str, version: int, reset_version: int):
+        db.execute(
+            "INSERT INTO rooms (room, version, reset_version) VALUES (?, ?, ?) "
+            "ON CONFLICT(room) DO UPDATE SET version = excluded.version, reset_version = excluded.reset_version",
+            (room, version, reset_version))
+
+    def _notify(self):
+        with self._changed:
+            self._changed.notify_all()
+        self._async_waiters.wake_all()
+
+    def version(self, room: str) -> int:
+        return self._versions(self._connection(), room)[0]
+
+    def snapshot(self, room: str) -> Dict:
+        with self._transaction(write=False) as db:
+            version, _ = self._versions(db, room)
+            return {"version": version, "conversation": self._messages(db, room)}
+
+    def append(self, room: str, messages: List[Dict[str, str]]) -> int:
+        if not _checked(messages):
+            return self.snapshot(room)["version"]
+        with self._transaction() as db:
+            version, reset_version = self._versions(db, room)
+            (count,) = db.execute("SELECT COUNT(*) FROM messages WHERE room = ?", (room,)).fetchone()
+            version += 1
+            self._insert(db, room, count, version, messages)
+            self._set_versions(db, room, version, reset_version)
+        self._notify()
+        return version
+
+    def replace(self, room: str, messages: List[Dict[str, str]]) -> int:
+        _checked(messages)
+        with self._transaction() as db:
+            version, reset_version = self._versions(db, room)
+            current = self._messages(db, room)
+            if len(messages) >= len(current) and messages[:len(current)] == current:
+                tail = messages[len(current):]
+                if not tail:
+                    return version
+                version += 1
+                self._insert(db, room, len(current), version, tail)
+            else:
+                version += 1
+                reset_version = version
+                db.execute("DELETE FROM messages WHERE room = ?", (room,))
+                self._insert(db, room, 0, version, messages)
+            self._set_versions(db, room, version, reset_version)
+        self._notify()
+        return version
+
+    def changes_since(self, room: str, since: int) -> Dict:
+        with self._transaction(write=False) as db:
+            version, reset_version = self._versions(db, room)
+            # A client ahead of us means the database was wiped
+            if since < reset_version or since > version:
+                return {"version": version, "reset": True, "start": 0, "messages": self._messages(db, room)}
+
+            (start,) = db.execute(
+                "SELECT COUNT(*) FROM messages WHERE room = ? AND version <= ?", (room, since)).fetchone()
+            return {"version": version, "reset": False, "start": start, "messages": self._messages(db, room, start)}
+
+    def wait_for_changes(self, room: str, since: int, timeout: float) -> Dict:
+        deadline = time.monotonic() + timeout
+        db = self._connection()
+        while True:
+            (version, _) = self._versions(db, room)
+            remaining = deadline - time.monotonic()
+            if version != since or remaining <= 0:
+                return self.changes_since(room, since)
+            with self._changed:
+                self._changed.wait(min(self.poll_interval, remaining))
+
+    async def wait_for_changes_async(self, room: str, since: int, timeout: float) -> Dict:
+        import asyncio
+
+        async def changed():
+            # Queries run in a worker thread, and waiters on the same room share the one in flight
+            version, _ = await self._version_polls.do(room, lambda: asyncio.to_thread(self.version, room))
+            return version != since
+
+        await self._async_waiters.wait(changed, timeout, self.poll_interval)
+        return await asyncio.to_thread(self.changes_since, room, since)
+
+
+class _Transaction:
+    """Context manager running a block in one transaction, rolled back on error."""
+
+    def __init__(self, db: sqlite3.Connection, begin: str):
+        self.db = db
+        self.begin = begin
+
+    def __enter__(self) -> sqlite3.Connection:
+        self.db.execute(self.begin)
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
@@ -0,0 +1,175 @@
+# Versioned shared conversation for syncing the user and friend views
+# Clients long-poll for the messages appended after the version they hold
+
+import asyncio
+import bisect
+import inspect
+import threading
+from typing import Awaitable, Callable, List, Dict, Optional, Union
+
+
+class AsyncWaiters:
+    """
+    Coroutines waiting for a change, woken from whichever thread made it.
+
+    A waiting coroutine only holds a future, not a thread, so an event loop
+    can keep thousands of long-polls open at once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = set()
+
+    async def wait(self, changed: Callable[[], Union[bool, Awaitable[bool]]], timeout: float,
+                   poll_interval: Optional[float] = None):
+        """
+        Wait until changed() is true, for at most timeout seconds.
+
+        changed() is checked again on every wake_all(), and every
+        poll_interval seconds if given (for changes made by other processes).
+        It may be a coroutine function, for checks that mustn't block the loop.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            # Registered before checking, so a wake-up during the check isn't missed
+            waiter = (loop, loop.create_future())
+            with self._lock:
+                self._waiters.add(waiter)
+            try:
+                result = changed()
+                if inspect.isawaitable(result):
+                    result = await result
+                remaining = deadline - loop.time()
+                if result or remaining <= 0:
+                    return
+                await asyncio.wait_for(waiter[1], remaining if poll_interval is None else min(poll_interval, remaining))
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._lock:
+                    self._waiters.discard(waiter)
+
+    def wake_all(self):
+        with self._lock:
+            waiters, self._waiters = self._waiters, set()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+def check_messages(messages) -> Optional[str]:
+    """Return why posted messages can't be stored, or None if they are a list of {"sender": str, "message": str}."""
+    if not isinstance(messages, list):
+        return "Messages must be a list"
+    for i, msg in enumerate(messages):
+        if not (isinstance(msg, dict) and msg.keys() == {"sender", "message"}
+                and isinstance(msg["sender"], str) and isinstance(msg["message"], str)):
+            return f"Message {i} must be an object with a string 'sender' and 'message'"
+    return None
+
+
+class SharedConversation:
+    """
+    Conversation shared between browser windows.
+
+    Every change bumps a monotonically increasing version. Appended messages
+    remember the version they were added in, so a client that already has
+    version N only needs the messages with a higher version. Anything that
+    isn't a plain append (clearing, loading an example) is a reset, and
+    clients older than the last reset get the full list again.
+    """
+
+    def __init__(self):
+        self._messages: List[Dict[str, str]] = []
+        self._message_versions: List[int] = []
+        self._version = 0
+        self._reset_version = 0
+        self._changed = threading.Condition()
+        self._async_waiters = AsyncWaiters()
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def snapshot(self) -> Dict:
+        """Return the full conversation with its version."""
+        with self._changed:
+            return {"version": self._version, "conversation": list(self._messages)}
+
+    def append(self, messages: List[Dict[str, str]]) -> int:
+        """Append messages and wake up waiting clients. Returns the new version."""
+        with self._changed:
+            if not messages:
+                return self._version
+            self._version += 1
+            self._messages.extend(messages)
+            self._message_versions.extend([self._version] * len(messages))
+            self._changed.notify_all()
+            self._async_waiters.wake_all()
+            return self._version
+
+    def replace(self, messages: List[Dict[str, str]]) -> int:
+        """
+        Store a full conversation sent by a client.
+
+        If the current messages are a prefix of the new list, only the tail
+        is appended; otherwise the conversation is reset.
+
+        Returns:
+            The new version
+        """
+        with self._changed:
+            current = len(self._messages)
+            if len(messages) >= current and messages[:current] == self._messages:
+                return self.append(messages[current:])
+
+            self._version += 1
+            self._reset_version = self._version
+            self._messages = list(messages)
+            self._message_versions = [self._version] * len(messages)
+            self._changed.notify_all()
+            self._async_waiters.wake_all()
+            return self._version
+
+    def changes_since(self, since: int) -> Dict:
+        """
+        Return what a client holding version `since` is missing.
+
+        Returns:
+            Dict with the current 'version', 'start' (index of the first
+            returned message in the full conversation), the new 'messages'
+            and 'reset' when the client has to drop what it has
+        """
+        with self._changed:
+            # A client ahead of us means the server restarted
+            if since < self._reset_version or since > self._version:
+                return {
+                    "version": self._version,
+                    "reset": True,
+                    "start": 0,
+                    "messages": list(self._messages)
+                }
+
+            start = bisect.bisect_right(self._message_versions, since)
+            return {
+                "version": self._version,
+                "reset": False,
+                "start": start,
+                "messages": self._messages[start:]
+            }
+
+    def wait_for_changes(self, since: int, timeout: float) -> Dict:
+        """Block until the version moves past `since` or the timeout expires."""
+        with self._changed:
+            self._changed.wait_for(lambda: self._version != since, timeout=timeout)
+            return self.changes_since(since)
+
+    async def wait_for_changes_async(self, since: int, timeout: float) -> Dict:
+        """wait_for_changes for coroutines: the event loop keeps running while this waits."""
+        await self._async_waiters.wait(lambda: self._version != since, timeout)
+        return self.changes_since(since)
@@ -0,0 +1,247 @@
+# Local fast path for formulaic last messages
+# "thanks!", "ok", "see you then" or "where's my order #12345" get template replies without a model call
+
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+# Messages longer than this are never formulaic enough to skip the model
+MAX_MESSAGE_CHARS = 80
+
+_APOSTROPHES = re.compile(r"['’`]")
+_PUNCTUATION = re.compile(r"[^\w#\s]+")
+
+
+def normalize_message(message: str) -> str:
+    """Lowercase, drop apostrophes and punctuation (but not '#') and collapse whitespace."""
+    text = _APOSTROPHES.sub("", message.lower())
+    return " ".join(_PUNCTUATION.sub(" ", text).split())
+
+
+class Intent:
+    """
+    One formulaic kind of message and the replies it gets.
+
+    Args:
+        name: Intent name, also used in metrics
+        pattern: Regex that must match the whole normalized message
+        confidence: How sure a match is that the templates fit
+        suggestions: (reply, tone, confidence, explanation); replies may use {sender} and named groups
+        analysis: conversation_analysis with the same placeholders
+        question_penalty: Subtracted from confidence when the user's previous message asked something,
+            because then the short answer carries meaning the templates can't know
+    """
+
+    def __init__(self, name: str, pattern: str, confidence: float, suggestions: List[Tuple[str, str, float, str]],
+                 analysis: Dict[str, str], question_penalty: float = 0.0):
+        self.name = name
+        self.pattern = pattern
+        self.confidence = confidence
+        self.suggestions = suggestions
+        self.analysis = analysis
+        self.question_penalty = question_penalty
+
+    def render(self, values: Dict[str, str]) -> Dict:
+        return {
+            "suggestions": [
+                {
+                    "reply": reply.format(**values),
+                    "tone": tone,
+                    "confidence": confidence,
+                    "explanation": explanation
+                }
+                for reply, tone, confidence, explanation in self.suggestions
+            ],
+            "conversation_analysis": {key: value.format(**values) for key, value in self.analysis.items()}
+        }
+
+
+DEFAULT_INTENTS = [
+    Intent(
+        "thanks",
+        r"(?:thanks|thank you|thx|ty|tysm|cheers|many thanks|much appreciated|appreciate it|i appreciate it)"
+        r"(?: (?:so much|a lot|again|very much|for everything|for your help|for the help))?(?: #?\w+)?",
+        0.95,
+        [
+            ("You're welcome!", "friendly", 0.9, "Warm, simple acknowledgement of the thanks"),
+            ("Anytime, {sender}. Happy to help.", "casual", 0.85, "Relaxed reply that keeps the door open"),
+            ("My pleasure. Let me know if you need anything else.", "professional", 0.8, "Polite close that offers further help"),
+        ],
+        {
+            "summary": "{sender} said thanks",
+            "last_message_intent": "Expressing gratitude",
+            "suggested_action": "Acknowledge the thanks"
+        }
+    ),
+    Intent(
+        "farewell",
+        r"(?:see you|see ya|cya|see you then|see you soon|see you later|see you tomorrow|bye|bye bye|goodbye|good night|"
+        r"night|talk soon|talk to you later|ttyl|later|catch you later|have a good (?:one|day|night|evening|weekend))"
+        r"(?: then| soon| later| tomorrow| there)?",
+        0.9,
+        [
+            ("See you!", "friendly", 0.9, "Mirrors the goodbye"),
+            ("Take care, {sender}!", "casual", 0.85, "Warm, informal sign-off"),
+            ("Thanks, talk soon.", "professional", 0.8, "Short, polite close"),
+        ],
+        {
+            "summary": "{sender} is wrapping up the conversation",
+            "last_message_intent": "Saying goodbye",
+            "suggested_action": "Say goodbye back"
+        }
+    ),
+    Intent(
+        "acknowledge",
+        r"(?:ok|okay|k|kk|okie|got it|sounds good|cool|alright|all right|sure|perfect|great|noted|understood|will do|"
+        r"no problem|np|no worries)(?: thanks| thank you| then)?",
+        0.85,
+        [
+            ("Great, thanks!", "friendly", 0.85, "Confirms you're on the same page"),
+            ("Perfect, let me know if anything changes.", "professional", 0.8, "Closes the loop and leaves room for updates"),
+            ("👍", "casual", 0.75, "Lightweight acknowledgement"),
+        ],
+        {
+            "summary": "{sender} acknowledged the previous message",
+            "last_message_intent": "Acknowledging",
+            "suggested_action": "Confirm briefly or move the conversation on"
+        },
+        question_penalty=0.25
+    ),
+    Intent(
+        "greeting",
+        r"(?:hi|hello|hey|hiya|heya|yo|howdy|good morning|good afternoon|good evening|morning)(?: there| all| everyone)?",
+        0.85,
+        [
+            ("Hi {sender}! How are you?", "friendly", 0.85, "Returns the greeting and invites them to go on"),
+            ("Hey! What's up?", "casual", 0.8, "Informal greeting that asks what they need"),
+            ("Hello {sender}, how can I help?", "professional", 0.75, "Polite greeting that offers help"),
+        ],
+        {
+            "summary": "{sender} opened with a greeting",
+            "last_message_intent": "Greeting",
+            "suggested_action": "Greet back and ask what they need"
+        },
+        question_penalty=0.25
+    ),
+    Intent(
+        "order_status",
+        r"(?:hi |hello |hey )?(?:(?:whats|what is|wheres|where is|any update on|any updates on|can you check|"
+        r"could you check|status of|status for|update on) )?(?:the |my )?order(?: status)?(?: for| of| on| number| no)?"
+        r" ?#? ?(?P<order>[a-z]{0,3}\d{3,}[a-z0-9-]*)(?: status)?",
+        0.9,
+        [
+            ("Let me check on order #{order} for you right away.", "professional", 0.9, "Takes ownership of the lookup"),
+            ("Thanks for your patience! I'm looking up order #{order} now.", "friendly", 0.85, "Warm reply while checking"),
+            ("I'm sorry for the wait. I'll get you an update on order #{order} shortly.", "empathetic", 0.8, "Acknowledges the wait"),
+        ],
+        {
+            "summary": "{sender} is asking about order #{order}",
+            "last_message_intent": "Asking for an order status update",
+            "suggested_action": "Look up order #{order} and report its status"
+        }
+    ),
+]
+
+
+class FastPathMatch:
+    """A last message the fast path can answer, with the rendered suggestions."""
+
+    def __init__(self, intent: str, confidence: float, data: Dict):
+        self.intent = intent
+        self.confidence = confidence
+        self.data = data
+
+    def to_dict(self) -> Dict:
+        return {"intent": self.intent, "confidence": self.confidence}
+
+
+class FastPath:
+    """
+    Classify the last message against a compiled index of formulaic intents.
+
+    All intent patterns are compiled into one alternation with a named group
+    per intent, so classifying a message is a single fullmatch of a short
+    normalized string. A match is only used if its confidence reaches
+    min_confidence; anything else falls through to the model.
+
+    Args:
+        intents: Intents to recognize (DEFAULT_INTENTS by default)
+        min_confidence: Least confidence that skips the model
+        enabled: Whether to answer anything locally at all
+    """
+
+    def __init__(self, intents: Optional[List[Intent]] = None, min_confidence: float = 0.8, enabled: bool = True):
+        self.intents = {intent.name: intent for intent in (intents or DEFAULT_INTENTS)}
+        self.min_confidence = min_confidence
+        self.enabled = enabled
+        self._group_intent = {}
+        alternatives = []
+        for i, intent in enumerate(self.intents.values()):
+            group = f"i{i}"
+            self._group_intent[group] = intent
+            alternatives.append(f"(?P<{group}>{intent.pattern})")
+        self._index = re.compile("|".join(alternatives))
+        self._lock = threading.Lock()
+        self.hits: Dict[str, int] = {name: 0 for name in self.intents}
+        self.below_threshold = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls) -> "FastPath":
+        """Build the fast path from the FAST_PATH / FAST_PATH_MIN_CONFIDENCE environment variables."""
+        return cls(
+            min_confidence=float(os.getenv("FAST_PATH_MIN_CONFIDENCE", "0.8")),
+            enabled=os.getenv("FAST_PATH", "1") == "1"
+        )
+
+    def classify(self, conversation_history: List[Dict[str, str]], user_name: str) -> Optional[FastPathMatch]:
+        """Return template suggestions for the last message, or None to ask the model."""
+        if not self.enabled or not conversation_history:
+            return None
+        last = conversation_history[-1]
+        message = last.get('message', '')
+        match = self._index.fullmatch(normalize_message(message)) if len(message) <= MAX_MESSAGE_CHARS else None
+        if match is None:
+            self._count(None)
+            return None
+
+        intent = self._group_intent[match.lastgroup]
+        confidence = intent.confidence
+        if intent.question_penalty and self._user_asked(conversation_history, user_name):
+            confidence -= intent.question_penalty
+        if confidence < self.min_confidence:
+            self._count(None, below_threshold=True)
+            return None
+
+        # Slots captured by the intent's own named groups, e.g. the order number
+        values = {"sender": last.get('sender', '')}
+        values.update((k, (v or '').upper()) for k, v in match.groupdict().items() if k not in self._group_intent)
+        self._count(intent.name)
+        return FastPathMatch(intent.name, round(confidence, 2), intent.render(values))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "hits": dict(self.hits),
+                "below_threshold": self.below_threshold,
+                "misses": self.misses
+            }
+
+    @staticmethod
+    def _user_asked(conversation_history: List[Dict[str, str]], user_name: str) -> bool:
+        # The user's most recent message before this one ended in a question
+        for msg in reversed(conversation_history[:-1]):
+            if msg.get('sender') == user_name:
+                return msg.get('message', '').rstrip().endswith('?')
+        return False
+
+    def _count(self, intent: Optional[str], below_threshold: bool = False):
+        with self._lock:
+            if intent is not None:
+                self.hits[intent] += 1
+            elif below_threshold:
+                self.below_threshold += 1
+            else:
+                self.misses += 1
@@ -0,0 +1,191 @@
+# Cached, validated and compressed JSON bodies for the polled routes
+# A body is serialized, hashed and compressed once per version of its data; clients that
+# already have it get a 304 on If-None-Match, and large bodies go out gzip or brotli compressed
+
+import os
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def dumps(obj) -> bytes:
+    """Serialize to compact UTF-8 JSON, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def accepted_encodings(accept_encoding: str) -> set:
+    """Content codings the client accepts ("q=0" means it doesn't)."""
+    accepted = set()
+    for part in (accept_encoding or "").lower().split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = params.strip()
+        if quality.startswith("q="):
+            try:
+                if float(quality[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            accepted.add(coding.strip())
+    return accepted
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Whether an If-None-Match header names this body, in any of its encodings."""
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        # The compressed variants carry the same hash with a "-gzip"/"-br" suffix
+        if tag.strip('"').split("-", 1)[0] == etag:
+            return True
+    return False
+
+
+class Payload:
+    """One serialized body with its content hash and compressed forms, built on demand."""
+
+    __slots__ = ("version", "body", "etag", "_encoded")
+
+    def __init__(self, version, body: bytes):
+        self.version = version
+        self.body = body
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self._encoded: Dict[str, bytes] = {}
+
+    def encoded(self, encoding: str, gzip_level: int, brotli_quality: int) -> bytes:
+        body = self._encoded.get(encoding)
+        if body is None:
+            # Two threads may both compress the first time; either result is the same
+            if encoding == "br":
+                body = brotli.compress(self.body, quality=brotli_quality)
+            else:
+                body = gzip.compress(self.body, compresslevel=gzip_level, mtime=0)
+            self._encoded[encoding] = body
+        return body
+
+
+class ResponseCache:
+    """
+    Serialized JSON bodies keyed by what they show, valid for one version of the data.
+
+    payload() returns the cached body while the caller's version matches,
+    and builds, serializes and hashes a new one otherwise. render() turns
+    it into a status, body and headers for the request: 304 with no body
+    when If-None-Match already names it, or the body with a content-hash
+    ETag, compressed with brotli (if installed) or gzip when it is at least
+    min_compress_size bytes and the client accepts it. Compressed bodies
+    are kept with the payload, so an unchanged body is never serialized or
+    compressed twice.
+
+    Args:
+        max_entries: Payloads kept before the least recently used are dropped
+        min_compress_size: Smallest body that is compressed
+        gzip_level: gzip compression level
+        brotli_quality: brotli quality (0-11)
+    """
+
+    def __init__(self, max_entries: int = 4096, min_compress_size: int = 1024, gzip_level: int = 6,
+                 brotli_quality: int = 5):
+        self.max_entries = max_entries
+        self.min_compress_size = min_compress_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self._entries: "OrderedDict[Hashable, Payload]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.builds = 0
+        self.not_modified = 0
+        self.compressed = 0
+        self.bytes_sent = 0
+        self.bytes_saved = 0
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache":
+        """Build a cache from the RESPONSE_CACHE_* / COMPRESS_* environment variables."""
+        return cls(
+            max_entries=int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "4096")),
+            min_compress_size=int(os.getenv("COMPRESS_MIN_BYTES", "1024")),
+            gzip_level=int(os.getenv("COMPRESS_GZIP_LEVEL", "6")),
+            brotli_quality=int(os.getenv("COMPRESS_BROTLI_QUALITY", "5"))
+        )
+
+    def payload(self, key: Hashable, version, build: Callable[[], object]) -> Payload:
+        """The body for key at this version, from the cache or freshly built."""
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None and payload.version == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return payload
+        payload = Payload(version, dumps(build()))
+        with self._lock:
+            self.builds += 1
+            self._entries[key] = payload
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return payload
+
+    def render(self, payload: Payload, if_none_match: str = "", accept_encoding: str = "",
+               cache_control: str = "no-cache") -> Tuple[int, bytes, Dict[str, str]]:
+        """Status, body and headers for sending the payload to this client."""
+        headers = {"Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if etag_matches(if_none_match, payload.etag):
+            headers["ETag"] = f'"{payload.etag}"'
+            with self._lock:
+                self.not_modified += 1
+                self.bytes_saved += len(payload.body)
+            return 304, b"", headers
+
+        body, encoding = payload.body, None
+        if len(body) >= self.min_compress_size:
+            accepted = accepted_encodings(accept_encoding)
+            if brotli is not None and "br" in accepted:
+                encoding = "br"
+            elif "gzip" in accepted:
+                encoding = "gzip"
+        if encoding is not None:
+            body = payload.encoded(encoding, self.gzip_level, self.brotli_quality)
+            headers["Content-Encoding"] = encoding
+            headers["ETag"] = f'"{payload.etag}-{encoding}"'
+        else:
+            headers["ETag"] = f'"{payload.etag}"'
+        with self._lock:
+            self.compressed += encoding is not None
+            self.bytes_sent += len(body)
+            self.bytes_saved += len(payload.body) - len(body)
+        return 200, body, headers
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "builds": self.builds,
+                "not_modified": self.not_modified,
+                "compressed": self.compressed,
+                "bytes_sent": self.bytes_sent,
+                "bytes_saved": self.bytes_saved,
+                "encoder": "orjson" if orjson is not None else "json",
+                "brotli": brotli is not None
+            }
@@ -0,0 +1,333 @@
+# Local stand-in for the xAI API
+# Selected with XAI_BACKEND=mock; answers with well-formed suggestion JSON after a simulated latency
+
+import os
+import json
+import math
+import random
+import re
+import threading
+import time
+from typing import AsyncIterator, List, Dict, Iterator, Optional, Tuple
+
+import grpc
+
+from resilience import remaining_time
+from suggestion_options import TONES
+
+
+class MockUpstreamError(grpc.RpcError):
+    """Injected failure, shaped like the gRPC errors the real client raises."""
+
+    def __init__(self, code: grpc.StatusCode = grpc.StatusCode.UNAVAILABLE, details: str = "mock upstream error"):
+        super().__init__(details)
+        self._code = code
+        self._details = details
+
+    def code(self) -> grpc.StatusCode:
+        return self._code
+
+    def details(self) -> str:
+        return self._details
+
+
+class MockUsage:
+    """Token counts, estimated at roughly 4 characters per token."""
+
+    def __init__(self, prompt_tokens: int, completion_tokens: int):
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.cached_prompt_text_tokens = 0
+        self.total_tokens = prompt_tokens + completion_tokens
+
+
+class MockResponse:
+    """Accumulated response, the same shape as xai_sdk's Response for the fields we use."""
+
+    def __init__(self, prompt_tokens: int):
+        self.content = ""
+        self.finish_reason = "REASON_STOP"
+        self.usage = MockUsage(prompt_tokens, 0)
+
+    def _add(self, text: str):
+        self.content += text
+        self.usage.completion_tokens = len(self.content) // 4 + 1
+        self.usage.total_tokens = self.usage.prompt_tokens + self.usage.completion_tokens
+
+
+class MockChunk:
+    """One streamed piece of output."""
+
+    def __init__(self, content: str):
+        self.content = content
+
+
+class MockChat:
+    """Chat with the append/sample/stream interface of xai_sdk's sync Chat."""
+
+    def __init__(self, client: "MockClient", model: str, messages: Optional[List] = None):
+        self._client = client
+        self.model = model
+        self.messages = list(messages or [])
+
+    def append(self, message) -> "MockChat":
+        self.messages.append(message)
+        return self
+
+    def sample(self) -> MockResponse:
+        latency, ttft, fail, malformed = self._client._plan()
+        response = MockResponse(self._prompt_tokens())
+        _sleep_within_deadline(latency)
+        if fail:
+            raise MockUpstreamError()
+        response._add(self._client._render(self._texts(), malformed))
+        return response
+
+    def stream(self) -> Iterator[Tuple[MockResponse, MockChunk]]:
+        latency, ttft, fail, malformed = self._client._plan()
+        response = MockResponse(self._prompt_tokens())
+        _sleep_within_deadline(ttft)
+        if fail:
+            raise MockUpstreamError()
+
+        content = self._client._render(self._texts(), malformed)
+        size = self._client.chunk_chars
+        pieces = [content[i:i + size] for i in range(0, len(content), size)] or [""]
+        gap = max(latency - ttft, 0.0) / len(pieces)
+        for i, piece in enumerate(pieces):
+            if i:
+                _sleep_within_deadline(gap)
+            response._add(piece)
+            yield response, MockChunk(piece)
+
+    def _texts(self) -> List[str]:
+        texts = []
+        for message in self.messages:
+            if hasattr(message, "content"):
+                texts.append("".join(part.text for part in message.content))
+            else:
+                texts.append(str(message))
+        return texts
+
+    def _prompt_tokens(self) -> int:
+        return sum(len(text) for text in self._texts()) // 4 + 1
+
+
+class MockAsyncChat(MockChat):
+    """Chat with the append/sample/stream interface of xai_sdk.aio's Chat; waiting holds no thread."""
+
+    async def sample(self) -> MockResponse:
+        latency, ttft, fail, malformed = self._client._plan()
+        response = MockResponse(self._prompt_tokens())
+        await _sleep_within_deadline_async(latency)
+        if fail:
+            raise MockUpstreamError()
+        response._add(self._client._render(self._texts(), malformed))
+        return response
+
+    async def stream(self) -> AsyncIterator[Tuple[MockResponse, MockChunk]]:
+        latency, ttft, fail, malformed = self._client._plan()
+        response = MockResponse(self._prompt_tokens())
+        await _sleep_within_deadline_async(ttft)
+        if fail:
+            raise MockUpstreamError()
+
+        content = self._client._render(self._texts(), malformed)
+        size = self._client.chunk_chars
+        pieces = [content[i:i + size] for i in range(0, len(content), size)] or [""]
+        gap = max(latency - ttft, 0.0) / len(pieces)
+        for i, piece in enumerate(pieces):
+            if i:
+                await _sleep_within_deadline_async(gap)
+            response._add(piece)
+            yield response, MockChunk(piece)
+
+
+def _sleep_within_deadline(seconds: float):
+    # Like a gRPC call with a timeout: give up when the request deadline passes
+    remaining = remaining_time()
+    if remaining is not None and remaining < seconds:
+        time.sleep(max(remaining, 0.0))
+        raise MockUpstreamError(grpc.StatusCode.DEADLINE_EXCEEDED, "Deadline Exceeded")
+    time.sleep(seconds)
+
+
+async def _sleep_within_deadline_async(seconds: float):
+    # Only the async client gets here; asyncio is slow to import for the command-line scripts
+    import asyncio
+    remaining = remaining_time()
+    if remaining is not None and remaining < seconds:
+        await asyncio.sleep(max(remaining, 0.0))
+        raise MockUpstreamError(grpc.StatusCode.DEADLINE_EXCEEDED, "Deadline Exceeded")
+    await asyncio.sleep(seconds)
+
+
+class _MockChatFactory:
+    def __init__(self, client: "MockClient"):
+        self._client = client
+
+    def create(self, model: str, messages: Optional[List] = None, **kwargs) -> MockChat:
+        return self._client.chat_class(self._client, model, messages)
+
+
+class MockClient:
+    """
+    Local stand-in for xai_sdk.Client.
+
+    Answers every chat with a well-formed suggestions document after a
+    latency drawn from a configurable distribution. It can stream, inject
+    malformed JSON and fail a fraction of calls, so the whole pipeline can
+    be exercised and timed without API calls.
+
+    Args:
+        latency_ms: Mean total response time
+        latency_jitter_ms: Spread of the response time
+        distribution: "fixed", "uniform", "normal" or "lognormal"
+        ttft_ms: Time to first streamed token
+        chunk_chars: Characters per streamed chunk
+        error_rate: Fraction of calls that raise MockUpstreamError
+        malformed_rate: Fraction of calls that return truncated JSON
+        stall_rate: Fraction of calls that stall for stall_ms before the first token
+        stall_ms: Extra delay of a stalled call
+        seed: Random seed for reproducible runs
+    """
+
+    chat_class = MockChat
+
+    def __init__(
+        self,
+        latency_ms: float = 800.0,
+        latency_jitter_ms: float = 200.0,
+        distribution: str = "lognormal",
+        ttft_ms: float = 150.0,
+        chunk_chars: int = 16,
+        error_rate: float = 0.0,
+        malformed_rate: float = 0.0,
+        stall_rate: float = 0.0,
+        stall_ms: float = 5000.0,
+        seed: Optional[int] = None
+    ):
+        if distribution not in ("fixed", "uniform", "normal", "lognormal"):
+            raise ValueError(f"Unknown latency distribution '{distribution}'")
+        self.latency_ms = latency_ms
+        self.latency_jitter_ms = latency_jitter_ms
+        self.distribution = distribution
+        self.ttft_ms = ttft_ms
+        self.chunk_chars = chunk_chars
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.stall_rate = stall_rate
+        self.stall_ms = stall_ms
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.chat = _MockChatFactory(self)
+        self.calls = 0
+        self.errors = 0
+        self.malformed = 0
+        self.stalls = 0
+
+    @classmethod
+    def from_env(cls) -> "MockClient":
+        """Build a mock client from the MOCK_* environment variables."""
+        seed = os.getenv("MOCK_SEED")
+        return cls(
+            latency_ms=float(os.getenv("MOCK_LATENCY_MS", "800")),
+            latency_jitter_ms=float(os.getenv("MOCK_LATENCY_JITTER_MS", "200")),
+            distribution=os.getenv("MOCK_LATENCY_DISTRIBUTION", "lognormal"),
+            ttft_ms=float(os.getenv("MOCK_TTFT_MS", "150")),
+            chunk_chars=int(os.getenv("MOCK_CHUNK_CHARS", "16")),
+            error_rate=float(os.getenv("MOCK_ERROR_RATE", "0")),
+            malformed_rate=float(os.getenv("MOCK_MALFORMED_RATE", "0")),
+            stall_rate=float(os.getenv("MOCK_STALL_RATE", "0")),
+            stall_ms=float(os.getenv("MOCK_STALL_MS", "5000")),
+            seed=int(seed) if seed else None
+        )
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"calls": self.calls, "errors": self.errors, "malformed": self.malformed, "stalls": self.stalls}
+
+    def _plan(self) -> Tuple[float, float, bool, bool]:
+        # Decide latency, time to first token and injected faults for one call
+        with self._lock:
+            mean = self.latency_ms
+            jitter = self.latency_jitter_ms
+            if self.distribution == "fixed" or jitter <= 0 or mean <= 0:
+                latency = mean
+            elif self.distribution == "uniform":
+                latency = self._random.uniform(mean - jitter, mean + jitter)
+            elif self.distribution == "normal":
+                latency = self._random.gauss(mean, jitter)
+            else:
+                # Lognormal with the requested mean and standard deviation: a long right tail like real traffic
+                sigma2 = math.log(1 + (jitter / mean) ** 2)
+                mu = math.log(mean) - sigma2 / 2
+                latency = self._random.lognormvariate(mu, sigma2 ** 0.5)
+            latency = max(latency, 0.0) / 1000
+            ttft = min(self.ttft_ms / 1000, latency)
+            # A stalled call sits on an idle connection before anything comes back
+            if self.stall_rate and self._random.random() < self.stall_rate:
+                ttft += self.stall_ms / 1000
+                latency += self.stall_ms / 1000
+                self.stalls += 1
+
+            fail = self._random.random() < self.error_rate
+            malformed = not fail and self._random.random() < self.malformed_rate
+            self.calls += 1
+            self.errors += fail
+            self.malformed += malformed
+            return latency, ttft, fail, malformed
+
+    def _render(self, texts: List[str], malformed: bool) -> str:
+        system_prompt = texts[0] if texts else ""
+        request = texts[-1] if texts else ""
+        if "JSON" not in system_prompt:
+            # Free-text calls such as conversation summaries
+            return "Mock summary of the conversation so far."
+
+        match = re.search(r"(\d+) (?:reply )?suggestions?", request)
+        count = int(match.group(1)) if match else 3
+        match = re.search(r"Only use these tones: ([a-z, ]+)", request)
+        tones = [tone for tone in match.group(1).split(", ") if tone in TONES] if match else None
+        tones = tones or TONES
+        last_line = next((line for line in reversed("\n".join(texts[1:-1]).splitlines()) if ": " in line), "")
+        sender = last_line.split(": ", 1)[0] if last_line else "them"
+
+        with self._lock:
+            confidences = sorted((round(self._random.uniform(0.6, 0.95), 2) for _ in range(count)), reverse=True)
+        suggestions = [
+            {
+                "reply": f"Mock reply {i + 1} to {sender}.",
+                "tone": tones[i % len(tones)],
+                "confidence": confidences[i],
+                "explanation": "Generated by the mock backend",
+                "context_notes": "Generated by the mock backend"
+            }
+            for i in range(count)
+        ]
+        if 'only the "suggestions" list' in request:
+            # A replacement for one suggestion; the caller already has the analysis
+            document = json.dumps({"suggestions": suggestions})
+        else:
+            document = json.dumps({
+                "suggestions": suggestions,
+                "conversation_summary": f"Conversation with {sender}",
+                "primary_intent": "Mock intent",
+                "conversation_analysis": {
+                    "summary": f"Conversation with {sender}",
+                    "last_message_intent": "Mock intent",
+                    "suggested_action": "Reply"
+                }
+            })
+        if malformed:
+            return document[:len(document) // 2]
+        return document
+
+
+class MockAsyncClient(MockClient):
+    """Local stand-in for xai_sdk.aio.Client, with the same settings as MockClient."""
+
+    chat_class = MockAsyncChat
+
+    async def close(self):
+        pass
@@ -0,0 +1,273 @@
+# Model tiering and hedged upstream calls
+# Short, simple threads go to a faster model; slow first tokens trigger a backup request
+
+import os
+import contextvars
+import queue
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class RoutingDecision:
+    """Which model a request runs on, and why."""
+
+    def __init__(self, tier: str, model: str, reason: str, features: Dict):
+        self.tier = tier
+        self.model = model
+        self.reason = reason
+        self.features = features
+
+    def to_dict(self) -> Dict:
+        return {"tier": self.tier, "model": self.model, "reason": self.reason, "features": self.features}
+
+
+class ModelRouter:
+    """
+    Pick a model tier from cheap features of the conversation.
+
+    A conversation goes to the fast tier only if it is short, its last
+    message is small and no extra context was supplied; everything else
+    stays on the standard model.
+
+    Args:
+        standard_model: Model for everything that isn't clearly simple
+        fast_model: Model for short, simple threads (None turns routing off)
+        fast_max_turns: Most messages a fast-tier conversation may have
+        fast_max_last_chars: Longest last message for the fast tier
+        fast_max_chars: Longest whole conversation for the fast tier
+    """
+
+    def __init__(
+        self,
+        standard_model: str = "grok-4",
+        fast_model: Optional[str] = "grok-3-mini",
+        fast_max_turns: int = 6,
+        fast_max_last_chars: int = 200,
+        fast_max_chars: int = 1200
+    ):
+        self.standard_model = standard_model
+        self.fast_model = fast_model
+        self.fast_max_turns = fast_max_turns
+        self.fast_max_last_chars = fast_max_last_chars
+        self.fast_max_chars = fast_max_chars
+
+    @classmethod
+    def from_env(cls, standard_model: str = "grok-4") -> "ModelRouter":
+        """Build a router from the MODEL_ROUTING / ROUTE_* environment variables."""
+        enabled = os.getenv("MODEL_ROUTING", "1") == "1"
+        return cls(
+            standard_model=standard_model,
+            fast_model=os.getenv("MODEL_TIER_FAST", "grok-3-mini") if enabled else None,
+            fast_max_turns=int(os.getenv("ROUTE_FAST_MAX_TURNS", "6")),
+            fast_max_last_chars=int(os.getenv("ROUTE_FAST_MAX_LAST_CHARS", "200")),
+            fast_max_chars=int(os.getenv("ROUTE_FAST_MAX_CHARS", "1200"))
+        )
+
+    @staticmethod
+    def features(conversation_history: List[Dict[str, str]], context: Optional[str] = None) -> Dict:
+        last = conversation_history[-1].get('message', '') if conversation_history else ''
+        return {
+            "turns": len(conversation_history),
+            "chars": sum(len(msg.get('message', '')) for msg in conversation_history),
+            "last_chars": len(last),
+            "has_context": bool(context)
+        }
+
+    def route(self, conversation_history: List[Dict[str, str]], context: Optional[str] = None) -> RoutingDecision:
+        features = self.features(conversation_history, context)
+        if not self.fast_model:
+            return RoutingDecision("standard", self.standard_model, "routing disabled", features)
+        if features["has_context"]:
+            return RoutingDecision("standard", self.standard_model, "extra context", features)
+        if features["turns"] > self.fast_max_turns:
+            return RoutingDecision("standard", self.standard_model, "long thread", features)
+        if features["last_chars"] > self.fast_max_last_chars:
+            return RoutingDecision("standard", self.standard_model, "long last message", features)
+        if features["chars"] > self.fast_max_chars:
+            return RoutingDecision("standard", self.standard_model, "long conversation", features)
+        return RoutingDecision("fast", self.fast_model, "short and simple", features)
+
+
+class LatencyTracker:
+    """Recent time-to-first-token samples per model, for percentile deadlines."""
+
+    def __init__(self, window: int = 500):
+        self.window = window
+        self._samples: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model: str, seconds: float):
+        with self._lock:
+            samples = self._samples.get(model)
+            if samples is None:
+                samples = self._samples[model] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, model: str, p: float) -> Tuple[Optional[float], int]:
+        """Return (p-th percentile, sample count); the percentile is None without samples."""
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if not samples:
+            return None, 0
+        return samples[min(len(samples) - 1, int(p * len(samples)))], len(samples)
+
+
+class HedgePolicy:
+    """
+    When to send a backup request.
+
+    The deadline is the given percentile of recent time-to-first-token for
+    the model, so only the slowest few percent of calls get hedged. Until
+    min_samples calls were seen, default_deadline is used.
+
+    Args:
+        enabled: Whether to hedge at all
+        percentile: TTFT percentile used as the hedge deadline
+        min_samples: Samples needed before the percentile is trusted
+        default_deadline: Deadline in seconds before enough samples exist
+        min_deadline: Lower bound, so a fast streak doesn't hedge every call
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        percentile: float = 0.95,
+        min_samples: int = 20,
+        default_deadline: float = 2.0,
+        min_deadline: float = 0.2
+    ):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.default_deadline = default_deadline
+        self.min_deadline = min_deadline
+        self.ttft = LatencyTracker()
+
+    @classmethod
+    def from_env(cls) -> "HedgePolicy":
+        """Build a policy from the HEDGE_* environment variables."""
+        return cls(
+            enabled=os.getenv("HEDGE_REQUESTS", "0") == "1",
+            percentile=float(os.getenv("HEDGE_PERCENTILE", "0.95")),
+            min_samples=int(os.getenv("HEDGE_MIN_SAMPLES", "20")),
+            default_deadline=float(os.getenv("HEDGE_DEFAULT_DEADLINE", "2.0")),
+            min_deadline=float(os.getenv("HEDGE_MIN_DEADLINE", "0.2"))
+        )
+
+    def deadline(self, model: str) -> float:
+        value, count = self.ttft.percentile(model, self.percentile)
+        if value is None or count < self.min_samples:
+            return self.default_deadline
+        return max(value, self.min_deadline)
+
+
+class HedgedResult:
+    """Outcome of a hedged call: the winning response and how it was reached."""
+
+    def __init__(self, response, content: str, ttft: Optional[float], winner: str, hedged: bool, deadline: float):
+        self.response = response
+        self.content = content
+        self.ttft = ttft
+        self.winner = winner
+        self.hedged = hedged
+        self.deadline = deadline
+
+    @property
+    def outcome(self) -> str:
+        """'not_hedged', 'primary_won' or 'backup_won'."""
+        return f"{self.winner}_won" if self.hedged else "not_hedged"
+
+    def to_dict(self) -> Dict:
+        return {
+            "hedged": self.hedged,
+            "winner": self.winner,
+            "hedge_deadline_ms": round(1000 * self.deadline, 1)
+        }
+
+
+class _Attempt:
+    """One streamed upstream call running on its own thread."""
+
+    def __init__(self, name: str, chat, results: queue.Queue):
+        self.name = name
+        self.chat = chat
+        self.results = results
+        self.progressed = threading.Event()  # first token arrived, or the call ended
+        self.cancelled = False
+        self.ttft = None
+        # Run in a copy of the caller's context so the request deadline applies to this call too
+        context = contextvars.copy_context()
+        self.thread = threading.Thread(target=context.run, args=(self._run,), name=f"hedge-{name}", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        started = time.perf_counter()
+        parts = []
+        response = None
+        try:
+            for response, chunk in self.chat.stream():
+                # Leaving the loop closes the stream, which cancels the losing call upstream
+                if self.cancelled:
+                    return
+                if chunk.content and self.ttft is None:
+                    self.ttft = time.perf_counter() - started
+                    self.progressed.set()
+                parts.append(chunk.content)
+            self.results.put((self, response, "".join(parts), None))
+        except Exception as e:
+            self.results.put((self, None, None, e))
+        finally:
+            self.progressed.set()
+
+
+def hedged_call(chat, make_backup_chat: Callable[[], object], model: str, policy: HedgePolicy) -> HedgedResult:
+    """
+    Stream a call, and fire a backup if no token arrived by the hedge deadline.
+
+    The first attempt to finish successfully wins and the other one is
+    cancelled. If every attempt fails, the first error is raised.
+
+    Args:
+        chat: Chat for the primary attempt
+        make_backup_chat: Builds an identical chat for the backup attempt
+        model: Model the chats run on, used for the TTFT statistics
+        policy: Hedge deadline settings and TTFT samples
+    """
+    deadline = policy.deadline(model)
+    results = queue.Queue()
+    attempts = [_Attempt("primary", chat, results)]
+    if not attempts[0].progressed.wait(deadline):
+        attempts.append(_Attempt("backup", make_backup_chat(), results))
+
+    errors = []
+    while len(errors) < len(attempts):
+        attempt, response, content, error = results.get()
+        if error is not None:
+            errors.append(error)
+            continue
+        for other in attempts:
+            if other is not attempt:
+                other.cancelled = True
+        if attempt.ttft is not None:
+            policy.ttft.observe(model, attempt.ttft)
+        if attempt is not attempts[0]:
+            # The primary was at least this slow; leaving it out would drag the percentile down
+            policy.ttft.observe(model, attempts[0].ttft or deadline)
+        return HedgedResult(response, content, attempt.ttft, attempt.name, len(attempts) > 1, deadline)
+
+    raise errors[0]
+
+
+def call_model(chat, make_backup_chat: Callable[[], object], model: str, policy: HedgePolicy) -> HedgedResult:
+    """
+    Run chat.sample(), or a hedged streamed call when the policy is enabled.
+
+    Without hedging the result has no ttft, since the first token arrives
+    with the whole answer.
+    """
+    if policy.enabled:
+        return hedged_call(chat, make_backup_chat, model, policy)
+    response = chat.sample()
+    return HedgedResult(response, response.content, None, "primary", False, 0.0)
@@ -0,0 +1,313 @@
+# Deadlines, retries and a circuit breaker for upstream model calls
+# The request's deadline travels in a context variable down to the gRPC call
+
+import os
+import sys
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+# Absolute time.monotonic() by which the current request must be done, if any
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+# gRPC status codes (by name) worth another attempt; anything else (bad request, auth, ...)
+# fails the same way again
+RETRYABLE_CODES = frozenset({"UNAVAILABLE", "RESOURCE_EXHAUSTED", "ABORTED", "INTERNAL"})
+
+
+class DeadlineExceeded(Exception):
+    """The request ran out of time before or during an upstream call."""
+
+
+class CircuitOpenError(Exception):
+    """The circuit breaker is open, so the upstream call was not attempted."""
+
+
+@contextmanager
+def deadline_scope(seconds: Optional[float]):
+    """Give the calls inside the block at most `seconds` (None leaves any outer deadline alone)."""
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    outer = request_deadline.get()
+    token = request_deadline.set(deadline if outer is None else min(outer, deadline))
+    try:
+        yield
+    finally:
+        request_deadline.reset(token)
+
+
+def remaining_time() -> Optional[float]:
+    """Seconds left until the current deadline, or None without one."""
+    deadline = request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def rpc_status(error: BaseException) -> Optional[str]:
+    """Name of the gRPC status code of an upstream error, or None for any other exception."""
+    # grpc is only imported along with a client; if it isn't loaded, no error can come from it
+    grpc = sys.modules.get("grpc")
+    if grpc is None or not isinstance(error, grpc.RpcError) or not hasattr(error, "code"):
+        return None
+    return error.code().name
+
+
+def is_retryable(error: BaseException) -> bool:
+    return rpc_status(error) in RETRYABLE_CODES
+
+
+def is_deadline_error(error: BaseException) -> bool:
+    return isinstance(error, DeadlineExceeded) or rpc_status(error) == "DEADLINE_EXCEEDED"
+
+
+class CircuitBreaker:
+    """
+    Stop calling an upstream that keeps failing, and probe it again later.
+
+    Closed: calls go through and outcomes are tracked over the last `window`
+    calls. Once at least min_calls were seen and the failure rate reaches
+    failure_threshold, the breaker opens and calls fail immediately with
+    CircuitOpenError. After open_seconds one probe call is let through
+    (half-open): success closes the breaker, failure opens it again.
+
+    Args:
+        failure_threshold: Failure rate that opens the breaker
+        window: Number of recent calls the rate is computed over
+        min_calls: Calls needed in the window before the breaker can open
+        open_seconds: How long to fail fast before probing
+    """
+
+    def __init__(self, failure_threshold: float = 0.5, window: int = 20, min_calls: int = 10, open_seconds: float = 15.0):
+        self.failure_threshold = failure_threshold
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self._outcomes = deque(maxlen=window)
+        self._state = "closed"
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_env(cls) -> "CircuitBreaker":
+        """Build a breaker from the BREAKER_* environment variables."""
+        return cls(
+            failure_threshold=float(os.getenv("BREAKER_FAILURE_THRESHOLD", "0.5")),
+            window=int(os.getenv("BREAKER_WINDOW", "20")),
+            min_calls=int(os.getenv("BREAKER_MIN_CALLS", "10")),
+            open_seconds=float(os.getenv("BREAKER_OPEN_SECONDS", "15"))
+        )
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def call(self, fn: Callable[[], T]) -> T:
+        """Run fn unless the breaker is open, and record whether it failed."""
+        probe = self.before_call()
+        try:
+            result = fn()
+        except BaseException as e:
+            self.after_call(probe, e)
+            raise
+        self.after_call(probe)
+        return result
+
+    async def call_async(self, fn: Callable[[], Awaitable[T]]) -> T:
+        """call() for coroutine functions. A call cancelled midway isn't counted either way."""
+        import asyncio
+        probe = self.before_call()
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            self.cancel_call(probe)
+            raise
+        except BaseException as e:
+            self.after_call(probe, e)
+            raise
+        self.after_call(probe)
+        return result
+
+    def before_call(self) -> bool:
+        """
+        Ask to make a call, for callers that can't wrap it in call() (e.g. streams).
+
+        Returns:
+            True if this call is the half-open probe; pass it to after_call
+
+        Raises:
+            CircuitOpenError: if the call must not be made
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == "open" or (state == "half_open" and self._probing):
+                self.rejected += 1
+                raise CircuitOpenError("Upstream is failing, not calling it for now")
+            if state == "half_open":
+                self._probing = True
+                return True
+            return False
+
+    def after_call(self, probe: bool, error: Optional[BaseException] = None):
+        """Record the outcome of a call allowed by before_call."""
+        # Only upstream trouble counts; other errors say nothing about the API
+        self._record(success=error is None or not self._counts_as_failure(error), probe=probe)
+
+    def cancel_call(self, probe: bool):
+        """Forget a call allowed by before_call that was abandoned (e.g. its client went away) before it finished."""
+        if probe:
+            with self._lock:
+                # Says nothing about the upstream; the next call may probe instead
+                self._probing = False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            failures = sum(1 for ok in self._outcomes if not ok)
+            return {
+                "state": self._current_state(),
+                "window_calls": len(self._outcomes),
+                "window_failures": failures,
+                "opened": self.opened,
+                "rejected": self.rejected
+            }
+
+    @staticmethod
+    def _counts_as_failure(error: BaseException) -> bool:
+        # Upstream errors and upstream timeouts; not DeadlineExceeded, raised before any call was made
+        return rpc_status(error) is not None
+
+    def _current_state(self) -> str:
+        # Caller must hold the lock
+        if self._state == "open" and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._state = "half_open"
+            self._probing = False
+        return self._state
+
+    def _record(self, success: bool, probe: bool):
+        with self._lock:
+            if probe:
+                self._probing = False
+                if success:
+                    self._state = "closed"
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+
+            self._outcomes.append(success)
+            failures = sum(1 for ok in self._outcomes if not ok)
+            if (self._state == "closed" and len(self._outcomes) >= self.min_calls
+                    and failures / len(self._outcomes) >= self.failure_threshold):
+                self._open()
+
+    def _open(self):
+        # Caller must hold the lock
+        self._state = "open"
+        self._opened_at = time.monotonic()
+        self.opened += 1
+
+
+class RetryPolicy:
+    """
+    Bounded retries with full-jitter exponential backoff, within the current deadline.
+
+    A retry only happens if the error is retryable and the backoff plus
+    min_attempt_seconds still fits in the time left.
+
+    Args:
+        max_attempts: Total attempts, including the first
+        base_delay: Backoff before the first retry (doubles every attempt)
+        max_delay: Upper bound on the backoff
+        min_attempt_seconds: Least time worth starting another attempt with
+    """
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.2, max_delay: float = 2.0, min_attempt_seconds: float = 1.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.min_attempt_seconds = min_attempt_seconds
+        self._random = random.Random()
+        self.retries = 0
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        """Build a policy from the UPSTREAM_* environment variables."""
+        return cls(
+            max_attempts=int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "3")),
+            base_delay=float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.2")),
+            max_delay=float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "2.0"))
+        )
+
+    def backoff(self, attempt: int) -> float:
+        return self._random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+def resilient_call(fn: Callable[[], T], breaker: Optional[CircuitBreaker] = None,
+                   retry: Optional[RetryPolicy] = None) -> Tuple[T, int]:
+    """
+    Call fn through the circuit breaker, retrying transient failures while the deadline allows.
+
+    Returns:
+        (result, attempts)
+
+    Raises:
+        CircuitOpenError: the breaker is open
+        DeadlineExceeded: the deadline passed before an attempt could start
+        Exception: the last error from fn
+    """
+    retry = retry or RetryPolicy(max_attempts=1)
+    attempt = 0
+    while True:
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded("Request deadline passed before the upstream call")
+        try:
+            result = breaker.call(fn) if breaker is not None else fn()
+            return result, attempt + 1
+        except Exception as e:
+            attempt += 1
+            if attempt >= retry.max_attempts or not is_retryable(e):
+                raise
+            delay = retry.backoff(attempt - 1)
+            remaining = remaining_time()
+            if remaining is not None and remaining < delay + retry.min_attempt_seconds:
+                raise
+            retry.retries += 1
+            time.sleep(delay)
+
+
+async def resilient_call_async(fn: Callable[[], Awaitable[T]], breaker: Optional[CircuitBreaker] = None,
+                               retry: Optional[RetryPolicy] = None) -> Tuple[T, int]:
+    """resilient_call for coroutine functions: the backoff is an asyncio.sleep, so it doesn't hold a thread."""
+    # asyncio takes a while to import, and the command-line scripts never need it
+    import asyncio
+    retry = retry or RetryPolicy(max_attempts=1)
+    attempt = 0
+    while True:
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded("Request deadline passed before the upstream call")
+        try:
+            result = await (breaker.call_async(fn) if breaker is not None else fn())
+            return result, attempt + 1
+        except Exception as e:
+            attempt += 1
+            if attempt >= retry.max_attempts or not is_retryable(e):
+                raise
+            delay = retry.backoff(attempt - 1)
+            remaining = remaining_time()
+            if remaining is not None and remaining < delay + retry.min_attempt_seconds:
+                raise
+            retry.retries += 1
+            await asyncio.sleep(delay)
@@ -0,0 +1,335 @@
+# Near-duplicate cache for reply suggestions
+# MinHash signatures of the last few turns in an LSH index, so conversations that only differ
+# in order numbers, names or punctuation can reuse each other's suggestions
+
+import re
+import json
+import struct
+import hashlib
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Slots: values that differ between otherwise identical conversations. They are
+# normalized away for matching and substituted back into reused suggestions
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+_ID = re.compile(r"\b[A-Za-z]{0,4}-?\d{3,}[A-Za-z0-9-]*\b")
+_NON_WORD = re.compile(r"[^\w<>\s]+")
+_MARKER = re.compile(r"⟦(\d+)⟧")
+
+class SimilarMatch:
+    """A cached response for a similar conversation, with this conversation's slots filled in."""
+
+    def __init__(self, result: Dict, similarity: float):
+        self.result = result
+        self.similarity = similarity
+
+
+class _Entry:
+    __slots__ = ("signature", "band_keys", "kinds", "last", "template", "expires_at", "size")
+
+    def __init__(self, signature, band_keys, kinds, last, template, expires_at, size):
+        self.signature = signature
+        self.band_keys = band_keys
+        self.kinds = kinds
+        self.last = last
+        self.template = template
+        self.expires_at = expires_at
+        self.size = size
+
+
+def extract_slots(turns: List[Dict[str, str]], user_name: str) -> List[Tuple[str, str]]:
+    """
+    (kind, value) of every slot in the turns, in order of first appearance.
+
+    Kinds are "me" (the user's name), "name" (other participants), "email" and "id"
+    (order numbers, ticket ids and other numbers of three or more digits).
+    """
+    slots = [("me", user_name)] if user_name else []
+    seen = {user_name}
+    for msg in turns:
+        sender = str(msg.get('sender', ''))
+        if sender and sender not in seen:
+            seen.add(sender)
+            slots.append(("name", sender))
+    for msg in turns:
+        text = str(msg.get('message', ''))
+        emails = _EMAIL.findall(text)
+        # Drop the e-mail addresses first so digits inside them aren't picked up as ids
+        ids = _ID.findall(_EMAIL.sub(" ", text))
+        for kind, values in (("email", emails), ("id", ids)):
+            for value in values:
+                if value not in seen:
+                    seen.add(value)
+                    slots.append((kind, value))
+    return slots
+
+
+def _text_fields(result: Dict) -> Iterator[Tuple[Dict, str]]:
+    """(dict, key) of every string in the suggestions and the conversation analysis of a response."""
+    data = result.get("data")
+    if not isinstance(data, dict):
+        return
+    sections = list(data.get("suggestions") or [])
+    sections.append(data.get("conversation_analysis"))
+    for fields in sections:
+        if isinstance(fields, dict):
+            for key, value in fields.items():
+                if isinstance(value, str):
+                    yield fields, key
+
+
+def _slot_pattern(values: List[str]) -> Optional["re.Pattern"]:
+    if not values:
+        return None
+    # Longest first, so "A-1234" wins over "1234"
+    alternatives = "|".join(re.escape(value) for value in sorted(values, key=len, reverse=True))
+    return re.compile(rf"(?<!\w)(?:{alternatives})(?!\w)")
+
+
+class SimilarityCache:
+    """
+    Reuse suggestions across near-identical conversations.
+
+    The last `turns` messages are normalized (senders become <me>/<them>,
+    names, e-mails and ids become placeholders, punctuation and case are
+    dropped) and split into word shingles. A MinHash signature of the
+    shingles estimates Jaccard similarity; LSH banding finds candidates
+    with a few dict lookups, so a lookup costs the same at 100 or 100,000
+    entries. A candidate is used when its estimated similarity reaches
+    `threshold`, it has the same kinds of slots in the same order, and its
+    newest message normalizes to exactly the same tokens: shared earlier
+    turns can outweigh a last message that asks for the opposite thing,
+    and that message is the one the suggestions answer.
+
+    The suggestion and analysis text of stored responses keeps its slot
+    values as placeholders and gets the new conversation's values on the
+    way out, so a reply about order #1234 for Alice comes back about order
+    #5678 for Bob. The rest of the response (prompt sizes, routing) is
+    returned as it was stored.
+
+    Entries expire after ttl_seconds, and the least recently used ones are
+    evicted past max_entries or max_bytes.
+
+    Args:
+        threshold: Least estimated Jaccard similarity that counts as a hit
+        turns: How many of the last messages are compared
+        shingle_size: Words per shingle
+        num_perm: MinHash signature length
+        bands: LSH bands (num_perm must be a multiple)
+        max_entries: Most entries kept
+        max_bytes: Approximate memory cap for the stored responses and signatures
+        ttl_seconds: How long an entry stays usable
+        max_candidates: Most candidates compared per lookup
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        turns: int = 4,
+        shingle_size: int = 3,
+        num_perm: int = 64,
+        bands: int = 16,
+        max_entries: int = 100000,
+        max_bytes: int = 128 * 1024 * 1024,
+        ttl_seconds: float = 3600.0,
+        max_candidates: int = 32
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.turns = turns
+        self.shingle_size = shingle_size
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.max_candidates = max_candidates
+        self._row = struct.Struct(f"<{num_perm}I")
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._buckets: List[Dict[int, set]] = [{} for _ in range(bands)]
+        self._next_id = 0
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, conversation_history: List[Dict[str, str]], user_name: str) -> Optional[SimilarMatch]:
+        """Return the response of the most similar cached conversation, or None."""
+        turns = conversation_history[-self.turns:]
+        slots = extract_slots(turns, user_name)
+        signature = self._signature(turns, user_name, slots)
+        if signature is None:
+            return None
+        kinds = tuple(kind for kind, _ in slots)
+        last = self._last_key(turns, user_name, slots)
+        band_keys = self._band_keys(signature)
+
+        now = time.monotonic()
+        best, best_similarity = None, 0.0
+        with self._lock:
+            candidates = set()
+            for band, key in enumerate(band_keys):
+                for entry_id in self._buckets[band].get(key, ()):
+                    candidates.add(entry_id)
+                    if len(candidates) >= self.max_candidates:
+                        break
+                if len(candidates) >= self.max_candidates:
+                    break
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                if entry.expires_at <= now:
+                    self._remove(entry_id)
+                    self.expirations += 1
+                    continue
+                similarity = sum(a == b for a, b in zip(signature, entry.signature)) / self.num_perm
+                if similarity > best_similarity and entry.kinds == kinds and entry.last == last:
+                    best_id, best, best_similarity = entry_id, entry, similarity
+
+            if best is None or best_similarity < self.threshold:
+                if candidates:
+                    self.rejected += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_id)
+            template = best.template
+
+        try:
+            result = self._fill(template, slots)
+        except (ValueError, LookupError):
+            # A template that can't be filled is no use to this conversation
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return SimilarMatch(result, round(best_similarity, 3))
+
+    def set(self, conversation_history: List[Dict[str, str]], user_name: str, result: Dict):
+        """Index a successful response under its conversation."""
+        turns = conversation_history[-self.turns:]
+        slots = extract_slots(turns, user_name)
+        signature = self._signature(turns, user_name, slots)
+        if signature is None:
+            return
+        template = self._template(result, slots)
+        # Response text, the packed signature, the last-message digest and the band keys with their bucket slots
+        size = len(template.encode("utf-8")) + 4 * self.num_perm + 48 * self.bands + 340
+        if size > self.max_bytes:
+            return
+        band_keys = self._band_keys(signature)
+
+        with self._lock:
+            entry_id = self._next_id
+            self._next_id += 1
+            # Packed as 32-bit values: a tuple of int objects would take eight times the memory
+            self._entries[entry_id] = _Entry(array("I", signature), band_keys, tuple(kind for kind, _ in slots),
+                                             self._last_key(turns, user_name, slots), template,
+                                             time.monotonic() + self.ttl_seconds, size)
+            self._bytes += size
+            for band, key in enumerate(band_keys):
+                self._buckets[band].setdefault(key, set()).add(entry_id)
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every entry, keeping the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._buckets = [{} for _ in range(self.bands)]
+            self._bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "threshold": self.threshold,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "rejected": self.rejected,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+    def normalize(self, turns: List[Dict[str, str]], user_name: str, slots: List[Tuple[str, str]]) -> List[str]:
+        """Tokens of the turns with senders as <me>/<them> and slot values as <kind> placeholders."""
+        # Names come from a handful of senders, so their pattern stays in re's cache;
+        # e-mails and ids, which change every time, use the precompiled patterns
+        names = _slot_pattern([value for kind, value in slots if kind in ("me", "name")])
+        tokens = []
+        for msg in turns:
+            tokens.append("<me>" if msg.get('sender') == user_name else "<them>")
+            text = _ID.sub(" <id> ", _EMAIL.sub(" <email> ", str(msg.get('message', ''))))
+            if names is not None:
+                text = names.sub(" <name> ", text)
+            tokens.extend(_NON_WORD.sub(" ", text.lower()).split())
+        return tokens
+
+    def _signature(self, turns: List[Dict[str, str]], user_name: str,
+                   slots: List[Tuple[str, str]]) -> Optional[Tuple[int, ...]]:
+        tokens = self.normalize(turns, user_name, slots)
+        size = self.shingle_size
+        if len(tokens) < size:
+            return None
+        shingles = {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+        # One SHAKE digest gives num_perm independent 32-bit hashes per shingle; the
+        # signature is their column-wise minimum, all of it done in C
+        length = 4 * self.num_perm
+        rows = [self._row.unpack(hashlib.shake_128(shingle.encode("utf-8")).digest(length)) for shingle in shingles]
+        return tuple(map(min, *rows)) if len(rows) > 1 else rows[0]
+
+    def _last_key(self, turns: List[Dict[str, str]], user_name: str, slots: List[Tuple[str, str]]) -> bytes:
+        # Digest of the newest message's normalized tokens, sender included
+        tokens = self.normalize(turns[-1:], user_name, slots)
+        return hashlib.blake2b(" ".join(tokens).encode("utf-8"), digest_size=8).digest()
+
+    def _band_keys(self, signature: Tuple[int, ...]) -> List[int]:
+        rows = self.rows
+        return [hash(signature[i:i + rows]) for i in range(0, self.num_perm, rows)]
+
+    @staticmethod
+    def _template(result: Dict, slots: List[Tuple[str, str]]) -> str:
+        # Only the suggestion and analysis text gets markers: keys, prompt sizes and routing
+        # numbers stay as they are even when they look like an id from the conversation
+        template = json.loads(json.dumps(result))
+        # The user's own name is left alone: with the default "You" it would match every "You" in the replies
+        slots = [(i, value) for i, (kind, value) in enumerate(slots) if kind != "me"]
+        pattern = _slot_pattern([value for _, value in slots])
+        if pattern is not None:
+            markers = {value: f"⟦{i}⟧" for i, value in slots}
+            for fields, key in _text_fields(template):
+                fields[key] = pattern.sub(lambda m: markers[m.group(0)], fields[key])
+        return json.dumps(template, ensure_ascii=False, separators=(",", ":"))
+
+    @staticmethod
+    def _fill(template: str, slots: List[Tuple[str, str]]) -> Dict:
+        result = json.loads(template)
+        for fields, key in _text_fields(result):
+            if "⟦" in fields[key]:
+                fields[key] = _MARKER.sub(lambda m: slots[int(m.group(1))][1], fields[key])
+        return result
+
+    def _remove(self, entry_id: int):
+        # Caller must hold the lock
+        entry = self._entries.pop(entry_id)
+        self._bytes -= entry.size
+        for band, key in enumerate(entry.band_keys):
+            bucket = self._buckets[band].get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[band][key]
@@ -0,0 +1,164 @@
+# Single-flight coalescing of identical in-flight calls
+# The first caller for a key does the work, concurrent duplicates wait for its result
+
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls with the same key into one.
+
+    The first caller for a key (the leader) runs the function. Callers that
+    arrive while it is running wait for the same result instead of starting
+    their own call. Waiting is the only thing a duplicate does, so a waiter
+    that gives up (wait_timeout) or goes away never affects the shared call
+    or the other waiters.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+
+    def do(self, key: str, fn: Callable[[], Any], wait_timeout: Optional[float] = None) -> Tuple[Any, bool]:
+        """
+        Run fn once for all concurrent callers with the same key.
+
+        Args:
+            key: Identity of the call
+            fn: Zero-argument function doing the work
+            wait_timeout: How long a duplicate waits before giving up
+
+        Returns:
+            (result, shared) where shared is True for callers that reused
+            another caller's in-flight result
+
+        Raises:
+            TimeoutError: if a duplicate gave up waiting
+            Exception: whatever fn raised, for the leader and every waiter
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+                leader = True
+            else:
+                call.waiters += 1
+                self.coalesced += 1
+                leader = False
+
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        elif not call.done.wait(wait_timeout):
+            with self._lock:
+                self.abandoned += 1
+            raise TimeoutError("Timed out waiting for an identical in-flight request")
+
+        if call.error is not None:
+            raise call.error
+        return call.result, not leader
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "abandoned": self.abandoned
+            }
+
+
+class _AsyncCall:
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class AsyncSingleFlight:
+    """
+    SingleFlight for coroutines on one event loop.
+
+    The leader's function runs in a task of its own that every caller
+    awaits, so a caller that is cancelled (its client disconnected) doesn't
+    take the shared call down with it. Once every caller of a call is gone
+    nobody wants the result any more, and the call itself is cancelled.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _AsyncCall] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.abandoned = 0
+        self.cancelled = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]], wait_timeout: Optional[float] = None) -> Tuple[Any, bool]:
+        """
+        Run fn once for all concurrent callers with the same key.
+
+        Same contract as SingleFlight.do, with fn a coroutine function.
+        The call runs in the leader's context (e.g. its deadline).
+        """
+        import asyncio
+        call = self._calls.get(key)
+        leader = call is None
+        if leader:
+            call = self._calls[key] = _AsyncCall(asyncio.ensure_future(fn()))
+            call.task.add_done_callback(lambda task: self._forget(key, call))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+
+        call.waiters += 1
+        try:
+            done, _ = await asyncio.wait({call.task}, timeout=None if leader else wait_timeout)
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                # Unlisted before it's cancelled: a task can take a while to unwind, and a
+                # caller arriving meanwhile must start a call of its own instead of joining this one
+                self._forget(key, call)
+                call.task.cancel()
+                self.cancelled += 1
+        if not done:
+            self.abandoned += 1
+            raise TimeoutError("Timed out waiting for an identical in-flight request")
+        return call.task.result(), not leader
+
+    def _forget(self, key: str, call: _AsyncCall):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def stats(self) -> Dict:
+        return {
+            "in_flight": len(self._calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+            "cancelled": self.cancelled
+        }
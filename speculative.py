@@ -0,0 +1,167 @@
+# Speculative pre-generation of reply suggestions
+# Starts generating as soon as the other party's message arrives, so /suggest finds the answer ready
+
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict
+
+
+class _Run:
+    def __init__(self, key: str):
+        self.key = key
+        self.state = "pending"  # pending -> running -> finished, or cancelled
+        self.used = False
+
+
+class SpeculativeRunner:
+    """
+    Run suggestion generation ahead of the user's request.
+
+    Each scope (a shared conversation) has at most one live speculative run.
+    A newer message supersedes it: a run still waiting out the debounce is
+    cancelled for free, a run that already reached the model is counted as
+    wasted unless its result was used. Wasted runs are capped per time
+    window, and at most max_in_flight runs talk to the model at once.
+
+    Args:
+        run_fn: Function doing the work; it should leave its result where the
+            normal request path finds it (cache / in-flight coalescing)
+        max_in_flight: Concurrent speculative model calls
+        debounce: Seconds to wait for follow-up messages before starting
+        max_wasted: Wasted runs allowed per waste_window before pausing
+        waste_window: Length of the waste window in seconds
+    """
+
+    def __init__(
+        self,
+        run_fn: Callable,
+        max_in_flight: int = 2,
+        debounce: float = 0.5,
+        max_wasted: int = 30,
+        waste_window: float = 3600.0
+    ):
+        self.run_fn = run_fn
+        self.debounce = debounce
+        self.max_wasted = max_wasted
+        self.waste_window = waste_window
+        self._slots = threading.Semaphore(max_in_flight)
+        self._runs: Dict[str, _Run] = {}
+        self._by_key: Dict[str, _Run] = {}
+        self._wasted_at = deque()
+        self._lock = threading.Lock()
+        # Set on speculative threads so run_fn's own lookups don't count as uses
+        self._local = threading.local()
+        self.started = 0
+        self.used = 0
+        self.wasted = 0
+        self.cancelled = 0
+        self.skipped_busy = 0
+        self.skipped_budget = 0
+
+    def trigger(self, scope: str, key: str, *args, **kwargs) -> bool:
+        """
+        Start speculating on a new conversation state.
+
+        Args:
+            scope: Conversation the state belongs to; older runs in it are superseded
+            key: Identity of the result (the cache key)
+            *args, **kwargs: Passed to run_fn
+
+        Returns:
+            True if a run was scheduled
+        """
+        with self._lock:
+            previous = self._runs.get(scope)
+            if previous is not None and previous.key == key and previous.state != "cancelled":
+                return False
+            if previous is not None:
+                self._supersede(previous)
+
+            if self._waste_budget_exhausted():
+                self.skipped_budget += 1
+                self._runs.pop(scope, None)
+                return False
+
+            run = _Run(key)
+            self._runs[scope] = run
+            self._by_key[key] = run
+
+        timer = threading.Timer(self.debounce, self._run, args=(scope, run, args, kwargs))
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def mark_used(self, key: str) -> bool:
+        """Record that a request asked for a speculated state. Returns True if one existed."""
+        if getattr(self._local, "speculating", False):
+            return False
+        with self._lock:
+            run = self._by_key.get(key)
+            if run is None or run.state == "cancelled":
+                return False
+            if not run.used:
+                run.used = True
+                self.used += 1
+            return True
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._waste_budget_exhausted()
+            return {
+                "started": self.started,
+                "used": self.used,
+                "wasted": self.wasted,
+                "cancelled": self.cancelled,
+                "skipped_busy": self.skipped_busy,
+                "skipped_budget": self.skipped_budget,
+                "wasted_in_window": len(self._wasted_at),
+                "max_wasted": self.max_wasted
+            }
+
+    def _run(self, scope: str, run: _Run, args, kwargs):
+        with self._lock:
+            if run.state != "pending":
+                return
+            if not self._slots.acquire(blocking=False):
+                run.state = "cancelled"
+                self._forget(scope, run)
+                self.skipped_busy += 1
+                return
+            run.state = "running"
+            self.started += 1
+
+        self._local.speculating = True
+        try:
+            self.run_fn(*args, **kwargs)
+        except Exception as e:
+            print(f"Speculative generation failed: {e}")
+        finally:
+            self._local.speculating = False
+            self._slots.release()
+            with self._lock:
+                run.state = "finished"
+
+    def _supersede(self, run: _Run):
+        # Caller must hold the lock
+        if run.state == "pending":
+            run.state = "cancelled"
+            self.cancelled += 1
+        elif not run.used:
+            self.wasted += 1
+            self._wasted_at.append(time.monotonic())
+        self._by_key.pop(run.key, None)
+
+    def _forget(self, scope: str, run: _Run):
+        # Caller must hold the lock
+        if self._runs.get(scope) is run:
+            del self._runs[scope]
+        if self._by_key.get(run.key) is run:
+            del self._by_key[run.key]
+
+    def _waste_budget_exhausted(self) -> bool:
+        # Caller must hold the lock
+        cutoff = time.monotonic() - self.waste_window
+        while self._wasted_at and self._wasted_at[0] < cutoff:
+            self._wasted_at.popleft()
+        return len(self._wasted_at) >= self.max_wasted
@@ -0,0 +1,109 @@
+# Incremental parser for streamed suggestion JSON
+# Emits each suggestion and the analysis as soon as its object is complete
+
+import json
+from typing import List, Tuple, Dict, Any
+
+
+class IncrementalSuggestionParser:
+    """
+    Parse a suggestions JSON document as it arrives chunk by chunk.
+
+    The model writes a single object of the form
+    {"suggestions": [{...}, {...}], "conversation_analysis": {...}}.
+    Instead of waiting for the whole document, the parser tracks nesting and
+    string state over the raw text and hands back every suggestion object and
+    the analysis object the moment its closing brace arrives.
+    """
+
+    def __init__(self, list_key: str = "suggestions", object_keys: Tuple[str, ...] = ("conversation_analysis",)):
+        self.list_key = list_key
+        self.object_keys = object_keys
+        self._buffer: List[str] = []
+        self._length = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_key = None
+        self._capture_start = None
+        self._capture_depth = 0
+        self._capture_key = None
+
+    @property
+    def text(self) -> str:
+        """Everything fed so far."""
+        return "".join(self._buffer)
+
+    def feed(self, chunk: str) -> List[Tuple[str, Dict[str, Any]]]:
+        """
+        Consume the next piece of model output.
+
+        Args:
+            chunk: Newly received text
+
+        Returns:
+            List of (key, object) pairs completed by this chunk, where key is
+            the list key for suggestions or one of the object keys
+        """
+        if not chunk:
+            return []
+
+        offset = self._length
+        self._buffer.append(chunk)
+        self._length += len(chunk)
+        completed = []
+
+        for i, ch in enumerate(chunk):
+            pos = offset + i
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if len(self._stack) == 1 and self._stack[0] == "{":
+                        # Strings at the top level are keys (or scalar values,
+                        # which are always followed by the next key anyway)
+                        self._last_key = self._slice(self._string_start + 1, pos)
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                self._string_start = pos
+            elif ch in "{[":
+                self._stack.append(ch)
+                if self._capture_start is None and ch == "{":
+                    if len(self._stack) == 3 and self._stack[1] == "[" and self._last_key == self.list_key:
+                        self._start_capture(pos, self.list_key)
+                    elif len(self._stack) == 2 and self._last_key in self.object_keys:
+                        self._start_capture(pos, self._last_key)
+            elif ch in "}]":
+                if not self._stack:
+                    continue
+                depth = len(self._stack)
+                self._stack.pop()
+                if self._capture_start is not None and depth == self._capture_depth:
+                    raw = self._slice(self._capture_start, pos + 1)
+                    key = self._capture_key
+                    self._capture_start = None
+                    try:
+                        completed.append((key, json.loads(raw)))
+                    except json.JSONDecodeError:
+                        # Leave malformed objects to the final full parse
+                        pass
+
+        return completed
+
+    def _start_capture(self, pos: int, key: str):
+        self._capture_start = pos
+        self._capture_depth = len(self._stack)
+        self._capture_key = key
+
+    def _slice(self, start: int, end: int) -> str:
+        # Collapse the buffer so slicing by absolute position stays cheap
+        if len(self._buffer) > 1:
+            self._buffer = ["".join(self._buffer)]
+        return self._buffer[0][start:end]
@@ -0,0 +1,74 @@
+# Pydantic models for structured reply suggestions
+# Kept out of app_structured.py so its command line doesn't import pydantic before it needs to
+
+from functools import lru_cache
+from typing import List, Optional, Literal, Tuple, Type
+from pydantic import BaseModel, Field, create_model
+
+from suggestion_options import DEFAULT_COUNT, MAX_COUNT, TONES
+
+
+class ReplySuggestion(BaseModel):
+    """Model for a single reply suggestion"""
+    reply: str = Field(description="The suggested reply text")
+    tone: Literal[TONES] = Field(
+        description="The tone of the reply"
+    )
+    confidence: float = Field(
+        description="Confidence score for this suggestion (0-1)",
+        ge=0.0,
+        le=1.0
+    )
+    context_notes: Optional[str] = Field(
+        description="Brief notes about why this reply is appropriate",
+        default=None
+    )
+
+
+class ReplyResponses(BaseModel):
+    """Model for the complete response containing multiple suggestions"""
+    suggestions: List[ReplySuggestion] = Field(
+        description="List of reply suggestions",
+        min_length=1,
+        max_length=MAX_COUNT
+    )
+    conversation_summary: str = Field(
+        description="Brief summary of the conversation context"
+    )
+    primary_intent: str = Field(
+        description="The primary intent detected in the last message"
+    )
+
+
+class ReplySuggestions(BaseModel):
+    """Model for replacement suggestions, without the analysis the caller already has"""
+    suggestions: List[ReplySuggestion] = Field(
+        description="List of reply suggestions",
+        min_length=1,
+        max_length=MAX_COUNT
+    )
+
+
+@lru_cache(maxsize=None)
+def reply_responses_model(count: int = DEFAULT_COUNT, tones: Optional[Tuple[str, ...]] = None,
+                          with_analysis: bool = True) -> Type[BaseModel]:
+    """
+    ReplyResponses (or ReplySuggestions without the analysis) constrained to
+    exactly `count` suggestions in the given tones.
+
+    Used as the native response format too, so the API enforces the count
+    and tones. One subclass is built per combination and reused.
+    """
+    base = ReplyResponses if with_analysis else ReplySuggestions
+    suggestion = ReplySuggestion
+    if tones is not None:
+        suggestion = create_model(
+            "ReplySuggestion",
+            __base__=ReplySuggestion,
+            tone=(Literal[tones], Field(description="The tone of the reply"))
+        )
+    return create_model(
+        base.__name__,
+        __base__=base,
+        suggestions=(List[suggestion], Field(description="List of reply suggestions", min_length=count, max_length=count))
+    )
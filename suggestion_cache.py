@@ -0,0 +1,131 @@
+# Response cache for reply suggestions
+# Bounded LRU with a per-entry TTL, keyed on the normalized conversation
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Optional, Tuple
+
+
+def normalize_conversation(conversation_history: List[Dict[str, str]]) -> List[Tuple[str, str]]:
+    """
+    Reduce a conversation to its (sender, message) pairs.
+
+    Extra keys are dropped and whitespace is collapsed so that requests which
+    only differ in formatting map to the same cache entry.
+    """
+    return [
+        (" ".join(str(msg.get('sender', '')).split()), " ".join(str(msg.get('message', '')).split()))
+        for msg in conversation_history
+    ]
+
+
+def make_cache_key(conversation_history: List[Dict[str, str]], user_name: str, model: str, variant: str = "") -> str:
+    """
+    Build a stable cache key for a suggestion request.
+
+    Args:
+        conversation_history: List of messages with 'sender' and 'message' keys
+        user_name: The person the suggestions are generated for
+        model: The model used to generate the suggestions
+        variant: Anything else the response depends on, e.g. the suggestion count
+            (requests without one keep the keys they always had)
+
+    Returns:
+        Hex digest identifying the request
+    """
+    parts = [model, user_name, normalize_conversation(conversation_history)]
+    if variant:
+        parts.append(variant)
+    payload = json.dumps(
+        parts,
+        ensure_ascii=False,
+        separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SuggestionCache:
+    """Thread-safe LRU cache with a per-entry TTL and a memory cap."""
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 16 * 1024 * 1024, ttl_seconds: float = 300.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        # key -> (expires_at, size_in_bytes, value)
+        self._entries: "OrderedDict[str, Tuple[float, int, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Return the cached value for key, or None on a miss or expired entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, size, value = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Dict, ttl_seconds: Optional[float] = None):
+        """Store value under key, evicting least recently used entries as needed."""
+        size = len(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+        if size > self.max_bytes:
+            # Never let a single oversized entry flush the whole cache
+            return
+
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+            self._entries[key] = (time.monotonic() + ttl, size, value)
+            self._bytes += size
+
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every entry, keeping the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict:
+        """Return hit/miss counters and current usage."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+    def _remove(self, key: str):
+        # Caller must hold the lock
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
@@ -0,0 +1,249 @@
+# Append-only history of suggestion requests and responses
+# Records go to rotating segment files with a small fixed-width index next to each one
+# python suggestion_history.py history/ --conversation <id> --since 2025-01-01 > records.jsonl
+
+import os
+import sys
+import json
+import glob
+import queue
+import struct
+import hashlib
+import argparse
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# Log records: 4-byte big-endian length, then zlib-compressed compact JSON
+_RECORD_HEADER = struct.Struct(">I")
+# Index entries: timestamp, 8-byte hash of the conversation id, offset of the record in the log
+_INDEX_ENTRY = struct.Struct(">dQQ")
+
+
+def conversation_key(conversation_id: Optional[str]) -> int:
+    """64-bit hash of a conversation id as stored in the index (0 for no id)."""
+    if not conversation_id:
+        return 0
+    return int.from_bytes(hashlib.blake2b(conversation_id.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def encode_record(record: Dict) -> bytes:
+    payload = zlib.compress(json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    return _RECORD_HEADER.pack(len(payload)) + payload
+
+
+class SuggestionHistory:
+    """
+    Append-only log of suggestion requests, safe to share between worker processes.
+
+    record() only puts the record on a bounded queue; a background thread
+    encodes and appends it, so callers never wait on the disk. When the queue
+    is full the record is dropped and counted rather than blocking a request.
+
+    Every process writes its own segments (the file name holds the start time
+    and pid), so workers never contend for a file. A segment is closed once it
+    reaches max_segment_bytes. Each segment log has an .idx file with one
+    fixed-width entry per record, which is all read() needs to look at to find
+    records by conversation id or time range.
+
+    Args:
+        directory: Where segments are written
+        max_segment_bytes: Size at which the current segment is rotated
+        max_pending: Records queued for the writer before new ones are dropped
+    """
+
+    def __init__(self, directory: str, max_segment_bytes: int = 64 * 1024 * 1024, max_pending: int = 10000):
+        self.directory = directory
+        self.max_segment_bytes = max_segment_bytes
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._writer = None
+        self._start_lock = threading.Lock()
+        self._log = None
+        self._index = None
+        self._segment_bytes = 0
+        self.written = 0
+        self.dropped = 0
+        self.segments_opened = 0
+
+    def record(self, record: Dict):
+        """Queue a record for writing. Adds a 'ts' timestamp if it has none."""
+        record.setdefault("ts", time.time())
+        self._start_writer()
+        try:
+            self._pending.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout: Optional[float] = None):
+        """Wait until every queued record has been written."""
+        if self._writer is None:
+            return
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._pending.unfinished_tasks:
+            if deadline is not None and time.monotonic() > deadline:
+                break
+            time.sleep(0.005)
+
+    def stats(self) -> Dict:
+        return {
+            "written": self.written,
+            "dropped": self.dropped,
+            "pending": self._pending.qsize(),
+            "segments_opened": self.segments_opened
+        }
+
+    def _start_writer(self):
+        if self._writer is not None:
+            return
+        with self._start_lock:
+            if self._writer is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._writer = threading.Thread(target=self._write_loop, name="suggestion-history", daemon=True)
+                self._writer.start()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._pending.get()]
+            # Drain whatever else is waiting so one flush covers the whole batch
+            while True:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                print(f"Failed to write suggestion history: {e}")
+            finally:
+                for _ in batch:
+                    self._pending.task_done()
+
+    def _write_batch(self, batch: List[Dict]):
+        for record in batch:
+            if self._log is None or self._segment_bytes >= self.max_segment_bytes:
+                self._open_segment()
+            data = encode_record(record)
+            offset = self._segment_bytes
+            self._log.write(data)
+            self._index.write(_INDEX_ENTRY.pack(record["ts"], conversation_key(record.get("conversation_id")), offset))
+            self._segment_bytes += len(data)
+            self.written += 1
+        # The log is flushed first, so an index entry never points past the end of its log
+        self._log.flush()
+        self._index.flush()
+
+    def _open_segment(self):
+        if self._log is not None:
+            self._log.close()
+            self._index.close()
+        name = f"segment-{time.time():017.6f}-{os.getpid()}"
+        path = os.path.join(self.directory, name)
+        self._log = open(path + ".log", "ab")
+        self._index = open(path + ".idx", "ab")
+        self._segment_bytes = 0
+        self.segments_opened += 1
+
+
+def list_segments(directory: str) -> List[str]:
+    """Segment paths without extension, oldest first."""
+    return sorted(path[:-len(".log")] for path in glob.glob(os.path.join(directory, "segment-*.log")))
+
+
+def _segment_start(segment: str) -> float:
+    return float(os.path.basename(segment).split("-")[1])
+
+
+def _read_index(segment: str, chunk_entries: int = 4096) -> Iterator[Tuple[float, int, int]]:
+    try:
+        f = open(segment + ".idx", "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        while True:
+            chunk = f.read(_INDEX_ENTRY.size * chunk_entries)
+            usable = len(chunk) - len(chunk) % _INDEX_ENTRY.size
+            if not usable:
+                return
+            yield from _INDEX_ENTRY.iter_unpack(chunk[:usable])
+            if usable < len(chunk):
+                return
+
+
+def _read_record(f, offset: int) -> Optional[Dict]:
+    f.seek(offset)
+    header = f.read(_RECORD_HEADER.size)
+    if len(header) < _RECORD_HEADER.size:
+        return None
+    (length,) = _RECORD_HEADER.unpack(header)
+    payload = f.read(length)
+    if len(payload) < length:
+        return None
+    return json.loads(zlib.decompress(payload))
+
+
+def read_history(
+    directory: str,
+    conversation_id: Optional[str] = None,
+    since: Optional[float] = None,
+    until: Optional[float] = None
+) -> Iterator[Dict]:
+    """
+    Stream records from a history directory, one at a time.
+
+    Only the index files are scanned; record bodies are read and decoded for
+    matches only. Segments that started after `until` are skipped without
+    being opened. Records come out per segment in write order.
+
+    Args:
+        directory: History directory written by SuggestionHistory
+        conversation_id: Only records for this conversation
+        since: Only records at or after this Unix timestamp
+        until: Only records before this Unix timestamp
+
+    Yields:
+        Record dicts
+    """
+    wanted = conversation_key(conversation_id) if conversation_id else None
+    for segment in list_segments(directory):
+        if until is not None and _segment_start(segment) >= until:
+            continue
+        with open(segment + ".log", "rb") as log:
+            for ts, key, offset in _read_index(segment):
+                if since is not None and ts < since:
+                    continue
+                if until is not None and ts >= until:
+                    continue
+                if wanted is not None and key != wanted:
+                    continue
+                record = _read_record(log, offset)
+                if record is None:
+                    break
+                # The index only holds a hash; rule out collisions
+                if conversation_id and record.get("conversation_id") != conversation_id:
+                    continue
+                yield record
+
+
+def _parse_time(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream suggestion history records as JSON lines")
+    parser.add_argument("directory", help="History directory")
+    parser.add_argument("--conversation", help="Only this conversation id")
+    parser.add_argument("--since", type=_parse_time, help="Unix time or ISO date")
+    parser.add_argument("--until", type=_parse_time, help="Unix time or ISO date")
+    args = parser.parse_args()
+
+    for record in read_history(args.directory, args.conversation, args.since, args.until):
+        sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
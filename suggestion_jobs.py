@@ -0,0 +1,169 @@
+# Background job queue for suggestion requests
+# A bounded queue feeding a fixed-size worker pool, with per-job timings
+
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+
+class SuggestionJobQueue:
+    """
+    Run suggestion work on a fixed number of worker threads.
+
+    Jobs wait in a bounded FIFO queue. Each job records how long it sat in
+    the queue separately from how long the work itself took, which is what
+    we need to size the pool against the upstream rate limit.
+    """
+
+    def __init__(self, worker_fn: Callable[..., Dict], workers: int = 4, max_depth: int = 64, result_ttl: float = 600.0):
+        self.worker_fn = worker_fn
+        self.workers = workers
+        self.max_depth = max_depth
+        self.result_ttl = result_ttl
+        self._queue: "queue.Queue[str]" = queue.Queue(maxsize=max_depth)
+        self._jobs: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._busy = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.total_queue_wait = 0.0
+        self.total_model_time = 0.0
+        self.max_queue_wait = 0.0
+
+    def submit(self, *args, **kwargs) -> str:
+        """
+        Queue a call to worker_fn(*args, **kwargs).
+
+        Returns:
+            The job id
+
+        Raises:
+            QueueFull: if max_depth jobs are already waiting
+        """
+        self._start_workers()
+        job_id = uuid.uuid4().hex
+        job = {
+            "job_id": job_id,
+            "status": "queued",
+            "args": args,
+            "kwargs": kwargs,
+            "queued_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None
+        }
+
+        with self._lock:
+            self._expire_jobs()
+            self._jobs[job_id] = job
+        try:
+            self._queue.put_nowait(job_id)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job_id]
+                self.rejected += 1
+            raise QueueFull(f"Suggestion queue is full ({self.max_depth} jobs waiting)")
+
+        with self._lock:
+            self.submitted += 1
+        return job_id
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        """Return the public status of a job, or None if it is unknown or expired."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return self._describe(job)
+
+    def stats(self) -> Dict:
+        """Return queue depth, pool utilization and timing totals."""
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "busy_workers": self._busy,
+                "queue_depth": self._queue.qsize(),
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "avg_queue_wait_ms": round(1000 * self.total_queue_wait / self.completed, 1) if self.completed else 0.0,
+                "max_queue_wait_ms": round(1000 * self.max_queue_wait, 1),
+                "avg_model_ms": round(1000 * self.total_model_time / self.completed, 1) if self.completed else 0.0
+            }
+
+    def _start_workers(self):
+        # Started on first use so importing the app doesn't spawn threads
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"suggestion-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is None:
+                    continue
+                job["status"] = "running"
+                job["started_at"] = time.time()
+                self._busy += 1
+
+            try:
+                result = self.worker_fn(*job["args"], **job["kwargs"])
+            except Exception as e:
+                print(f"Suggestion job {job_id} failed: {e}")
+                result = {
+                    "success": False,
+                    "error": str(e)
+                }
+
+            with self._lock:
+                job["finished_at"] = time.time()
+                job["status"] = "done"
+                job["result"] = result
+                self._busy -= 1
+                self.completed += 1
+                queue_wait = job["started_at"] - job["queued_at"]
+                self.total_queue_wait += queue_wait
+                self.max_queue_wait = max(self.max_queue_wait, queue_wait)
+                self.total_model_time += job["finished_at"] - job["started_at"]
+
+    def _expire_jobs(self):
+        # Caller must hold the lock; jobs are kept in submission order
+        cutoff = time.time() - self.result_ttl
+        while self._jobs:
+            job_id, job = next(iter(self._jobs.items()))
+            if job["status"] != "done" or job["finished_at"] > cutoff:
+                break
+            del self._jobs[job_id]
+
+    @staticmethod
+    def _describe(job: Dict) -> Dict:
+        status = {
+            "job_id": job["job_id"],
+            "status": job["status"],
+            "queue_wait_ms": None,
+            "model_ms": None
+        }
+        if job["started_at"] is not None:
+            status["queue_wait_ms"] = round(1000 * (job["started_at"] - job["queued_at"]), 1)
+        else:
+            status["queue_wait_ms"] = round(1000 * (time.time() - job["queued_at"]), 1)
+        if job["finished_at"] is not None:
+            status["model_ms"] = round(1000 * (job["finished_at"] - job["started_at"]), 1)
+            status["result"] = job["result"]
+        return status
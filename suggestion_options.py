@@ -0,0 +1,73 @@
+# How many reply suggestions to generate and in which tones
+# Shared by the web app, the command-line scripts and the mock backend
+
+from typing import Dict, Iterable, List, Optional
+
+# Every tone a suggestion can have
+TONES = ("friendly", "professional", "casual", "empathetic", "assertive")
+
+DEFAULT_COUNT = 3
+MAX_COUNT = 5
+
+
+class SuggestionOptions:
+    """
+    Number of suggestions and the tones they may use.
+
+    Args:
+        count: Suggestions to generate, 1 to MAX_COUNT
+        tones: Allowed tones, a subset of TONES (None or empty allows all)
+
+    Raises:
+        ValueError: for a count out of range or an unknown tone
+    """
+
+    def __init__(self, count: int = DEFAULT_COUNT, tones: Optional[Iterable[str]] = None):
+        if isinstance(count, bool) or not isinstance(count, int) or not 1 <= count <= MAX_COUNT:
+            raise ValueError(f"count must be a whole number from 1 to {MAX_COUNT}")
+        tones = set(tones or ())
+        unknown = tones - set(TONES)
+        if unknown:
+            raise ValueError(f"Unknown tone(s) {', '.join(sorted(unknown))}, expected some of {', '.join(TONES)}")
+        self.count = count
+        # In TONES order, so equal filters give equal cache keys and prompts
+        self.tones = tuple(tone for tone in TONES if tone in tones) or None
+
+    @classmethod
+    def from_request(cls, data: Dict) -> "SuggestionOptions":
+        """Read "count" and "tones" (a list or a comma-separated string) from a request body."""
+        count = data.get('count')
+        tones = data.get('tones')
+        if isinstance(tones, str):
+            tones = [tone.strip() for tone in tones.split(",") if tone.strip()]
+        return cls(DEFAULT_COUNT if count is None else count, tones)
+
+    @property
+    def is_default(self) -> bool:
+        return self.count == DEFAULT_COUNT and self.tones is None
+
+    def cache_variant(self) -> str:
+        """What sets these options apart in a cache key; empty for the defaults."""
+        if self.is_default:
+            return ""
+        return f"n={self.count};tones={','.join(self.tones or ())}"
+
+    def amount(self) -> str:
+        """"3 reply suggestions", for the instruction sent to the model."""
+        return f"{self.count} reply suggestion{'' if self.count == 1 else 's'}"
+
+    def tone_instruction(self) -> str:
+        """Sentence restricting the tones, or an empty string."""
+        if self.tones is None:
+            return ""
+        return f" Only use these tones: {', '.join(self.tones)}."
+
+    def select(self, suggestions: List[Dict]) -> Optional[List[Dict]]:
+        """The first `count` of the suggestions in an allowed tone, or None if there aren't enough."""
+        allowed = [s for s in suggestions if self.tones is None or s.get('tone') in self.tones]
+        if len(allowed) < self.count:
+            return None
+        return allowed[:self.count]
+
+    def to_dict(self) -> Dict:
+        return {"count": self.count, "tones": list(self.tones) if self.tones else None}
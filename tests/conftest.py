@@ -0,0 +1,14 @@
+import os
+import sys
+
+# The modules live at the top of the repository, next to web_app.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Tests that import web_app run it on the local mock, fast, without a history log or background warm-up
+os.environ.setdefault("XAI_BACKEND", "mock")
+os.environ.setdefault("MOCK_LATENCY_MS", "5")
+os.environ.setdefault("MOCK_LATENCY_JITTER_MS", "0")
+os.environ.setdefault("MOCK_LATENCY_DISTRIBUTION", "fixed")
+os.environ.setdefault("MOCK_TTFT_MS", "1")
+os.environ.setdefault("SUGGESTION_HISTORY_DIR", "")
+os.environ.setdefault("CLIENT_POOL_WARMUP", "0")
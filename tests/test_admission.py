@@ -0,0 +1,148 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import admission as admission_module
+from admission import AdmissionController, AdmissionRejected
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission_module.time, "monotonic", clock)
+    return clock
+
+
+def test_token_buckets_are_off_by_default():
+    controller = AdmissionController()
+    for _ in range(50):
+        with controller.admit("1.2.3.4"):
+            pass
+    assert controller.stats()["rate_limited"] == 0
+
+
+def test_bucket_allows_burst_then_rejects(clock):
+    controller = AdmissionController(user_rate=1.0, user_burst=3)
+    for _ in range(3):
+        with controller.admit("1.2.3.4"):
+            pass
+    with pytest.raises(AdmissionRejected) as rejected:
+        with controller.admit("1.2.3.4"):
+            pass
+    assert rejected.value.reason == "rate_limited"
+    assert controller.stats()["rate_limited"] == 1
+
+    # Other clients have buckets of their own
+    with controller.admit("5.6.7.8"):
+        pass
+
+
+def test_bucket_refills(clock):
+    controller = AdmissionController(user_rate=0.5, user_burst=1)
+    with controller.admit("1.2.3.4"):
+        pass
+    with pytest.raises(AdmissionRejected):
+        with controller.admit("1.2.3.4"):
+            pass
+    clock.now += 2.0
+    with controller.admit("1.2.3.4"):
+        pass
+
+
+def test_background_work_has_no_bucket(clock):
+    controller = AdmissionController(user_rate=0.5, user_burst=1)
+    for _ in range(5):
+        with controller.admit(None):
+            pass
+    assert controller.stats()["rate_limited"] == 0
+
+
+def test_full_queue_is_shed_and_refunded(clock):
+    controller = AdmissionController(max_concurrent=1, max_queue=0, user_rate=1.0, user_burst=2)
+    with controller.admit("a"):
+        with pytest.raises(AdmissionRejected) as rejected:
+            with controller.admit("b"):
+                pass
+    assert rejected.value.reason == "overloaded"
+    # The shed request didn't use up b's burst
+    with controller.admit("b"):
+        pass
+    with controller.admit("b"):
+        pass
+
+
+def test_queued_request_gets_the_freed_slot():
+    controller = AdmissionController(max_concurrent=1, slo_seconds=5)
+    order = []
+    holding = threading.Event()
+    release = threading.Event()
+
+    def first():
+        with controller.admit("a"):
+            holding.set()
+            release.wait(5)
+            order.append("a")
+
+    def second():
+        with controller.admit("b"):
+            order.append("b")
+
+    threads = [threading.Thread(target=first), threading.Thread(target=second)]
+    threads[0].start()
+    holding.wait(5)
+    threads[1].start()
+    deadline = time.monotonic() + 5
+    while controller.stats()["queued"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert order == ["a", "b"]
+    assert controller.stats()["active"] == 0
+
+
+def test_async_request_cancelled_while_queued_leaves_the_queue():
+    controller = AdmissionController(max_concurrent=1, slo_seconds=5)
+
+    async def scenario():
+        async with controller.admit_async("a"):
+            waiting = asyncio.ensure_future(controller.admit_async("b").__aenter__())
+            await asyncio.sleep(0.01)
+            assert controller.stats()["queued"] == 1
+            waiting.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiting
+            assert controller.stats()["queued"] == 0
+        assert controller.stats()["active"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_web_app_counts_requests_against_the_address(monkeypatch):
+    import web_app
+
+    monkeypatch.setattr(web_app, "admission", AdmissionController(user_rate=0.001, user_burst=1))
+    monkeypatch.setattr(web_app, "similar_cache", None)
+    client = web_app.app.test_client()
+
+    def suggest(user_name, remote_addr, topic):
+        conversation = [{"sender": "Sam", "message": f"Could you look over the {topic} numbers before our call tomorrow?"}]
+        response = client.post("/suggest", json={"conversation": conversation, "user_name": user_name},
+                               environ_base={"REMOTE_ADDR": remote_addr})
+        return response.get_json()
+
+    assert "degraded" not in suggest("You", "10.0.0.1", "budget")
+    # A different user_name from the same address shares the bucket
+    assert suggest("Someone else", "10.0.0.1", "hiring")["degraded"] is True
+    # Another address has its own
+    assert "degraded" not in suggest("You", "10.0.0.2", "travel")
@@ -0,0 +1,155 @@
+import json
+import threading
+
+import pytest
+
+import app
+
+
+class Crash(Exception):
+    pass
+
+
+def write_input(path, count):
+    with open(path, "w") as f:
+        for i in range(count):
+            f.write(json.dumps({"id": f"c{i}", "conversation": [{"sender": "Alice", "message": f"hi {i}"}]}) + "\n")
+        f.write("\n")
+
+
+def output_ids(path):
+    with open(path) as f:
+        return [json.loads(line)["id"] for line in f]
+
+
+def crashing_save(monkeypatch, crash_on):
+    """Make the crash_on-th save_checkpoint call of the next run raise, like a crash right before it."""
+    save_checkpoint = app.save_checkpoint
+    saves = []
+
+    def save(*args):
+        saves.append(args)
+        if len(saves) == crash_on:
+            raise Crash()
+        save_checkpoint(*args)
+
+    monkeypatch.setattr(app, "save_checkpoint", save)
+    return save_checkpoint
+
+
+@pytest.fixture(autouse=True)
+def instant_records(monkeypatch):
+    monkeypatch.setattr(app, "_process_record", lambda record: {"id": record["id"]})
+
+
+@pytest.mark.parametrize("crash_after", [1, 3, 5])
+def test_rerun_after_a_crash_writes_every_result_once(tmp_path, monkeypatch, crash_after):
+    input_path, output_path = str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl")
+    write_input(input_path, 6)
+    # Dies after a line was flushed, before its checkpoint (the first save is the run's start)
+    save_checkpoint = crashing_save(monkeypatch, crash_after + 1)
+    with pytest.raises(Crash):
+        app.batch_mode(input_path, output_path, concurrency=2)
+    assert len(output_ids(output_path)) == crash_after
+
+    monkeypatch.setattr(app, "save_checkpoint", save_checkpoint)
+    app.batch_mode(input_path, output_path, concurrency=2)
+    assert sorted(output_ids(output_path)) == [f"c{i}" for i in range(6)]
+
+
+def test_finished_run_has_nothing_left_to_do(tmp_path, monkeypatch):
+    input_path, output_path = str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl")
+    write_input(input_path, 4)
+    app.batch_mode(input_path, output_path, concurrency=3)
+
+    monkeypatch.setattr(app, "_process_record", lambda record: pytest.fail("ran a record twice"))
+    app.batch_mode(input_path, output_path, concurrency=3)
+    assert sorted(output_ids(output_path)) == ["c0", "c1", "c2", "c3"]
+    watermark, done, output_bytes = app.load_checkpoint(output_path + ".checkpoint")
+    assert output_bytes == (tmp_path / "out.jsonl").stat().st_size
+
+
+def test_crash_right_after_resuming_still_writes_every_result_once(tmp_path, monkeypatch):
+    input_path, output_path = str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl")
+    write_input(input_path, 6)
+    save_checkpoint = app.save_checkpoint
+    for crash_on in (4, 2):
+        # The second run cuts off the unsaved line, then dies before its first result is checkpointed
+        crashing_save(monkeypatch, crash_on)
+        with pytest.raises(Crash):
+            app.batch_mode(input_path, output_path, concurrency=1)
+        monkeypatch.setattr(app, "save_checkpoint", save_checkpoint)
+
+    app.batch_mode(input_path, output_path, concurrency=1)
+    assert sorted(output_ids(output_path)) == [f"c{i}" for i in range(6)]
+
+
+def test_unreadable_lines_get_an_error_result_and_are_not_retried(tmp_path, monkeypatch):
+    input_path, output_path = str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl")
+    with open(input_path, "w") as f:
+        f.write(json.dumps({"id": "c0", "conversation": []}) + "\n")
+        f.write('{"id": "c1", "conversation": [\n')
+        f.write("42\n")
+        f.write(json.dumps({"id": "c3", "messages": []}) + "\n")
+        f.write(json.dumps([{"sender": "Alice", "message": "hi"}]) + "\n")
+    app.batch_mode(input_path, output_path, concurrency=2)
+
+    with open(output_path) as f:
+        results = {result["id"]: result for result in map(json.loads, f)}
+    assert sorted(results, key=str) == [1, 2, 4, "c0", "c3"]
+    assert results[1]["error"].startswith("Invalid JSON on line 2")
+    assert results[2]["error"] == "Line 3 is not a conversation"
+    assert results["c3"]["error"] == "Line 4 is not a conversation"
+    assert "error" not in results[4] and "error" not in results["c0"]
+
+    monkeypatch.setattr(app, "_process_record", lambda record: pytest.fail("ran a record twice"))
+    app.batch_mode(input_path, output_path, concurrency=2)
+    assert len(output_ids(output_path)) == 5
+
+
+def test_resume_past_a_gap_runs_only_the_missing_lines(tmp_path, monkeypatch):
+    input_path, output_path = str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl")
+    write_input(input_path, 8)
+    with open(output_path, "w") as f:
+        for i in (0, 1, 4, 5):
+            f.write(json.dumps({"id": f"c{i}"}) + "\n")
+    app.save_checkpoint(output_path + ".checkpoint", 2, {4, 5}, (tmp_path / "out.jsonl").stat().st_size)
+
+    ran = []
+    monkeypatch.setattr(app, "_process_record", lambda record: ran.append(record["id"]) or {"id": record["id"]})
+    app.batch_mode(input_path, output_path, concurrency=2)
+
+    assert sorted(ran) == ["c2", "c3", "c6", "c7"]
+    assert sorted(output_ids(output_path)) == [f"c{i}" for i in range(8)]
+    watermark, done, _ = app.load_checkpoint(output_path + ".checkpoint")
+    # Past the 8 conversations and the blank last line
+    assert watermark == 9
+    assert done == set()
+
+
+def test_lines_done_ahead_of_a_slow_one_are_bounded(tmp_path, monkeypatch):
+    input_path, output_path = str(tmp_path / "in.jsonl"), str(tmp_path / "out.jsonl")
+    write_input(input_path, 60)
+    monkeypatch.setattr(app, "BATCH_MAX_AHEAD", 4)
+    slow = threading.Event()
+    threading.Timer(0.2, slow.set).start()
+
+    def process(record):
+        if record["id"] == "c0":
+            slow.wait(5)
+        return {"id": record["id"]}
+
+    monkeypatch.setattr(app, "_process_record", process)
+    save_checkpoint = app.save_checkpoint
+    ahead = []
+
+    def save(checkpoint_path, watermark, done, output_bytes):
+        ahead.append(len(done))
+        save_checkpoint(checkpoint_path, watermark, done, output_bytes)
+
+    monkeypatch.setattr(app, "save_checkpoint", save)
+    app.batch_mode(input_path, output_path, concurrency=3)
+
+    # Reading stops at 4 × 3, and the records already in flight can still finish
+    assert 4 * 3 <= max(ahead) < 4 * 3 + 3
+    assert sorted(output_ids(output_path), key=lambda i: int(i[1:])) == [f"c{i}" for i in range(60)]
@@ -0,0 +1,170 @@
+import asyncio
+import threading
+
+from chat_sessions import ChatSessionManager
+
+SYSTEM_PROMPT = "You suggest replies."
+
+
+def text(message) -> str:
+    return "".join(part.text for part in message.content)
+
+
+class FakeChat:
+    def __init__(self, messages):
+        self.messages = messages
+
+    def prompt(self) -> str:
+        return "\n".join(text(message) for message in self.messages)
+
+
+class FakeClient:
+    class chat:
+        @staticmethod
+        def create(model, messages, **kwargs):
+            return FakeChat(messages)
+
+
+def history(n, last=None):
+    turns = [{"sender": "Sam" if i % 2 == 0 else "You", "message": f"message {i}"} for i in range(n)]
+    if last is not None:
+        turns[-1] = {"sender": "Sam", "message": last}
+    return turns
+
+
+def prepare(manager, conversation, instruction="Suggest replies"):
+    return manager.prepare_chat(FakeClient, "model", "key", SYSTEM_PROMPT, conversation, instruction)
+
+
+def race(manager, first, second):
+    """Prepare `first`, letting `second` prepare completely right after `first` looked up its session."""
+    get_session = manager._get_session
+
+    def get_session_then_race(session_key, system_prompt, turns):
+        session = get_session(session_key, system_prompt, turns)
+        manager._get_session = get_session
+        raced.append(prepare(manager, second))
+        return session
+
+    raced = []
+    manager._get_session = get_session_then_race
+    return prepare(manager, first), raced[0]
+
+
+def test_later_turns_are_appended_to_the_session():
+    manager = ChatSessionManager()
+    prepare(manager, history(3))
+    (chat, info) = prepare(manager, history(5))
+    assert "message 4" in chat.prompt()
+    assert manager.stats()["turns_reused"] == 3
+    assert info["verbatim_turns"] == 5
+
+
+def test_shorter_request_racing_a_longer_one_only_sends_its_own_turns():
+    manager = ChatSessionManager()
+    prepare(manager, history(3))
+
+    (chat_a, info_a), (chat_b, _) = race(manager, history(5), history(7))
+
+    assert "message 4" in chat_a.prompt()
+    assert "message 5" not in chat_a.prompt() and "message 6" not in chat_a.prompt()
+    assert info_a["verbatim_turns"] == 5
+    assert "message 6" in chat_b.prompt()
+    assert manager.stats()["unshared"] == 1
+
+    # The session kept the longer history for the next request
+    prepare(manager, history(8))
+    assert manager.stats()["turns_appended"] == 8
+
+
+def test_diverging_request_doesnt_get_the_other_last_message():
+    manager = ChatSessionManager()
+    prepare(manager, history(3))
+
+    (chat_a, _), (chat_b, _) = race(manager, history(5, last="see you at noon"), history(5, last="cancel everything"))
+
+    assert "see you at noon" in chat_a.prompt() and "cancel everything" not in chat_a.prompt()
+    assert "cancel everything" in chat_b.prompt()
+
+
+def folding_manager(**kwargs) -> ChatSessionManager:
+    return ChatSessionManager(max_prompt_tokens=10, recent_turns=2, fold_batch=2, **kwargs)
+
+
+def test_summarizer_runs_without_the_session_lock():
+    locked = []
+
+    def summarizer(client, model, previous_summary, turns):
+        session = manager._sessions["key"]
+        locked.append(session.lock.locked())
+        return f"summary of {len(turns)} turns"
+
+    manager = folding_manager(summarizer=summarizer)
+    chat, info = prepare(manager, history(6))
+
+    assert locked == [False]
+    assert info["summarized_turns"] == 4
+    assert "summary of 4 turns" in chat.prompt()
+
+
+def test_other_requests_dont_wait_for_the_summarizer():
+    summarizing = threading.Event()
+    release = threading.Event()
+
+    def summarizer(client, model, previous_summary, turns):
+        summarizing.set()
+        release.wait(5)
+        return "slow summary"
+
+    manager = folding_manager(summarizer=summarizer)
+    folding = threading.Thread(target=prepare, args=(manager, history(6)))
+    folding.start()
+    assert summarizing.wait(5)
+
+    # Same conversation while the summary is being written: not blocked, and no second summary call
+    finished = []
+    other = threading.Thread(target=lambda: finished.append(prepare(manager, history(6))))
+    other.start()
+    other.join(2)
+    assert finished, "request waited on another request's summarizer call"
+
+    release.set()
+    folding.join(5)
+    assert manager.stats()["folds"] == 1
+
+
+def test_failed_summary_leaves_the_turns_verbatim():
+    def summarizer(client, model, previous_summary, turns):
+        raise RuntimeError("upstream down")
+
+    manager = folding_manager(summarizer=summarizer)
+    chat, info = prepare(manager, history(6))
+    assert info["summarized_turns"] == 0
+    assert manager.stats()["summary_failures"] == 1
+    # The next request tries again
+    prepare(manager, history(6))
+    assert manager.stats()["summary_failures"] == 2
+
+
+def test_async_summary_cancelled_lets_the_next_request_fold():
+    calls = []
+
+    async def slow_summarizer(client, model, previous_summary, turns):
+        calls.append(len(turns))
+        if len(calls) == 1:
+            await asyncio.sleep(10)
+        return "summary"
+
+    manager = folding_manager(async_summarizer=slow_summarizer)
+
+    async def scenario():
+        task = asyncio.ensure_future(manager.prepare_chat_async(
+            FakeClient, "model", "key", SYSTEM_PROMPT, history(6), "Suggest replies"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return await manager.prepare_chat_async(FakeClient, "model", "key", SYSTEM_PROMPT, history(6), "Suggest replies")
+
+    chat, info = asyncio.run(scenario())
+    assert calls == [4, 4]
+    assert info["summarized_turns"] == 4
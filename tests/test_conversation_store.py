@@ -0,0 +1,131 @@
+import asyncio
+import threading
+
+import pytest
+
+from conversation_store import ConversationStore, MemoryConversationStore, SQLiteConversationStore
+
+MESSAGE = {"sender": "Alice", "message": "Hi"}
+
+
+def test_sqlite_async_wait_wakes_on_a_local_write(tmp_path):
+    store = SQLiteConversationStore(str(tmp_path / "rooms.db"), poll_interval=5)
+
+    async def scenario():
+        waiter = asyncio.ensure_future(store.wait_for_changes_async("room", 0, timeout=5))
+        await asyncio.sleep(0.05)
+        await asyncio.to_thread(store.append, "room", [MESSAGE])
+        return await asyncio.wait_for(waiter, 1)
+
+    changes = asyncio.run(scenario())
+    assert changes["version"] == 1
+    assert changes["messages"] == [MESSAGE]
+
+
+def test_sqlite_async_wait_notices_other_processes(tmp_path):
+    path = str(tmp_path / "rooms.db")
+    store = SQLiteConversationStore(path, poll_interval=0.02)
+    # Another worker process: its writes don't wake this store's waiters
+    other = SQLiteConversationStore(path)
+
+    async def scenario():
+        waiter = asyncio.ensure_future(store.wait_for_changes_async("room", 0, timeout=5))
+        await asyncio.sleep(0.05)
+        other.append("room", [MESSAGE])
+        return await asyncio.wait_for(waiter, 1)
+
+    assert asyncio.run(scenario())["messages"] == [MESSAGE]
+
+
+def test_sqlite_async_wait_times_out_unchanged(tmp_path):
+    store = SQLiteConversationStore(str(tmp_path / "rooms.db"), poll_interval=0.01)
+    changes = asyncio.run(store.wait_for_changes_async("room", 0, timeout=0.05))
+    assert changes == {"version": 0, "reset": False, "start": 0, "messages": []}
+
+
+def test_sqlite_async_waiters_poll_off_the_loop_and_share_queries(tmp_path):
+    store = SQLiteConversationStore(str(tmp_path / "rooms.db"), poll_interval=0.02)
+    version = store.version
+    threads, queries = set(), []
+
+    def counted_version(room):
+        threads.add(threading.current_thread())
+        queries.append(room)
+        return version(room)
+
+    store.version = counted_version
+
+    async def scenario():
+        waiters = [store.wait_for_changes_async("room", 0, timeout=0.2) for _ in range(50)]
+        await asyncio.gather(*waiters)
+
+    asyncio.run(scenario())
+    assert threading.main_thread() not in threads
+    # 50 waiters polling every 20ms for 200ms would make about 500 queries on their own
+    assert 0 < len(queries) < 100
+
+
+def test_store_without_every_method_fails_when_created():
+    class Incomplete(ConversationStore):
+        def version(self, room):
+            return 0
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_memory_reads_of_unknown_rooms_create_nothing():
+    store = MemoryConversationStore()
+    assert store.version("nobody") == 0
+    assert store.snapshot("nobody") == {"version": 0, "conversation": []}
+    assert store.changes_since("nobody", 0)["messages"] == []
+    assert store.changes_since("nobody", 3)["reset"] is True
+    assert store.wait_for_changes("nobody", 0, timeout=0.01)["version"] == 0
+    asyncio.run(store.wait_for_changes_async("nobody", 0, timeout=0.01))
+    assert store._rooms == {}
+
+
+def test_memory_writes_keep_their_room():
+    store = MemoryConversationStore()
+    assert store.append("room", [MESSAGE]) == 1
+    assert store.snapshot("room") == {"version": 1, "conversation": [MESSAGE]}
+    assert store.replace("empty", []) == 0
+    assert list(store._rooms) == ["room"]
+
+
+def test_memory_waiter_on_a_new_room_sees_its_first_write():
+    store = MemoryConversationStore()
+
+    async def scenario():
+        waiter = asyncio.ensure_future(store.wait_for_changes_async("room", 0, timeout=5))
+        await asyncio.sleep(0.01)
+        store.append("room", [MESSAGE])
+        return await asyncio.wait_for(waiter, 1)
+
+    assert asyncio.run(scenario())["messages"] == [MESSAGE]
+    assert list(store._rooms) == ["room"]
+
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(store.wait_for_changes("other", 0, timeout=5)))
+    waiter.start()
+    while "other" not in store._rooms:
+        pass
+    store.append("other", [MESSAGE])
+    waiter.join(5)
+    assert result[0]["messages"] == [MESSAGE]
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryConversationStore()
+    return SQLiteConversationStore(str(tmp_path / "rooms.db"))
+
+
+@pytest.mark.parametrize("messages", ["hello", [{"sender": "Alice"}], [{"sender": "Alice", "message": None}], [MESSAGE, 3]])
+def test_malformed_messages_are_not_stored(store, messages):
+    with pytest.raises(ValueError):
+        store.append("room", messages)
+    with pytest.raises(ValueError):
+        store.replace("room", messages)
+    assert store.snapshot("room") == {"version": 0, "conversation": []}
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+import web_app
+from similarity_cache import SimilarityCache
+from suggestion_cache import SuggestionCache
+
+
+@pytest.fixture
+def caches(monkeypatch):
+    monkeypatch.setattr(web_app, "suggestion_cache", SuggestionCache())
+    monkeypatch.setattr(web_app, "similar_cache", SimilarityCache())
+    monkeypatch.setattr(web_app, "admission", None)
+
+
+def conversation(order):
+    return [
+        {"sender": "Dana", "message": f"Hi, my order {order} arrived but the charger is missing from the box."},
+        {"sender": "You", "message": f"Sorry about that, I can see order {order} shipped last week from our warehouse."},
+        {"sender": "Dana", "message": "Can you just send it again?"},
+    ]
+
+
+def test_regenerating_a_near_duplicate_calls_the_model(caches):
+    client = web_app.app.test_client()
+    first = client.post("/suggest", json={"conversation": conversation("48213")}).get_json()
+    assert first["success"] and first["cached"] is False
+
+    # The same conversation about another order is answered from the near-duplicate cache
+    shown = client.post("/suggest", json={"conversation": conversation("55120")}).get_json()
+    assert "similarity" in shown
+
+    regenerated = client.post("/suggest", json={"conversation": conversation("55120"), "regenerate": 1}).get_json()
+    assert regenerated["success"]
+    assert regenerated["regenerated"] == 1
+    assert regenerated["cached"] is False
+    assert regenerated["data"]["suggestions"][0] == shown["data"]["suggestions"][0]
+
+    # The replacement stays with this conversation
+    again = client.post("/suggest", json={"conversation": conversation("55120")}).get_json()
+    assert again["data"]["suggestions"][1] == regenerated["data"]["suggestions"][1]
+
+
+def test_async_regenerating_a_near_duplicate_calls_the_model(caches):
+    import async_engine
+
+    web_app.get_suggestions(conversation("48213"))
+    shown = web_app.get_suggestions(conversation("55120"))
+    assert "similarity" in shown
+
+    regenerated = asyncio.run(async_engine.regenerate_suggestion(conversation("55120"), "You", 2))
+    assert regenerated["regenerated"] == 2
+    assert regenerated["cached"] is False
+
+
+def test_regenerating_without_a_cached_response_generates_the_set(caches):
+    client = web_app.app.test_client()
+    result = client.post("/suggest", json={"conversation": conversation("48213"), "regenerate": 0}).get_json()
+    assert result["success"]
+    assert "regenerated" not in result
+    assert len(result["data"]["suggestions"]) == 3
@@ -0,0 +1,101 @@
+import asyncio
+
+import grpc
+import pytest
+
+from mock_backend import MockUpstreamError
+from resilience import CircuitBreaker, CircuitOpenError
+
+
+def fail():
+    raise MockUpstreamError(grpc.StatusCode.UNAVAILABLE)
+
+
+def open_breaker(open_seconds: float) -> CircuitBreaker:
+    breaker = CircuitBreaker(failure_threshold=0.5, window=4, min_calls=4, open_seconds=open_seconds)
+    for _ in range(4):
+        with pytest.raises(MockUpstreamError):
+            breaker.call(fail)
+    return breaker
+
+
+def test_opens_after_failure_rate_and_rejects():
+    breaker = open_breaker(open_seconds=60)
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        breaker.call(lambda: "ok")
+    assert breaker.stats()["rejected"] == 1
+    assert breaker.stats()["opened"] == 1
+
+
+def test_errors_that_are_not_upstream_errors_dont_count():
+    breaker = CircuitBreaker(window=4, min_calls=4)
+    for _ in range(4):
+        with pytest.raises(ValueError):
+            breaker.call(lambda: int("x"))
+    assert breaker.state == "closed"
+
+
+def test_successful_probe_closes():
+    breaker = open_breaker(open_seconds=0)
+    assert breaker.state == "half_open"
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.state == "closed"
+
+
+def test_failed_probe_reopens():
+    breaker = open_breaker(open_seconds=0)
+    probe = breaker.before_call()
+    assert probe is True
+    breaker.open_seconds = 60
+    breaker.after_call(probe, MockUpstreamError())
+    assert breaker.state == "open"
+
+
+def test_only_one_probe_at_a_time():
+    breaker = open_breaker(open_seconds=0)
+    assert breaker.before_call() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+def test_cancelled_probe_lets_the_next_call_probe():
+    breaker = open_breaker(open_seconds=0)
+    probe = breaker.before_call()
+    breaker.cancel_call(probe)
+    assert breaker.state == "half_open"
+    assert breaker.before_call() is True
+
+
+def test_call_async_cancelled_while_probing():
+    breaker = open_breaker(open_seconds=0)
+
+    async def scenario():
+        task = asyncio.ensure_future(breaker.call_async(lambda: asyncio.sleep(10)))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert breaker.state == "half_open"
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.state == "closed"
+
+
+def test_stream_closed_early_while_probing(monkeypatch):
+    import web_app
+
+    breaker = open_breaker(open_seconds=0)
+    monkeypatch.setattr(web_app, "upstream_breaker", breaker)
+    monkeypatch.setattr(web_app, "admission", None)
+    conversation = [{"sender": "Sam", "message": "Did you get a chance to look at the slides for Thursday's review?"}]
+
+    # The browser disconnects after the first suggestion
+    events = web_app.stream_reply_suggestions(conversation, "You", None)
+    event, _ = next(events)
+    assert event == "suggestion"
+    events.close()
+
+    assert breaker.state == "half_open"
+    assert breaker.before_call() is True
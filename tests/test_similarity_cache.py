@@ -0,0 +1,78 @@
+from similarity_cache import SimilarityCache
+
+RESULT = {"success": True, "data": {"suggestions": [{"reply": "Sure, I'll resend order 48213 today."}]}}
+
+
+def conversation(last_message, order="48213", name="Dana"):
+    return [
+        {"sender": name, "message": f"Hi, my order {order} arrived but the charger is missing from the box."},
+        {"sender": "You", "message": f"Sorry about that, I can see order {order} shipped last week from our warehouse."},
+        {"sender": name, "message": "It was supposed to include the charger and the cable, I checked the listing twice."},
+        {"sender": name, "message": last_message},
+    ]
+
+
+def test_different_last_message_is_not_a_hit():
+    cache = SimilarityCache()
+    cache.set(conversation("Can you just send it again?"), "You", RESULT)
+
+    assert cache.get(conversation("Cancel it and refund me."), "You") is None
+    assert cache.stats()["hits"] == 0
+
+
+def test_same_last_message_with_other_slots_is_a_hit():
+    cache = SimilarityCache()
+    cache.set(conversation("Can you just send it again?"), "You", RESULT)
+
+    match = cache.get(conversation("Can you just send it again!", order="55120", name="Robin"), "You")
+    assert match is not None
+    assert match.result["data"]["suggestions"][0]["reply"] == "Sure, I'll resend order 55120 today."
+
+
+def test_last_message_from_other_sender_is_not_a_hit():
+    cache = SimilarityCache()
+    history = conversation("Can you just send it again?")
+    cache.set(history, "You", RESULT)
+
+    assert cache.get(history[:-1] + [{"sender": "You", "message": "Can you just send it again?"}], "You") is None
+
+
+def test_expired_entries_are_not_returned():
+    cache = SimilarityCache(ttl_seconds=0)
+    history = conversation("Can you just send it again?")
+    cache.set(history, "You", RESULT)
+
+    assert cache.get(history, "You") is None
+
+
+def test_slot_values_outside_the_suggestion_text_are_left_alone():
+    cache = SimilarityCache()
+    result = {
+        "success": True,
+        "data": {
+            "suggestions": [{"reply": "Order 6000 ships today.", "confidence": 0.9}],
+            "conversation_analysis": {"summary": "Dana asks about order 6000"}
+        },
+        "prompt": {"budget_tokens": 6000, "6000": "key"}
+    }
+    cache.set(conversation("Can you just send it again?", order="6000"), "You", result)
+
+    match = cache.get(conversation("Can you just send it again?", order="AB-1234", name="Robin"), "You")
+    assert match is not None
+    assert match.result["data"]["suggestions"][0] == {"reply": "Order AB-1234 ships today.", "confidence": 0.9}
+    assert match.result["data"]["conversation_analysis"]["summary"] == "Robin asks about order AB-1234"
+    assert match.result["prompt"] == {"budget_tokens": 6000, "6000": "key"}
+
+
+def test_template_that_cannot_be_filled_is_a_miss(monkeypatch):
+    cache = SimilarityCache()
+    history = conversation("Can you just send it again?")
+    cache.set(history, "You", RESULT)
+
+    def broken(template, slots):
+        raise ValueError("Expecting value")
+
+    monkeypatch.setattr(cache, "_fill", broken)
+    assert cache.get(history, "You") is None
+    assert cache.stats()["hits"] == 0
+    assert cache.stats()["misses"] == 1
@@ -0,0 +1,159 @@
+import asyncio
+import threading
+
+import pytest
+
+from single_flight import AsyncSingleFlight, SingleFlight
+
+
+def test_concurrent_calls_share_one_run():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    runs = []
+
+    def work():
+        runs.append(1)
+        started.set()
+        release.wait(5)
+        return "result"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flights.do("key", work)))
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=lambda: results.append(flights.do("key", work)))
+    follower.start()
+    while flights.stats()["coalesced"] == 0:
+        pass
+    release.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert runs == [1]
+    assert sorted(results) == [("result", False), ("result", True)]
+
+
+class Work:
+    """A coroutine function that runs until released, counting its runs and cancellations."""
+
+    def __init__(self, cleanup: float = 0.0):
+        self.runs = 0
+        self.cancelled = 0
+        self.cleanup = cleanup
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.runs += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            # Closing an upstream stream can take a moment, during which the task isn't done
+            await asyncio.sleep(self.cleanup)
+            raise
+        return f"result {self.runs}"
+
+
+def run(scenario):
+    return asyncio.run(scenario())
+
+
+def test_async_join_shares_the_call():
+    async def scenario():
+        flights, work = AsyncSingleFlight(), Work()
+        leader = asyncio.ensure_future(flights.do("key", work))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.do("key", work))
+        await asyncio.sleep(0)
+        work.release.set()
+        assert await leader == ("result 1", False)
+        assert await follower == ("result 1", True)
+        assert work.runs == 1
+        assert flights.in_flight() == 0
+
+    run(scenario)
+
+
+def test_async_call_survives_while_someone_waits():
+    async def scenario():
+        flights, work = AsyncSingleFlight(), Work()
+        leader = asyncio.ensure_future(flights.do("key", work))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flights.do("key", work))
+        await asyncio.sleep(0)
+
+        # The leader's client goes away; the follower still gets the result
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+        work.release.set()
+        assert await follower == ("result 1", True)
+        assert work.cancelled == 0
+        assert flights.stats()["cancelled"] == 0
+
+    run(scenario)
+
+
+def test_async_call_is_cancelled_when_everyone_leaves():
+    async def scenario():
+        flights, work = AsyncSingleFlight(), Work()
+        callers = [asyncio.ensure_future(flights.do("key", work)) for _ in range(3)]
+        await asyncio.sleep(0)
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.sleep(0)
+        assert work.cancelled == 1
+        assert flights.stats()["cancelled"] == 1
+        assert flights.in_flight() == 0
+
+    run(scenario)
+
+
+def test_async_caller_arriving_right_after_a_cancel_starts_a_new_call():
+    async def scenario():
+        flights, work = AsyncSingleFlight(), Work(cleanup=0.05)
+        leader = asyncio.ensure_future(flights.do("key", work))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.gather(leader, return_exceptions=True)
+
+        # The cancelled call is still cleaning up
+        newcomer = asyncio.ensure_future(flights.do("key", work))
+        await asyncio.sleep(0)
+        work.release.set()
+        assert await newcomer == ("result 2", False)
+
+    run(scenario)
+
+
+def test_async_duplicate_gives_up_after_wait_timeout():
+    async def scenario():
+        flights, work = AsyncSingleFlight(), Work()
+        leader = asyncio.ensure_future(flights.do("key", work))
+        await asyncio.sleep(0)
+        with pytest.raises(TimeoutError):
+            await flights.do("key", work, wait_timeout=0.01)
+        work.release.set()
+        assert await leader == ("result 1", False)
+        assert flights.stats()["abandoned"] == 1
+
+    run(scenario)
+
+
+def test_async_errors_reach_every_caller():
+    async def scenario():
+        flights = AsyncSingleFlight()
+        release = asyncio.Event()
+
+        async def fail():
+            await release.wait()
+            raise ValueError("upstream said no")
+
+        callers = [asyncio.ensure_future(flights.do("key", fail)) for _ in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+
+    run(scenario)
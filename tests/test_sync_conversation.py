@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+import pytest
+
+import asgi_app
+import web_app
+from conversation_store import MemoryConversationStore, SQLiteConversationStore
+
+MALFORMED = [
+    {"append": "hello"},
+    {"append": [{"sender": "Alice"}]},
+    {"append": [{"sender": "Alice", "message": 3}]},
+    {"append": [["Alice", "hi"]]},
+    {"conversation": {"sender": "Alice", "message": "hi"}},
+    {"conversation": [{"sender": "Alice", "message": "hi", "extra": True}]},
+]
+
+
+@pytest.fixture(autouse=True, params=["memory", "sqlite"])
+def fresh_store(request, monkeypatch, tmp_path):
+    if request.param == "memory":
+        store = MemoryConversationStore()
+    else:
+        store = SQLiteConversationStore(str(tmp_path / "rooms.db"))
+    monkeypatch.setattr(web_app, "conversation_store", store)
+    monkeypatch.setattr(asgi_app, "conversation_store", store)
+    monkeypatch.setattr(web_app, "speculative_runs", None)
+    return store
+
+
+def flask_post(body):
+    response = web_app.app.test_client().post("/sync_conversation", json=body)
+    return response.status_code, response.get_json()
+
+
+def asgi_post(body):
+    body = json.dumps(body).encode()
+    scope = {"type": "http", "method": "POST", "path": "/sync_conversation", "query_string": b"",
+             "headers": [(b"content-type", b"application/json")], "client": ("127.0.0.1", 1234)}
+    sent = []
+    requests = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        # The client stays connected until the response is sent
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi_app.app(scope, receive, send))
+    status = next(message["status"] for message in sent if message["type"] == "http.response.start")
+    payload = b"".join(message.get("body", b"") for message in sent if message["type"] == "http.response.body")
+    return status, json.loads(payload)
+
+
+@pytest.mark.parametrize("post", [flask_post, asgi_post])
+@pytest.mark.parametrize("body", MALFORMED)
+def test_malformed_messages_are_rejected(fresh_store, post, body):
+    status, payload = post({"room": "r", **body})
+    assert status == 400
+    assert payload["success"] is False
+    assert fresh_store.snapshot("r") == {"version": 0, "conversation": []}
+
+
+@pytest.mark.parametrize("post", [flask_post, asgi_post])
+def test_well_formed_messages_are_stored(fresh_store, post):
+    message = {"sender": "Alice", "message": "hi"}
+    status, payload = post({"room": "r", "append": [message]})
+    assert (status, payload["version"]) == (200, 1)
+    status, payload = post({"room": "r", "conversation": [message, {"sender": "You", "message": "hey"}]})
+    assert status == 200
+    assert payload["conversation"][1] == {"sender": "You", "message": "hey"}
+
+
+def test_flask_rejects_a_body_that_is_not_an_object(fresh_store):
+    status, payload = flask_post([{"sender": "Alice", "message": "hi"}])
+    assert status == 400
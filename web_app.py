@@ -3,40 +3,162 @@
 
 import os
 import json
-from flask import Flask, render_template, request, jsonify
-from typing import List, Dict
+import time
+from contextlib import closing, contextmanager
+from flask import Flask, Response, g, render_template, request, jsonify, stream_with_context
+from typing import Callable, List, Dict, Iterator, Optional, Tuple
 
-from xai_sdk import Client
-from xai_sdk.chat import user, system
+from admission import AdmissionController, AdmissionRejected, admission_client, client_scope
+from backends import create_client
+from chat_sessions import ChatSessionManager, make_session_key
+from client_pool import ClientPool
+from conversation_store import create_conversation_store
+from conversation_sync import check_messages
+from fast_path import FastPath
+from http_cache import ResponseCache, dumps
+from model_routing import ModelRouter, HedgePolicy, call_model
+from resilience import (CircuitBreaker, CircuitOpenError, DeadlineExceeded, RetryPolicy,
+                        deadline_scope, is_deadline_error, remaining_time, resilient_call)
+from metrics import Registry, request_timings, timed, record_stage, server_timing_header
+from single_flight import SingleFlight
+from speculative import SpeculativeRunner
+from stream_parser import IncrementalSuggestionParser
+from similarity_cache import SimilarityCache
+from suggestion_cache import SuggestionCache, make_cache_key
+from suggestion_history import SuggestionHistory
+from suggestion_jobs import SuggestionJobQueue, QueueFull
+from suggestion_options import SuggestionOptions
 
 app = Flask(__name__)
 
-# Initialize the XAI client
-client = Client(api_key=os.getenv("XAI_API_KEY"))
+# Pool of XAI clients shared by all request threads. Connections are opened in the
+# background at startup so the first request doesn't pay for the TLS handshake
+client_pool = ClientPool.from_env(create_client)
+if os.getenv("CLIENT_POOL_WARMUP", "1") == "1":
+    client_pool.warm_up(background=True)
 
+MODEL = "grok-4"
 
-def generate_reply_suggestions(conversation_history: List[Dict[str, str]], user_name: str = "You") -> Dict:
-    """Generate reply suggestions and return them with metadata."""
-    try:
-        # Validate that the last message is NOT from the user
-        if not conversation_history:
-            return {
-                "success": False,
-                "error": "No conversation history provided"
-            }
-        
-        last_message = conversation_history[-1]
-        if last_message['sender'] == user_name:
-            return {
-                "success": False,
-                "error": "Cannot generate suggestions when you sent the last message. Wait for a reply first."
-            }
-        
-        # Create a new chat instance
-        chat = client.chat.create(model="grok-4")
-        
-        # System prompt for structured output
-        system_prompt = f"""You are a helpful AI assistant that analyzes message conversations and suggests appropriate replies.
+# Short, simple threads run on a faster model; slow first tokens can trigger a backup request
+model_router = ModelRouter.from_env(standard_model=MODEL)
+hedge_policy = HedgePolicy.from_env()
+
+# Formulaic last messages ("thanks!", "see you then", "where's my order #123") are
+# answered from templates without calling the model
+fast_path = FastPath.from_env()
+
+# Every suggestion request gets a time budget that is passed down to the upstream call.
+# Transient upstream errors are retried while the budget allows, and a circuit breaker
+# answers with the canned fallback right away while the API keeps failing
+SUGGEST_DEADLINE = float(os.getenv("SUGGEST_DEADLINE", "30"))
+upstream_breaker = CircuitBreaker.from_env()
+upstream_retry = RetryPolicy.from_env()
+
+# Admission control in front of the model: a global concurrency limit, a fair queue and optional
+# per-client token buckets; requests that would wait past the SLO get the degraded fallback
+admission = AdmissionController.from_env() if os.getenv("ADMISSION_CONTROL", "1") == "1" else None
+
+# Requests count against the address they came from. Behind a reverse proxy, name the header it
+# sets to the client's address (e.g. X-Forwarded-For); clients can't choose their own bucket
+ADMISSION_CLIENT_HEADER = os.getenv("ADMISSION_CLIENT_HEADER", "")
+
+# Prometheus metrics, served on /metrics
+metrics_registry = Registry()
+prompt_build_seconds = metrics_registry.histogram(
+    "suggest_prompt_build_seconds", "Time spent building the prompt and chat for a suggestion request")
+upstream_ttft_seconds = metrics_registry.histogram(
+    "suggest_upstream_ttft_seconds", "Time until the first token from the model (the whole answer when not streaming)")
+upstream_seconds = metrics_registry.histogram(
+    "suggest_upstream_seconds", "Total time of the upstream model call")
+parse_seconds = metrics_registry.histogram(
+    "suggest_parse_seconds", "Time spent parsing and validating the model output")
+request_seconds = metrics_registry.histogram(
+    "http_request_duration_seconds", "End-to-end request time by route", ("route", "method", "status"))
+input_tokens = metrics_registry.counter("suggest_input_tokens_total", "Prompt tokens sent upstream")
+output_tokens = metrics_registry.counter("suggest_output_tokens_total", "Completion tokens received from upstream")
+fallback_responses = metrics_registry.counter("suggest_fallback_responses_total", "Canned fallback suggestions returned")
+parse_failures = metrics_registry.counter("suggest_parse_failures_total", "Model outputs that could not be parsed")
+admission_wait_seconds = metrics_registry.histogram(
+    "suggest_admission_wait_seconds", "Time spent waiting for an upstream slot")
+route_decisions = metrics_registry.counter(
+    "suggest_route_decisions_total", "Suggestion requests by model tier and routing reason", ("tier", "reason"))
+degraded_responses = metrics_registry.counter(
+    "suggest_degraded_responses_total", "Fallback suggestions returned because of the deadline, the circuit breaker or load shedding", ("reason",))
+fast_path_hits = metrics_registry.counter(
+    "suggest_fast_path_hits_total", "Requests answered from local templates without a model call", ("intent",))
+hedge_outcomes = metrics_registry.counter(
+    "suggest_hedge_total", "Upstream calls by hedging outcome (not_hedged, primary_won, backup_won)", ("outcome",))
+
+# Per-request stage timings are returned in a Server-Timing header when the client
+# sends X-Request-Timing: 1, or for every request with REQUEST_TIMING_HEADER=1
+REQUEST_TIMING_HEADER = os.getenv("REQUEST_TIMING_HEADER", "0") == "1"
+
+# Persistent per-conversation chats, so follow-up requests only send new turns
+# Older turns are folded into a rolling summary once the prompt passes the token budget
+chat_sessions = ChatSessionManager(
+    idle_ttl=float(os.getenv("CHAT_SESSION_IDLE_TTL", "900")),
+    max_sessions=int(os.getenv("CHAT_SESSION_MAX", "1000")),
+    max_prompt_tokens=int(os.getenv("CONTEXT_MAX_TOKENS", "6000")) or None,
+    recent_turns=int(os.getenv("CONTEXT_RECENT_TURNS", "20"))
+)
+
+# Cache of successful suggestion responses, keyed on the normalized conversation
+suggestion_cache = SuggestionCache(
+    max_entries=int(os.getenv("SUGGEST_CACHE_MAX_ENTRIES", "1024")),
+    max_bytes=int(os.getenv("SUGGEST_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+    ttl_seconds=float(os.getenv("SUGGEST_CACHE_TTL", "300"))
+)
+
+# Behind the exact cache: conversations whose last few turns only differ in names, order
+# numbers or punctuation reuse each other's suggestions, with those values swapped in
+similar_cache = None
+if os.getenv("SIMILAR_CACHE", "1") == "1":
+    similar_cache = SimilarityCache(
+        threshold=float(os.getenv("SIMILAR_CACHE_THRESHOLD", "0.8")),
+        turns=int(os.getenv("SIMILAR_CACHE_TURNS", "4")),
+        max_entries=int(os.getenv("SIMILAR_CACHE_MAX_ENTRIES", "100000")),
+        max_bytes=int(os.getenv("SIMILAR_CACHE_MAX_BYTES", str(128 * 1024 * 1024))),
+        ttl_seconds=float(os.getenv("SIMILAR_CACHE_TTL", "3600"))
+    )
+
+# Serialized bodies of the polled routes (/sync_conversation, /examples), kept until their
+# data changes; clients revalidate with If-None-Match and large bodies go out compressed
+response_cache = ResponseCache.from_env()
+
+
+def check_conversation(conversation_history: List[Dict[str, str]], user_name: str) -> Optional[Dict]:
+    """Return an error response if suggestions can't be generated, otherwise None."""
+    if not conversation_history:
+        return {
+            "success": False,
+            "error": "No conversation history provided"
+        }
+    
+    # Validate that the last message is NOT from the user
+    last_message = conversation_history[-1]
+    if last_message['sender'] == user_name:
+        return {
+            "success": False,
+            "error": "Cannot generate suggestions when you sent the last message. Wait for a reply first."
+        }
+    
+    return None
+
+
+def build_suggestion_prompts(conversation_history: List[Dict[str, str]], user_name: str,
+                             options: Optional[SuggestionOptions] = None) -> Tuple[str, str]:
+    """
+    Build the system prompt and the per-request instruction.
+    
+    The system prompt only depends on user_name, so it stays byte-identical for
+    the whole conversation; anything about the latest message, the number of
+    suggestions and their tones go in the instruction.
+    """
+    options = options or SuggestionOptions()
+    last_message = conversation_history[-1]
+    
+    # System prompt for structured output
+    system_prompt = f"""You are a helpful AI assistant that analyzes message conversations and suggests appropriate replies.
 
 IMPORTANT CONTEXT:
 - The person needing reply suggestions is "{user_name}"
@@ -44,96 +166,718 @@ IMPORTANT CONTEXT:
 - The last message in the conversation is from someone else TO "{user_name}"
 - Generate replies from the perspective of "{user_name}"
 
-When given a conversation history, provide exactly 3 reply suggestions with analysis.
+When given a conversation history, provide exactly as many reply suggestions as the request asks for, with analysis.
 
-IMPORTANT: You must respond with ONLY a valid JSON object in this exact format:
+IMPORTANT: You must respond with ONLY a valid JSON object in this exact format, with one object in "suggestions" per requested suggestion:
 {{
-    "suggestions": [
-        {{
-            "reply": "Your first suggested reply here",
-            "tone": "friendly/professional/casual/empathetic/assertive",
-            "confidence": 0.85,
-            "explanation": "Brief explanation of why this is appropriate"
-        }},
-        {{
-            "reply": "Your second suggested reply here",
-            "tone": "friendly/professional/casual/empathetic/assertive",
-            "confidence": 0.75,
-            "explanation": "Brief explanation of why this is appropriate"
-        }},
-        {{
-            "reply": "Your third suggested reply here",
-            "tone": "friendly/professional/casual/empathetic/assertive",
-            "confidence": 0.70,
-            "explanation": "Brief explanation of why this is appropriate"
-        }}
-    ],
-    "conversation_analysis": {{
-        "summary": "Brief summary of the conversation context",
-        "last_message_intent": "The intent of the last message sent TO {user_name}",
-        "suggested_action": "What action {user_name}'s reply should take"
+"suggestions": [
+    {{
+        "reply": "Your suggested reply here",
+        "tone": "friendly/professional/casual/empathetic/assertive",
+        "confidence": 0.85,
+        "explanation": "Brief explanation of why this is appropriate"
     }}
+],
+"conversation_analysis": {{
+    "summary": "Brief summary of the conversation context",
+    "last_message_intent": "The intent of the last message sent TO {user_name}",
+    "suggested_action": "What action {user_name}'s reply should take"
+}}
 }}
 
 Guidelines:
 1. Each suggestion should be a reply that {user_name} would send
-2. Consider that {user_name} is responding to {last_message['sender']}'s message
-3. Each suggestion should have a different tone and approach
+2. Consider who sent the last message {user_name} is responding to
+3. Each suggestion should have a different tone and approach, using only the tones the request allows
 4. Confidence scores should be between 0 and 1
 5. Provide clear, actionable suggestions
 6. Consider the full conversation context"""
+    
+    instruction = (f"Please provide {options.amount()} for {user_name} to respond to "
+                   f"{last_message['sender']}'s last message.{options.tone_instruction()}")
+    
+    return system_prompt, instruction
+
+
+def build_regenerate_instruction(conversation_history: List[Dict[str, str]], user_name: str, data: Dict,
+                                 index: int, options: Optional[SuggestionOptions] = None) -> str:
+    """
+    Instruction asking for one replacement for suggestion `index` of an earlier response.
+    
+    The earlier analysis and suggestions are passed along, so the model neither
+    repeats the analysis nor one of the other suggestions.
+    """
+    options = options or SuggestionOptions()
+    last_message = conversation_history[-1]
+    current = "\n".join(f"{i + 1}. ({s.get('tone')}) {s.get('reply')}" for i, s in enumerate(data.get("suggestions", [])))
+    return f"""Please provide 1 reply suggestion for {user_name} to respond to {last_message['sender']}'s last message, to replace suggestion {index + 1}.{options.tone_instruction()}
+It must be clearly different from all of the current suggestions:
+{current}
+
+The conversation is already analyzed: {json.dumps(data.get("conversation_analysis") or {}, ensure_ascii=False)}
+So respond with only the "suggestions" list, without "conversation_analysis"."""
+
+
+def suggestion_session_key(conversation_history: List[Dict[str, str]], user_name: str, conversation_id: Optional[str] = None) -> str:
+    """Key of the chat session a request runs on."""
+    if conversation_id:
+        return f"{conversation_id}:{user_name}"
+    return make_session_key(conversation_history, user_name)
+
+
+def create_suggestion_chat(conversation_history: List[Dict[str, str]], user_name: str, session_key: str, client, model: str = MODEL,
+                           options: Optional[SuggestionOptions] = None, instruction: Optional[str] = None):
+    """
+    Create a chat for this request on top of the conversation's persistent session, on a client leased from the pool.
+    
+    `instruction` replaces the usual request for suggestions, e.g. to regenerate one of them.
+    """
+    system_prompt, default_instruction = build_suggestion_prompts(conversation_history, user_name, options)
+    instruction = instruction or default_instruction
+    return chat_sessions.prepare_chat(client, model, session_key, system_prompt, conversation_history, instruction)
+
+
+def route_request(conversation_history: List[Dict[str, str]]):
+    """Pick the model tier for a request and count the decision."""
+    decision = model_router.route(conversation_history)
+    route_decisions.inc(tier=decision.tier, reason=decision.reason)
+    return decision
+
+
+def local_suggestions(conversation_history: List[Dict[str, str]], user_name: str,
+                      options: Optional[SuggestionOptions] = None) -> Optional[Dict]:
+    """Template suggestions for a formulaic last message, or None if the model is needed."""
+    match = fast_path.classify(conversation_history, user_name)
+    if match is None:
+        return None
+    # The templates may not have enough suggestions in the requested tones
+    suggestions = (options or SuggestionOptions()).select(match.data["suggestions"])
+    if suggestions is None:
+        return None
+    fast_path_hits.inc(intent=match.intent)
+    route_decisions.inc(tier="local", reason=match.intent)
+    return {
+        "success": True,
+        "data": {**match.data, "suggestions": suggestions},
+        "routing": {"tier": "local", "model": "local", "reason": match.intent, "confidence": match.confidence}
+    }
+
+
+def suggestion_cache_key(conversation_history: List[Dict[str, str]], user_name: str,
+                         options: Optional[SuggestionOptions] = None) -> str:
+    """Cache key of a suggestion request; requests for another count or other tones get their own."""
+    return make_cache_key(conversation_history, user_name, MODEL, options.cache_variant() if options else "")
+
+
+def similar_suggestions(conversation_history: List[Dict[str, str]], user_name: str,
+                        options: Optional[SuggestionOptions] = None) -> Optional[Dict]:
+    """Suggestions of a near-identical earlier conversation, or None."""
+    # The near-duplicate index only holds responses with the default count and tones
+    if similar_cache is None or (options is not None and not options.is_default):
+        return None
+    match = similar_cache.get(conversation_history, user_name)
+    if match is None:
+        return None
+    return {**match.result, "similarity": match.similarity}
+
+
+def lookup_suggestions(cache_key: str, conversation_history: List[Dict[str, str]], user_name: str,
+                       options: Optional[SuggestionOptions] = None) -> Optional[Dict]:
+    """A cached response for this request, an exact repeat or a near-duplicate, or None."""
+    cached = suggestion_cache.get(cache_key)
+    if cached is None and check_conversation(conversation_history, user_name) is None:
+        cached = similar_suggestions(conversation_history, user_name, options)
+    return cached
+
+
+def replay_events(cached: Dict) -> Iterator[Tuple[str, Dict]]:
+    """The suggestion and analysis events of a cached response, as /suggest/stream sends them."""
+    for suggestion in cached["data"].get("suggestions", []):
+        yield "suggestion", suggestion
+    if "conversation_analysis" in cached["data"]:
+        yield "analysis", cached["data"]["conversation_analysis"]
+
+
+def remember_suggestions(cache_key: str, conversation_history: List[Dict[str, str]], user_name: str, result: Dict,
+                         options: Optional[SuggestionOptions] = None):
+    """Cache a successful model response for exact repeats and near-duplicates."""
+    if not result.get("success"):
+        return
+    suggestion_cache.set(cache_key, result)
+    # Template answers are instant anyway
+    if (similar_cache is not None and (options is None or options.is_default)
+            and (result.get("routing") or {}).get("tier") != "local"):
+        similar_cache.set(conversation_history, user_name, result)
+
+
+def client_address(header: Callable[[str], Optional[str]], remote_addr: Optional[str]) -> str:
+    """The address a request counts against for admission control, given a header lookup and the peer address."""
+    if ADMISSION_CLIENT_HEADER:
+        forwarded = header(ADMISSION_CLIENT_HEADER)
+        if forwarded:
+            # The last hop is the one our proxy added; anything before it came from the client
+            return forwarded.split(",")[-1].strip()
+    return remote_addr or "unknown"
+
+
+@contextmanager
+def upstream_slot():
+    """Hold an admission slot for the block, after waiting for it in the fair queue."""
+    if admission is None:
+        yield
+        return
+    started = time.perf_counter()
+    with admission.admit(admission_client.get()):
+        record_stage(admission_wait_seconds, "queue", time.perf_counter() - started)
+        yield
+
+
+def count_tokens(response):
+    """Add a response's token usage to the counters."""
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        input_tokens.inc(usage.prompt_tokens)
+        output_tokens.inc(usage.completion_tokens)
+
+
+def finish_suggestions(result: Dict, response, prompt_info: Dict, session_key: str, turns: int) -> Dict:
+    """Attach prompt size to a parsed result and seed the session's rolling summary from it."""
+    usage = getattr(response, "usage", None)
+    if usage is not None and usage.prompt_tokens:
+        prompt_info = {**prompt_info, "prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+    
+    analysis = result.get("conversation_analysis") or {}
+    chat_sessions.record_summary(session_key, analysis.get("summary"), turns)
+    
+    return {
+        "success": True,
+        "data": result,
+        "prompt": prompt_info
+    }
+
+
+def fallback_response(error: str = "Failed to parse AI response") -> Dict:
+    """Canned response used when the model output isn't valid JSON or the model can't be reached in time."""
+    fallback_responses.inc()
+    return {
+        "success": False,
+        "error": error,
+        "data": {
+            "suggestions": [
+                {
+                    "reply": "I'll look into this and get back to you.",
+                    "tone": "professional",
+                    "confidence": 0.7,
+                    "explanation": "Safe default response"
+                }
+            ],
+            "conversation_analysis": {
+                "summary": "Error analyzing conversation",
+                "last_message_intent": "Unknown",
+                "suggested_action": "Acknowledge and investigate"
+            }
+        }
+    }
+
+
+def sample_suggestions(conversation_history: List[Dict[str, str]], user_name: str, conversation_id: Optional[str],
+                       options: Optional[SuggestionOptions] = None, instruction: Optional[str] = None) -> Tuple[Dict, object, Dict, str, Dict]:
+    """
+    Call the model for suggestions and parse its answer.
+    
+    Returns:
+        (parsed output, response, prompt_info, session_key, routing)
+    
+    Raises:
+        json.JSONDecodeError: if the output isn't valid JSON (the raw output is in its .doc)
+    """
+    # Wait for an admission slot, then build the prompt and call the model on a pooled client
+    with upstream_slot(), client_pool.lease() as client:
+        # Reuse the conversation's session so only new turns are sent
+        with timed(prompt_build_seconds, "prompt"):
+            decision = route_request(conversation_history)
+            session_key = suggestion_session_key(conversation_history, user_name, conversation_id)
+            chat, prompt_info = create_suggestion_chat(conversation_history, user_name, session_key, client, decision.model,
+                                                       options, instruction)
+        routing = decision.to_dict()
         
-        chat.append(system(system_prompt))
-        
-        # Format the conversation history
-        conversation_text = "Here is the conversation history:\n\n"
-        for msg in conversation_history:
-            conversation_text += f"{msg['sender']}: {msg['message']}\n"
-        
-        conversation_text += f"\nPlease provide 3 reply suggestions for {user_name} to respond to {last_message['sender']}'s last message."
-        
-        chat.append(user(conversation_text))
+        # With hedging on, the call is streamed so a missing first token can be noticed
+        # and a backup call raced against it past the deadline
+        started = time.perf_counter()
+        call, attempts = resilient_call(
+            lambda: call_model(
+                chat,
+                lambda: create_suggestion_chat(conversation_history, user_name, session_key, client, decision.model,
+                                               options, instruction)[0],
+                decision.model,
+                hedge_policy
+            ),
+            upstream_breaker,
+            upstream_retry
+        )
+    if attempts > 1:
+        routing["attempts"] = attempts
+    response = call.response
+    upstream_ttft_seconds.observe(call.ttft if call.ttft is not None else time.perf_counter() - started)
+    if hedge_policy.enabled:
+        hedge_outcomes.inc(outcome=call.outcome)
+        routing.update(call.to_dict())
+    record_stage(upstream_seconds, "upstream", time.perf_counter() - started)
+    count_tokens(response)
+    
+    # Parse the JSON response
+    with timed(parse_seconds, "parse"):
+        result = json.loads(call.content)
+    return result, response, prompt_info, session_key, routing
+
+
+def generate_reply_suggestions(conversation_history: List[Dict[str, str]], user_name: str = "You", conversation_id: Optional[str] = None,
+                               options: Optional[SuggestionOptions] = None) -> Dict:
+    """Generate reply suggestions (3 in any tone unless options say otherwise) and return them with metadata."""
+    try:
+        error = check_conversation(conversation_history, user_name)
+        if error:
+            return error
         
-        # Get the response
-        response = chat.sample()
+        local = local_suggestions(conversation_history, user_name, options)
+        if local is not None:
+            return local
         
-        # Parse the JSON response
-        result = json.loads(response.content)
+        result, response, prompt_info, session_key, routing = sample_suggestions(
+            conversation_history, user_name, conversation_id, options)
         return {
-            "success": True,
-            "data": result
+            **finish_suggestions(result, response, prompt_info, session_key, len(conversation_history)),
+            "routing": routing
         }
         
     except json.JSONDecodeError as e:
         print(f"JSON parsing error: {e}")
-        print(f"Raw response: {response.content}")
+        print(f"Raw response: {e.doc}")
+        parse_failures.inc()
+        return fallback_response()
+    except Exception as e:
+        degraded = degraded_response(e)
+        if degraded is not None:
+            return degraded
+        print(f"Error: {e}")
         return {
             "success": False,
-            "error": "Failed to parse AI response",
-            "data": {
-                "suggestions": [
-                    {
-                        "reply": "I'll look into this and get back to you.",
-                        "tone": "professional",
-                        "confidence": 0.7,
-                        "explanation": "Safe default response"
-                    }
-                ],
-                "conversation_analysis": {
-                    "summary": "Error analyzing conversation",
-                    "last_message_intent": "Unknown",
-                    "suggested_action": "Acknowledge and investigate"
-                }
+            "error": str(e)
+        }
+
+
+def regenerate_suggestion(conversation_history: List[Dict[str, str]], user_name: str, index: int,
+                          conversation_id: Optional[str] = None, options: Optional[SuggestionOptions] = None,
+                          deadline: Optional[float] = None) -> Dict:
+    """
+    Replace suggestion `index` of the cached response for this conversation.
+    
+    Only the replacement is generated; the analysis and the other suggestions
+    come from the cache, so "give me another option" costs a fraction of the
+    output tokens of a full response. The updated response goes back into
+    the cache, so the next replacement steers clear of this one too.
+    Without a cached response the whole set is generated as usual.
+    """
+    with deadline_scope(deadline or SUGGEST_DEADLINE):
+        started = time.perf_counter()
+        cache_key = suggestion_cache_key(conversation_history, user_name, options)
+        cached = regeneration_base(cache_key, conversation_history, user_name, options)
+        if cached is None:
+            return _get_suggestions(conversation_history, user_name, conversation_id, "regenerate", options)
+        data = cached["data"]
+        if not 0 <= index < len(data.get("suggestions", [])):
+            return {
+                "success": False,
+                "error": f"There is no suggestion {index} to regenerate"
             }
+        
+        try:
+            instruction = build_regenerate_instruction(conversation_history, user_name, data, index, options)
+            result, response, prompt_info, _, routing = sample_suggestions(
+                conversation_history, user_name, conversation_id, options, instruction)
+            result = replace_suggestion(cache_key, cached, index, result, response, prompt_info, routing)
+        except Exception as e:
+            return regeneration_failed(cached, index, e)
+        record_history("regenerate", conversation_history, user_name, conversation_id, cache_key, result, started)
+        return result
+
+
+def regeneration_base(cache_key: str, conversation_history: List[Dict[str, str]], user_name: str,
+                      options: Optional[SuggestionOptions] = None) -> Optional[Dict]:
+    """
+    The response a regeneration edits: what the client was shown for this conversation, or None.
+
+    That may have been a near-duplicate's suggestions. They are stored under
+    this conversation's own key first, so the replacement is made and kept
+    there instead of the same near-duplicate being served again.
+    """
+    cached = lookup_suggestions(cache_key, conversation_history, user_name, options)
+    if cached is None or not cached.get("success"):
+        return None
+    if "similarity" in cached:
+        suggestion_cache.set(cache_key, cached)
+    return cached
+
+
+def replace_suggestion(cache_key: str, cached: Dict, index: int, result: Dict, response, prompt_info: Dict, routing: Dict) -> Dict:
+    """
+    Swap the model's replacement in for suggestion `index` of a cached response, and cache the result.
+
+    Raises:
+        ValueError: if the model's output has no usable replacement
+    """
+    replacement = result["suggestions"][0]
+    if not isinstance(replacement, dict) or "reply" not in replacement:
+        raise ValueError("The replacement has no reply")
+    
+    data = cached["data"]
+    suggestions = list(data["suggestions"])
+    suggestions[index] = replacement
+    updated = {**cached, "data": {**data, "suggestions": suggestions}}
+    suggestion_cache.set(cache_key, updated)
+    
+    usage = getattr(response, "usage", None)
+    if usage is not None and usage.prompt_tokens:
+        prompt_info = {**prompt_info, "prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+    return {**updated, "prompt": prompt_info, "routing": routing, "regenerated": index, "cached": False}
+
+
+def regeneration_failed(cached: Dict, index: int, error: Exception) -> Dict:
+    """The cached response, unchanged, with why suggestion `index` couldn't be replaced."""
+    if isinstance(error, json.JSONDecodeError):
+        parse_failures.inc()
+    reason = degraded_reason(error)
+    if reason is not None:
+        degraded_responses.inc(reason=reason[0])
+    print(f"Error regenerating suggestion {index}: {error}")
+    # Nothing was replaced; the client keeps showing what it has
+    return {**cached, "success": False, "error": reason[1] if reason else str(error), "degraded": reason is not None}
+
+
+def degraded_reason(error: Exception) -> Optional[Tuple[str, str]]:
+    """(reason, message) for a request that hit its deadline, the open circuit breaker or load shedding, otherwise None."""
+    if isinstance(error, AdmissionRejected):
+        return error.reason, str(error)
+    if isinstance(error, CircuitOpenError):
+        return "circuit_open", "The model is unavailable right now"
+    if is_deadline_error(error):
+        return "deadline", "The model didn't answer in time"
+    return None
+
+
+def degraded_response(error: Exception) -> Optional[Dict]:
+    """Fallback suggestions for a request that hit its deadline, the open circuit breaker or load shedding, otherwise None."""
+    reason = degraded_reason(error)
+    if reason is None:
+        return None
+    degraded_responses.inc(reason=reason[0])
+    return {**fallback_response(reason[1]), "degraded": True}
+
+
+def stream_reply_suggestions(conversation_history: List[Dict[str, str]], user_name: str = "You", conversation_id: Optional[str] = None,
+                             options: Optional[SuggestionOptions] = None) -> Iterator[Tuple[str, Dict]]:
+    """
+    Stream reply suggestions as they are generated.
+    
+    Yields ("suggestion", suggestion) for every suggestion and ("analysis", analysis)
+    for the conversation analysis as soon as each object is complete, then a final
+    ("done", result) carrying the same response generate_reply_suggestions returns.
+    """
+    error = check_conversation(conversation_history, user_name)
+    if error:
+        yield "done", error
+        return
+    
+    local = local_suggestions(conversation_history, user_name, options)
+    if local is not None:
+        for suggestion in local["data"]["suggestions"]:
+            yield "suggestion", suggestion
+        yield "analysis", local["data"]["conversation_analysis"]
+        yield "done", local
+        return
+    
+    content = ""
+    try:
+        parser = IncrementalSuggestionParser()
+        response = None
+        with upstream_slot(), client_pool.lease() as client:
+            with timed(prompt_build_seconds, "prompt"):
+                decision = route_request(conversation_history)
+                session_key = suggestion_session_key(conversation_history, user_name, conversation_id)
+                chat, prompt_info = create_suggestion_chat(conversation_history, user_name, session_key, client, decision.model, options)
+            
+            started = time.perf_counter()
+            # Tokens already reached the client, so a stream isn't retried; it still goes through the breaker
+            probe = upstream_breaker.before_call()
+            try:
+                with closing(chat.stream()) as stream:
+                    for response, chunk in stream:
+                        if parser.text == "" and chunk.content:
+                            upstream_ttft_seconds.observe(time.perf_counter() - started)
+                        for key, obj in parser.feed(chunk.content):
+                            yield ("suggestion" if key == "suggestions" else "analysis"), obj
+            except GeneratorExit:
+                # The client went away mid-stream: closing the upstream stream cancels the call,
+                # which says nothing about the upstream, and a probe must not stay taken
+                upstream_breaker.cancel_call(probe)
+                raise
+            except Exception as e:
+                upstream_breaker.after_call(probe, e)
+                raise
+            upstream_breaker.after_call(probe)
+        record_stage(upstream_seconds, "upstream", time.perf_counter() - started)
+        count_tokens(response)
+        
+        content = parser.text
+        with timed(parse_seconds, "parse"):
+            result = json.loads(content)
+        yield "done", {
+            **finish_suggestions(result, response, prompt_info, session_key, len(conversation_history)),
+            "routing": decision.to_dict()
         }
+        
+    except json.JSONDecodeError as e:
+        print(f"JSON parsing error: {e}")
+        print(f"Raw response: {content}")
+        parse_failures.inc()
+        yield "done", fallback_response()
     except Exception as e:
+        degraded = degraded_response(e)
+        if degraded is not None:
+            yield "done", degraded
+            return
         print(f"Error: {e}")
-        return {
+        yield "done", {
             "success": False,
             "error": str(e)
         }
 
 
+def record_history(source: str, conversation_history: List[Dict[str, str]], user_name: str,
+                   conversation_id: Optional[str], cache_key: str, result: Dict, started: float):
+    """Queue one request/response pair for the suggestion history log."""
+    if suggestion_history is None:
+        return
+    data = result.get("data") or {}
+    prompt = result.get("prompt") or {}
+    routing = result.get("routing") or {}
+    suggestion_history.record({
+        "source": source,
+        "conversation_id": conversation_id,
+        "conversation_hash": cache_key,
+        "model": routing.get("model", MODEL),
+        "routing": routing or None,
+        "user_name": user_name,
+        "turns": len(conversation_history),
+        "success": result.get("success", False),
+        "cached": result.get("cached", False),
+        "coalesced": result.get("coalesced", False),
+        "latency_ms": round(1000 * (time.perf_counter() - started), 1),
+        "prompt_tokens": prompt.get("prompt_tokens"),
+        "completion_tokens": prompt.get("completion_tokens"),
+        "suggestions": data.get("suggestions"),
+        "analysis": data.get("conversation_analysis"),
+        "error": result.get("error")
+    })
+
+
+def get_suggestions(conversation_history: List[Dict[str, str]], user_name: str = "You",
+                    conversation_id: Optional[str] = None, source: str = "suggest",
+                    deadline: Optional[float] = None, options: Optional[SuggestionOptions] = None) -> Dict:
+    """
+    Return suggestions for a conversation.
+    
+    Repeats are served from the cache, and identical requests that arrive
+    while the first one is still waiting on the model share its result.
+    The request gets `deadline` seconds (SUGGEST_DEADLINE by default).
+    `options` picks the number of suggestions and their tones.
+    Every call is recorded in the suggestion history, tagged with source.
+    """
+    with deadline_scope(deadline or SUGGEST_DEADLINE):
+        return _get_suggestions(conversation_history, user_name, conversation_id, source, options)
+
+
+def _get_suggestions(conversation_history: List[Dict[str, str]], user_name: str,
+                     conversation_id: Optional[str], source: str, options: Optional[SuggestionOptions] = None) -> Dict:
+    started = time.perf_counter()
+    cache_key = suggestion_cache_key(conversation_history, user_name, options)
+    if speculative_runs is not None:
+        speculative_runs.mark_used(cache_key)
+    cached = lookup_suggestions(cache_key, conversation_history, user_name, options)
+    if cached is not None:
+        result = {**cached, "cached": True}
+        record_history(source, conversation_history, user_name, conversation_id, cache_key, result, started)
+        return result
+    
+    def generate():
+        result = generate_reply_suggestions(conversation_history, user_name, conversation_id, options)
+        remember_suggestions(cache_key, conversation_history, user_name, result, options)
+        return result
+    
+    try:
+        wait_timeout = min(COALESCE_WAIT_TIMEOUT, max(remaining_time(), 0.0))
+        result, coalesced = suggestion_flights.do(cache_key, generate, wait_timeout=wait_timeout)
+    except TimeoutError as e:
+        # Waited on an identical call until our own deadline ran out
+        result, coalesced = degraded_response(DeadlineExceeded(str(e))), True
+    result = {**result, "cached": False, "coalesced": coalesced}
+    record_history(source, conversation_history, user_name, conversation_id, cache_key, result, started)
+    return result
+
+
+# Append-only log of every suggestion request and response, written off the request path.
+# Read it back with `python suggestion_history.py <dir>`; set SUGGESTION_HISTORY_DIR= to turn it off
+SUGGESTION_HISTORY_DIR = os.getenv("SUGGESTION_HISTORY_DIR", "suggestion_history")
+suggestion_history = None
+if SUGGESTION_HISTORY_DIR:
+    suggestion_history = SuggestionHistory(
+        SUGGESTION_HISTORY_DIR,
+        max_segment_bytes=int(os.getenv("SUGGESTION_HISTORY_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+    )
+
+
+# Identical /suggest requests in flight at the same time share one model call
+suggestion_flights = SingleFlight()
+COALESCE_WAIT_TIMEOUT = float(os.getenv("COALESCE_WAIT_TIMEOUT", "120"))
+
+
+# Opt-in speculative generation: when the other party's message arrives, start on the
+# suggestions right away so the user's /suggest is a cache hit or joins the running call
+SPECULATIVE_USER_NAME = os.getenv("SPECULATIVE_USER_NAME", "You")
+speculative_runs = None
+if os.getenv("SPECULATIVE_SUGGESTIONS", "0") == "1":
+    speculative_runs = SpeculativeRunner(
+        get_suggestions,
+        max_in_flight=int(os.getenv("SPECULATIVE_MAX_IN_FLIGHT", "2")),
+        debounce=float(os.getenv("SPECULATIVE_DEBOUNCE", "0.5")),
+        max_wasted=int(os.getenv("SPECULATIVE_MAX_WASTED_PER_HOUR", "30")),
+        waste_window=3600.0
+    )
+
+
+def speculate(room: str, conversation: List[Dict[str, str]]):
+    """Start generating suggestions for the user if the last message came from someone else."""
+    if speculative_runs is None:
+        return
+    if check_conversation(conversation, SPECULATIVE_USER_NAME) is not None:
+        return
+    cache_key = make_cache_key(conversation, SPECULATIVE_USER_NAME, MODEL)
+    speculative_runs.trigger(room, cache_key, conversation, SPECULATIVE_USER_NAME, room, "speculative")
+
+
+# Worker pool for job-mode /suggest requests
+suggestion_jobs = SuggestionJobQueue(
+    get_suggestions,
+    workers=int(os.getenv("SUGGEST_WORKERS", "4")),
+    max_depth=int(os.getenv("SUGGEST_QUEUE_DEPTH", "64")),
+    result_ttl=float(os.getenv("SUGGEST_JOB_TTL", "600"))
+)
+
+
+def collect_component_stats():
+    """Report cache, session and job queue counters on /metrics."""
+    cache = suggestion_cache.stats()
+    yield "suggest_cache_hits_total", "counter", "Suggestion cache hits", cache["hits"]
+    yield "suggest_cache_misses_total", "counter", "Suggestion cache misses", cache["misses"]
+    yield "suggest_cache_entries", "gauge", "Entries in the suggestion cache", cache["entries"]
+    yield "suggest_cache_bytes", "gauge", "Approximate size of the suggestion cache", cache["bytes"]
+    if similar_cache is not None:
+        similar = similar_cache.stats()
+        yield "suggest_similar_cache_hits_total", "counter", "Requests answered with a near-duplicate conversation's suggestions", similar["hits"]
+        yield "suggest_similar_cache_misses_total", "counter", "Near-duplicate lookups without a close enough match", similar["misses"]
+        yield "suggest_similar_cache_entries", "gauge", "Conversations in the near-duplicate index", similar["entries"]
+        yield "suggest_similar_cache_bytes", "gauge", "Approximate size of the near-duplicate index", similar["bytes"]
+    sessions = chat_sessions.stats()
+    yield "chat_sessions", "gauge", "Live chat sessions", sessions["sessions"]
+    yield "chat_session_turns_reused_total", "counter", "Turns served from a session prefix", sessions["turns_reused"]
+    yield "chat_session_folds_total", "counter", "Times older turns were folded into a summary", sessions["folds"]
+    flights = suggestion_flights.stats()
+    yield "suggest_coalesced_requests_total", "counter", "Requests that shared an identical in-flight model call", flights["coalesced"]
+    yield "suggest_in_flight_calls", "gauge", "Distinct suggestion calls waiting on the model", flights["in_flight"]
+    jobs = suggestion_jobs.stats()
+    yield "suggest_job_queue_depth", "gauge", "Jobs waiting for a worker", jobs["queue_depth"]
+    yield "suggest_job_busy_workers", "gauge", "Workers running a job", jobs["busy_workers"]
+    yield "suggest_jobs_rejected_total", "counter", "Jobs rejected because the queue was full", jobs["rejected"]
+    if admission is not None:
+        admitted = admission.stats()
+        yield "suggest_admission_active", "gauge", "Upstream calls holding an admission slot", admitted["active"]
+        yield "suggest_admission_queued", "gauge", "Requests waiting for an admission slot", admitted["queued"]
+        yield "suggest_admission_rate_limited_total", "counter", "Requests refused by the per-user token bucket", admitted["rate_limited"]
+        yield "suggest_admission_shed_total", "counter", "Requests shed because the queue wait would exceed the SLO", admitted["shed"]
+    responses = response_cache.stats()
+    yield "http_response_cache_hits_total", "counter", "Polled responses served from an already serialized body", responses["hits"]
+    yield "http_not_modified_total", "counter", "Polled responses answered with 304 Not Modified", responses["not_modified"]
+    yield "http_response_bytes_saved_total", "counter", "Body bytes not sent thanks to 304s and compression", responses["bytes_saved"]
+    pool = client_pool.stats()
+    yield "upstream_client_pool_in_use", "gauge", "Calls in flight on pooled upstream clients", pool["in_use"]
+    yield "upstream_client_pool_utilization", "gauge", "Busy fraction of the pooled clients since startup", pool["utilization"]
+    yield "upstream_client_connects_total", "counter", "Upstream clients created, including reconnects", pool["connects"]
+    yield "upstream_client_reconnects_total", "counter", "Upstream clients replaced after a failed health check", pool["reconnects"]
+    breaker = upstream_breaker.stats()
+    yield "suggest_upstream_breaker_open", "gauge", "1 while the upstream circuit breaker fails calls fast", int(breaker["state"] == "open")
+    yield "suggest_upstream_breaker_opened_total", "counter", "Times the upstream circuit breaker opened", breaker["opened"]
+    yield "suggest_upstream_breaker_rejected_total", "counter", "Calls rejected by the open circuit breaker", breaker["rejected"]
+    yield "suggest_upstream_retries_total", "counter", "Upstream calls retried after a transient error", upstream_retry.retries
+    if suggestion_history is not None:
+        history = suggestion_history.stats()
+        yield "suggest_history_written_total", "counter", "Records written to the suggestion history", history["written"]
+        yield "suggest_history_dropped_total", "counter", "History records dropped because the writer fell behind", history["dropped"]
+        yield "suggest_history_pending", "gauge", "History records waiting for the writer", history["pending"]
+    if speculative_runs is not None:
+        speculative = speculative_runs.stats()
+        yield "suggest_speculative_started_total", "counter", "Speculative generations sent to the model", speculative["started"]
+        yield "suggest_speculative_used_total", "counter", "Speculative generations a later request asked for", speculative["used"]
+        yield "suggest_speculative_wasted_total", "counter", "Speculative generations superseded before being used", speculative["wasted"]
+        yield "suggest_speculative_cancelled_total", "counter", "Speculative generations cancelled before reaching the model", speculative["cancelled"]
+        yield "suggest_speculative_skipped_total", "counter", "Speculative generations skipped for concurrency or waste budget", speculative["skipped_busy"] + speculative["skipped_budget"]
+
+
+metrics_registry.add_collector(collect_component_stats)
+
+
+@app.before_request
+def start_request_timer():
+    """Start timing the request and collect stage timings if the client asked for them."""
+    g.request_started = time.perf_counter()
+    g.client_token = admission_client.set(client_address(request.headers.get, request.remote_addr))
+    if REQUEST_TIMING_HEADER or request.headers.get('X-Request-Timing') == '1':
+        g.timings_token = request_timings.set({})
+
+
+@app.after_request
+def finish_request_timer(response):
+    """Record the request duration and attach the Server-Timing header."""
+    # Streamed responses are timed when their generator finishes
+    if response.is_streamed:
+        return response
+    
+    elapsed = time.perf_counter() - g.request_started
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    request_seconds.observe(elapsed, route=route, method=request.method, status=response.status_code)
+    
+    timings = request_timings.get()
+    if timings is not None:
+        response.headers['Server-Timing'] = server_timing_header({**timings, "total": elapsed})
+    return response
+
+
+@app.teardown_request
+def reset_request_timings(exc):
+    """Stop collecting stage timings and forget the client once the request is over."""
+    token = g.pop('timings_token', None)
+    if token is not None:
+        request_timings.reset(token)
+    token = g.pop('client_token', None)
+    if token is not None:
+        admission_client.reset(token)
+
+
+@app.route('/metrics')
+def metrics():
+    """Expose counters and latency histograms in the Prometheus text format."""
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/')
 def index():
     """Render the main page for the user."""
@@ -146,13 +890,35 @@ def friend_view():
     return render_template('index.html', is_friend_view=True)
 
 
+def request_deadline(data: Dict) -> float:
+    """Time budget of a suggestion request: "deadline_ms" in the body or X-Request-Deadline-Ms, at most SUGGEST_DEADLINE."""
+    return deadline_seconds(data.get('deadline_ms') or request.headers.get('X-Request-Deadline-Ms'))
+
+
+def deadline_seconds(deadline_ms) -> float:
+    """A client-requested deadline in milliseconds as seconds, at most SUGGEST_DEADLINE (the default when missing or invalid)."""
+    try:
+        deadline = float(deadline_ms) / 1000 if deadline_ms else SUGGEST_DEADLINE
+    except (TypeError, ValueError):
+        deadline = SUGGEST_DEADLINE
+    return min(max(deadline, 0.001), SUGGEST_DEADLINE)
+
+
 @app.route('/suggest', methods=['POST'])
 def suggest():
-    """API endpoint to get reply suggestions."""
+    """
+    API endpoint to get reply suggestions.
+    
+    "count" (1-5, default 3) and "tones" (a list of tones) shape the
+    suggestions; "regenerate": <index> replaces just that suggestion of the
+    last response for the same conversation, count and tones.
+    """
     try:
         data = request.json
         conversation_history = data.get('conversation', [])
         user_name = data.get('user_name', 'You')
+        conversation_id = data.get('conversation_id')
+        deadline = request_deadline(data)
         
         if not conversation_history:
             return jsonify({
@@ -160,9 +926,39 @@ def suggest():
                 "error": "No conversation provided"
             })
         
-        # Generate suggestions
-        result = generate_reply_suggestions(conversation_history, user_name)
-        return jsonify(result)
+        try:
+            options = SuggestionOptions.from_request(data)
+        except ValueError as e:
+            return jsonify({
+                "success": False,
+                "error": str(e)
+            }), 400
+        
+        if data.get('regenerate') is not None:
+            index = data['regenerate']
+            if isinstance(index, bool) or not isinstance(index, int):
+                return jsonify({
+                    "success": False,
+                    "error": "regenerate must be the index of a suggestion"
+                }), 400
+            return jsonify(regenerate_suggestion(conversation_history, user_name, index, conversation_id, options, deadline))
+        
+        # Job mode: queue the work and let the client poll for the result
+        if data.get('mode') == 'job':
+            try:
+                job_id = suggestion_jobs.submit(conversation_history, user_name, conversation_id, "job", deadline, options)
+            except QueueFull as e:
+                return jsonify({
+                    "success": False,
+                    "error": str(e)
+                }), 503
+            return jsonify({
+                "success": True,
+                "job_id": job_id,
+                "status_url": f"/suggest/jobs/{job_id}"
+            }), 202
+        
+        return jsonify(get_suggestions(conversation_history, user_name, conversation_id, deadline=deadline, options=options))
         
     except Exception as e:
         return jsonify({
@@ -171,57 +967,232 @@ def suggest():
         })
 
 
+@app.route('/suggest/jobs/<job_id>')
+def suggest_job(job_id):
+    """Return the status of a queued suggestion job, with its result once done."""
+    job = suggestion_jobs.get(job_id)
+    if job is None:
+        return jsonify({
+            "success": False,
+            "error": "Unknown or expired job"
+        }), 404
+    return jsonify(job)
+
+
+@app.route('/suggest/jobs')
+def suggest_jobs_stats():
+    """Return queue depth, worker utilization and average queue/model times."""
+    return jsonify(suggestion_jobs.stats())
+
+
+def sse_event(event: str, data: Dict) -> str:
+    """Format one Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.route('/suggest/stream', methods=['POST'])
+def suggest_stream():
+    """Streaming variant of /suggest that pushes each suggestion as a Server-Sent Event. Takes the same "count" and "tones"."""
+    data = request.json or {}
+    conversation_history = data.get('conversation', [])
+    user_name = data.get('user_name', 'You')
+    conversation_id = data.get('conversation_id')
+    deadline = request_deadline(data)
+    client = admission_client.get()
+    started = g.request_started
+    try:
+        options = SuggestionOptions.from_request(data)
+        options_error = None
+    except ValueError as e:
+        options, options_error = None, str(e)
+    
+    def generate():
+        if not conversation_history or options_error:
+            yield sse_event("done", {
+                "success": False,
+                "error": options_error or "No conversation provided"
+            })
+            return
+        
+        # Replay cached responses without touching the model
+        cache_key = suggestion_cache_key(conversation_history, user_name, options)
+        cached = lookup_suggestions(cache_key, conversation_history, user_name, options)
+        if cached is not None:
+            for event, payload in replay_events(cached):
+                yield sse_event(event, payload)
+            result = {**cached, "cached": True}
+            record_history("stream", conversation_history, user_name, conversation_id, cache_key, result, started)
+            yield sse_event("done", result)
+            return
+        
+        for event, payload in stream_reply_suggestions(conversation_history, user_name, conversation_id, options):
+            if event == "done":
+                remember_suggestions(cache_key, conversation_history, user_name, payload, options)
+                payload = {**payload, "cached": False}
+                record_history("stream", conversation_history, user_name, conversation_id, cache_key, payload, started)
+            yield sse_event(event, payload)
+    
+    def timed_generate():
+        try:
+            with deadline_scope(deadline), client_scope(client):
+                yield from generate()
+        finally:
+            request_seconds.observe(time.perf_counter() - started, route='/suggest/stream', method='POST', status=200)
+    
+    return Response(
+        stream_with_context(timed_generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.route('/cache_stats')
+def cache_stats():
+    """Return hit/miss counters for the suggestion cache, request coalescing, chat session reuse, speculation, the upstream breaker, the local fast path, the near-duplicate cache, admission control, the client pool and the polled-response cache."""
+    return jsonify({
+        **suggestion_cache.stats(),
+        "coalescing": suggestion_flights.stats(),
+        "sessions": chat_sessions.stats(),
+        "speculative": speculative_runs.stats() if speculative_runs is not None else None,
+        "upstream": {**upstream_breaker.stats(), "retries": upstream_retry.retries},
+        "fast_path": fast_path.stats(),
+        "similar": similar_cache.stats() if similar_cache is not None else None,
+        "admission": admission.stats() if admission is not None else None,
+        "client_pool": client_pool.stats(),
+        "responses": response_cache.stats()
+    })
+
+
+def cached_json(key, version, build, cache_control: str = "no-cache") -> Response:
+    """
+    Send the cached JSON body for key at this version, building it with build() if needed.
+
+    Answers 304 when the client's If-None-Match already names the body.
+    """
+    payload = response_cache.payload(key, version, build)
+    status, body, headers = response_cache.render(
+        payload,
+        request.headers.get('If-None-Match', ''),
+        request.headers.get('Accept-Encoding', ''),
+        cache_control
+    )
+    return Response(body, status=status, headers=headers, mimetype='application/json')
+
+
+def fast_json(data, status: int = 200) -> Response:
+    """jsonify() for the hot routes, with the faster encoder."""
+    return Response(dumps(data), status=status, mimetype='application/json')
+
+
+EXAMPLES = [
+    {
+        "title": "Job Interview Follow-up",
+        "conversation": [
+            {"sender": "Recruiter", "message": "Thank you for coming in today for the interview!"},
+            {"sender": "You", "message": "Thank you for having me! I really enjoyed learning about the role."},
+            {"sender": "Recruiter", "message": "We were impressed with your background. We'll be making decisions by Friday. Do you have any questions?"}
+        ]
+    },
+    {
+        "title": "Customer Support",
+        "conversation": [
+            {"sender": "Customer", "message": "I ordered a product last week but haven't received it yet."},
+            {"sender": "You", "message": "I apologize for the delay. Let me look into your order right away."},
+            {"sender": "Customer", "message": "My order number is #12345. When can I expect to receive it?"}
+        ]
+    },
+    {
+        "title": "Team Collaboration",
+        "conversation": [
+            {"sender": "Colleague", "message": "Hey, are you available to review the presentation?"},
+            {"sender": "You", "message": "Sure! I can take a look at it."},
+            {"sender": "Colleague", "message": "Great! I've shared it with you. Could you provide feedback by tomorrow?"}
+        ]
+    }
+]
+
+
 @app.route('/examples')
 def examples():
     """Return example conversations."""
-    examples = [
-        {
-            "title": "Job Interview Follow-up",
-            "conversation": [
-                {"sender": "Recruiter", "message": "Thank you for coming in today for the interview!"},
-                {"sender": "You", "message": "Thank you for having me! I really enjoyed learning about the role."},
-                {"sender": "Recruiter", "message": "We were impressed with your background. We'll be making decisions by Friday. Do you have any questions?"}
-            ]
-        },
-        {
-            "title": "Customer Support",
-            "conversation": [
-                {"sender": "Customer", "message": "I ordered a product last week but haven't received it yet."},
-                {"sender": "You", "message": "I apologize for the delay. Let me look into your order right away."},
-                {"sender": "Customer", "message": "My order number is #12345. When can I expect to receive it?"}
-            ]
-        },
-        {
-            "title": "Team Collaboration",
-            "conversation": [
-                {"sender": "Colleague", "message": "Hey, are you available to review the presentation?"},
-                {"sender": "You", "message": "Sure! I can take a look at it."},
-                {"sender": "Colleague", "message": "Great! I've shared it with you. Could you provide feedback by tomorrow?"}
-            ]
-        }
-    ]
-    return jsonify(examples)
+    # Static, so clients may reuse them for a while before revalidating
+    return cached_json("examples", 0, lambda: EXAMPLES, cache_control="public, max-age=300")
+
+
+# Conversations shared between the user and friend views, one per room
+conversation_store = create_conversation_store()
+
+DEFAULT_ROOM = "default"
+MAX_ROOM_ID_LENGTH = 128
 
+# Longest time a sync request is held open waiting for a change
+SYNC_MAX_WAIT = float(os.getenv("SYNC_MAX_WAIT", "25"))
+
+def post_conversation(room: str, data: Dict) -> Tuple[Dict, int]:
+    """
+    Apply a /sync_conversation POST body to the room, for this app and asgi_app.py.
+    
+    Returns:
+        (response body, status): 400 unless the messages are a list of
+        {"sender": str, "message": str} objects
+    """
+    messages = data['append'] if 'append' in data else data.get('conversation', [])
+    error = check_messages(messages)
+    if error:
+        return {"success": False, "error": error}, 400
+    
+    if 'append' in data:
+        version = conversation_store.append(room, messages)
+        speculate(room, conversation_store.snapshot(room)["conversation"])
+        return {"success": True, "room": room, "version": version}, 200
+    
+    conversation_store.replace(room, messages)
+    snapshot = conversation_store.snapshot(room)
+    speculate(room, snapshot["conversation"])
+    return {"success": True, "room": room, **snapshot}, 200
 
-# Shared conversation storage for demo purposes
-shared_conversation = []
 
 @app.route('/sync_conversation', methods=['GET', 'POST'])
 def sync_conversation():
-    """Sync conversation between user and friend views."""
-    global shared_conversation
+    """
+    Sync conversation between user and friend views.
+    
+    Every request names its conversation with ?room=<id> (or "room" in the
+    POST body); without one it uses the default room.
+    GET without parameters returns the whole conversation. GET with
+    ?since=<version> returns only the messages added after that version and,
+    with &wait=<seconds>, holds the request open until something changes.
+    POST takes either {"append": [...]} for new messages or
+    {"conversation": [...]} to replace the whole conversation.
+    """
+    data = (request.json or {}) if request.method == 'POST' else {}
+    if not isinstance(data, dict):
+        return fast_json({"success": False, "error": "Expected a JSON object"}, 400)
+    room = str(data.get('room') or request.args.get('room') or DEFAULT_ROOM)
+    if len(room) > MAX_ROOM_ID_LENGTH:
+        return fast_json({"success": False, "error": "Room id is too long"}, 400)
     
     if request.method == 'POST':
-        data = request.json
-        shared_conversation = data.get('conversation', [])
-        return jsonify({"success": True, "conversation": shared_conversation})
-    else:
-        return jsonify({"conversation": shared_conversation})
-
+        body, status = post_conversation(room, data)
+        return fast_json(body, status)
+    
+    # Bodies are cached per room and `since` until the version moves, so an idle
+    # conversation is answered from memory, or with a 304 to clients that have it
+    since = request.args.get('since', type=int)
+    if since is None:
+        return cached_json((room, None), conversation_store.version(room),
+                           lambda: {"room": room, **conversation_store.snapshot(room)})
+    
+    wait = min(request.args.get('wait', 0, type=float), SYNC_MAX_WAIT)
+    if wait > 0 and conversation_store.version(room) == since:
+        changes = conversation_store.wait_for_changes(room, since, wait)
+        return cached_json((room, since), changes["version"], lambda: {"room": room, **changes})
+    return cached_json((room, since), conversation_store.version(room),
+                       lambda: {"room": room, **conversation_store.changes_since(room, since)})
 
 if __name__ == '__main__':
-    # Check if API key is set
-    if not os.getenv("XAI_API_KEY"):
+    # Check if API key is set (the local mock backend doesn't need one)
+    if os.getenv("XAI_BACKEND", "xai") == "xai" and not os.getenv("XAI_API_KEY"):
         print("Error: Please set your XAI_API_KEY environment variable")
         print("You can do this by running: export XAI_API_KEY='your-api-key-here'")
         exit(1)
@@ -235,4 +1206,4 @@ if __name__ == '__main__':
     print("   Friend view: http://localhost:5000/friend")
     print("\nOpen both URLs in different browser windows to simulate a conversation!")
     
-    app.run(debug=True, port=5000) 
\ No newline at end of file
+    app.run(debug=True, port=5000, threaded=True) 
\ No newline at end of file